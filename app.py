@@ -1,20 +1,181 @@
-from flask import Flask, request
+from flask import Flask, Response, g, make_response, request, stream_with_context
 from flask.json import jsonify
-import json
+import functools
+from itertools import chain, islice
 import sqlite3
-import statistics
+import threading
+import time
+import zlib
 from marshmallow import ValidationError
-from schemas import DeviceReadingSchema, DeviceReadingInputSchema, DeviceReadingValueInputSchema, DeviceReadingQuartilesInputSchema
+import columnar
+import instrumentation
+from cache import MISSING, MetricCache
+from db import DEFAULT_PRAGMAS, Connection, ConnectionPool, device_version, migrate, written_since
+from fleet import fleet_stats, list_devices
+from hub import ReadingHub, TooManySubscribers, sse_chunks
+from latest import LatestIndex, batch_latest_readings, latest_readings
+from ingest import IngestQueueFull, get_ingest_queue, insert_readings, parse_readings_body, put_batches, \
+    validate_readings
+from retrieval import batched, iter_fleet_readings, iter_readings, json_chunks, ndjson_chunks
+from shards import group_by_shard, shard_path, shard_paths
+from schemas import EXPORT_QUERY, PERCENTILE_QUERY, QUARTILES_QUERY, READING, READING_BULK, READING_QUERY, SENSOR_TYPES, \
+    VALUE_QUERY, LATEST_QUERY, BatchLatestInputSchema, BatchStatsInputSchema, DeviceReadingSeriesInputSchema, \
+    DeviceReadingStatsInputSchema, DeviceReadingStreamInputSchema, FleetStatsInputSchema, FleetStreamInputSchema, \
+    encode_cursor
+from series import bucket_series, lttb_series
+from instrumentation import InstrumentedConnection, TimingHistogram, render_samples, timed, timed_iter
+from stats import batch_stats, compute_stats, value_histogram
+from writer import WriterClient, WriterError
 
 app = Flask(__name__)
-
-# Setup the SQLite DB
+app.config.update(
+    # Put POSTed readings on a write-behind queue drained by a single writer
+    # thread in group commits, instead of committing in the request
+    INGEST_QUEUE=False,
+    # The most batches the queue holds before POSTs get a 503
+    INGEST_QUEUE_SIZE=10000,
+    # A group commit is written once this many rows are pending...
+    INGEST_BATCH_SIZE=1000,
+    # ...or this many seconds after the first of them was queued
+    INGEST_FLUSH_INTERVAL=0.05,
+    # Wait for the group commit holding the readings before responding
+    INGEST_DURABLE_ACK=False,
+    # Seconds a POST waiting for its commit, with a durable ack or a writer
+    # process, gives up after with a 503
+    INGEST_ACK_TIMEOUT=30,
+    # Seconds a client is told to back off for when the queue is full
+    INGEST_RETRY_AFTER=1,
+    # Base path of the SQLite database, test_database.db is used when TESTING
+    DATABASE='database.db',
+    # Pragmas applied to every pooled SQLite connection when it is opened
+    SQLITE_PRAGMAS=DEFAULT_PRAGMAS,
+    # Prepared statements cached per pooled connection
+    SQLITE_CACHED_STATEMENTS=256,
+    # Idle connections the pool keeps around per database
+    SQLITE_POOL_MAX_IDLE=16,
+    # Cache metric results. None turns the cache on except when TESTING
+    METRIC_CACHE=None,
+    # The most metric results the cache holds
+    METRIC_CACHE_SIZE=10000,
+    # Seconds results for windows that have not closed yet are cached for
+    METRIC_CACHE_OPEN_TTL=5,
+    # Number of SQLite files the readings are spread over by a hash of the
+    # device_uuid. Change it with shards.py, which moves the readings
+    SHARD_COUNT=1,
+    # Threads the ASGI entry point in asgi.py runs requests on
+    ASGI_WORKERS=32,
+    # Requests the ASGI entry point queues for those threads before it
+    # answers with a 503
+    ASGI_MAX_PENDING=1000,
+    # Seconds the ASGI entry point waits for a client that stopped reading a
+    # streamed response before abandoning it and freeing its thread
+    ASGI_SEND_TIMEOUT=30,
+    # Live streams the ASGI entry point serves at once. Each holds one of the
+    # ASGI_WORKERS threads, so it must be lower, and past it they get a 503
+    ASGI_MAX_STREAMS=16,
+    # Worker processes fleet queries are split across, None for one per core
+    FLEET_WORKERS=None,
+    # Fleet queries over fewer devices than this are computed in the request
+    FLEET_MIN_PARALLEL_DEVICES=64,
+    # Time every request by route and phase, exposed on /metrics
+    INSTRUMENTATION=True,
+    # Statements running longer than this many seconds have their query plan
+    # sampled. None turns it off
+    SLOW_QUERY_THRESHOLD=0.1,
+    # Seconds before the plan of the same slow statement is sampled again
+    SLOW_QUERY_EXPLAIN_INTERVAL=60,
+    # Readings a live stream subscriber can fall behind by before it is
+    # disconnected, to resume from its last event id
+    STREAM_BUFFER_SIZE=1000,
+    # Recent readings kept for subscribers resuming with a Last-Event-ID
+    STREAM_HISTORY=10000,
+    # Seconds of silence before a stream sends a keepalive comment
+    STREAM_HEARTBEAT=15,
+    # The most live streams served at once, past it they get a 503
+    STREAM_MAX_SUBSCRIBERS=1000,
+    # Serve latest readings from an in-process index per shard, kept
+    # current by the write path. None turns it on except when TESTING
+    LATEST_INDEX=None,
+    # Prefix of the live stream event ids, None for a random one. serve.py
+    # gives all its reader processes the same one
+    STREAM_EPOCH=None,
+    # Unix socket of the writer process every write is sent to instead of
+    # being committed here, and the key to authenticate with. Set by
+    # serve.py in its reader processes
+    WRITER_ADDRESS=None,
+    WRITER_AUTHKEY=None,
+    # Commits the writer process queues for a reader that is slow to take
+    # them in before dropping it. The reader follows again, and its caches
+    # catch up from the write versions
+    WRITER_FOLLOW_BUFFER=1000,
+)
+
+# Setup the SQLite DB, every shard is migrated when it is first connected to
 conn = sqlite3.connect('database.db')
-conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+migrate(conn)
 conn.close()
 
 
+def _conditional(view):
+    """
+    Answer the GETs of a device route from the device's write version.
+
+    The ETag is the version of the device (with the time of its last write
+    and the Accept header, which picks the format), and Last-Modified that
+    time. A request whose If-None-Match or If-Modified-Since still matches
+    gets a 304 from a single lookup in the devices table, without the view
+    running at all. The version is read before the view, so a response is
+    never older than its ETag, at worst newer.
+    """
+
+    @functools.wraps(view)
+    def wrapper(device_uuid):
+        if request.method not in ('GET', 'HEAD'):
+            return view(device_uuid)
+
+        version = _get_device_version(device_uuid)
+        if version is None:
+            return view(device_uuid)
+
+        number, modified = version
+        etag = '{}.{}.{:x}'.format(number, modified, zlib.crc32(request.headers.get('Accept', '').encode()))
+        # Only once the second of the last write is over, so a later write
+        # can never share its Last-Modified
+        last_modified = modified // 1000 if time.time() >= modified // 1000 + 1 else None
+
+        if request.if_none_match:
+            not_modified = etag in request.if_none_match
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and modified // 1000 <= since.timestamp()
+
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(view(device_uuid))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.vary.add('Accept')
+        return response
+
+    return wrapper
+
+
+def _get_device_version(device_uuid):
+    # Read once per request, before anything is computed from the readings,
+    # so what was computed is never older than the version
+    versions = g.setdefault('device_versions', {})
+    if device_uuid not in versions:
+        versions[device_uuid] = device_version(_get_db_connection(device_uuid), device_uuid)
+    return versions[device_uuid]
+
+
 @app.route('/devices/<string:device_uuid>/readings/', methods=['POST', 'GET'])
+@_conditional
 def request_device_readings(device_uuid):
     """
     This endpoint allows clients to POST or GET data specific sensor types.
@@ -25,63 +186,76 @@ def request_device_readings(device_uuid):
     * date_created -> The epoch date of the sensor reading.
         If none provided, we set to now.
 
+    The POST body may also be a JSON array of readings, or NDJSON when sent
+    with an application/x-ndjson content type. A batch is written in a
+    single transaction and the response reports the number of readings
+    inserted along with the errors for each rejected item, by index.
+
     Optional Query Parameters:
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
+    * limit -> The most readings to return. When there are more, the
+        X-Next-Cursor response header holds the cursor for the next page
+    * cursor -> The X-Next-Cursor of the previous page
+
+    Readings are streamed in date_created order as a JSON array, as NDJSON
+    when the client accepts application/x-ndjson, or in the binary format
+    of columnar.py when it accepts application/vnd.canary.columnar.
     """
 
-    conn = _get_db_connection()
-    cur = conn.cursor()
+    conn = _get_db_connection(device_uuid)
 
     if request.method == 'POST':
         # Grab the post parameters
-        post_data = json.loads(request.data)
-
         try:
-            # Validate the payload
-            data = DeviceReadingSchema().load(post_data)
-        except ValidationError as err:
-            return err.messages, 400
-
-        # Insert data into db
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (device_uuid, data['type'], data['value'], data['date_created']))
-
-        conn.commit()
-
-        # Return success
-        return 'success', 201
+            items, many = parse_readings_body(request.data, request.mimetype)
+        except ValueError:
+            return dict(_schema=['Invalid JSON.']), 400
+
+        if not many:
+            try:
+                # Validate the payload
+                with timed('validation'):
+                    data = READING.load(items[0])
+            except ValidationError as err:
+                return err.messages, 400
+
+            rows, errors = [(device_uuid, data['type'], data['value'], data['date_created'])], {}
+        else:
+            # Validate the whole batch, it is then written in one transaction
+            with timed('validation'):
+                rows, errors = validate_readings(READING, items, device_uuid)
+
+        return _write_readings(rows, errors, many)
     else:
         try:
             # Validate the request args
-            data = DeviceReadingInputSchema().load(request.args)
+            with timed('validation'):
+                data = READING_QUERY.load(request.args)
         except ValidationError as err:
             return err.messages, 400
 
-        # Construct the query
-        # Ideally we would use an ORM instead of writing inline SQL
-        query = 'select * from readings where device_uuid = ?'
-        if data['type']:
-            query += ' and type = ?'
-        if data['start']:
-            query += ' and date_created >= ?'
-        if data['end']:
-            query += ' and date_created < ?'
+        # Stream the readings straight off the cursor in (date_created, rowid)
+        # order, so memory stays flat however many there are
+        rows = iter_readings(conn, device_uuid, data['type'], data['start'], data['end'], data['cursor'])
 
-        # Doing this to avoid SQL injection, which would be possible if
-        # doing 'select * from readings where blah={}'.format(param)
-        params = tuple(p for p in (device_uuid, data['type'], data['start'], data['end']) if p)
+        headers = {}
+        if data['limit']:
+            # Keyset pagination, read one reading past the page to find out
+            # whether there is another page after it
+            with timed('materialization'):
+                rows = list(islice(rows, data['limit'] + 1))
+            if len(rows) > data['limit']:
+                rows = rows[:-1]
+                headers['X-Next-Cursor'] = encode_cursor(rows[-1][4], rows[-1][0])
 
-        # Execute the query
-        cur.execute(query, params)
-        rows = cur.fetchall()
-
-        # Return the JSON
-        return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
+        # Return the JSON, unless the client asked for another format
+        return _stream_readings(rows, headers, ['application/json', 'application/x-ndjson', columnar.MIMETYPE])
 
 
 @app.route('/devices/<string:device_uuid>/readings/min/', methods=['GET'])
+@_conditional
 def request_device_readings_min(device_uuid):
     """
     This endpoint allows clients to GET the min sensor reading for a device.
@@ -94,37 +268,31 @@ def request_device_readings_min(device_uuid):
     * end -> The epoch end time for a sensor being created
     """
 
-    conn = _get_db_connection()
-    cur = conn.cursor()
+    return _request_device_readings_metric(device_uuid, 'min', VALUE_QUERY)
 
-    try:
-        # Validate the request args
-        data = DeviceReadingValueInputSchema().load(request.args)
-    except ValidationError as err:
-        return err.messages, 400
 
-    # Construct the query
-    query = 'select * from readings where device_uuid = ? and type = ?'
-    if data['start']:
-        query += ' and date_created >= ?'
-    if data['end']:
-        query += ' and date_created < ?'
-    query += ' order by value, date_created limit 1'
+@app.route('/devices/<string:device_uuid>/readings/max/', methods=['GET'])
+@_conditional
+def request_device_readings_max(device_uuid):
+    """
+    This endpoint allows clients to GET the max sensor reading for a device.
 
-    params = tuple(p for p in (device_uuid, data['type'], data['start'], data['end']) if p)
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
 
-    # Execute the query
-    cur.execute(query, params)
-    row = cur.fetchone()
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    """
 
-    # Return the JSON
-    return jsonify(dict(zip(['device_uuid', 'type', 'value', 'date_created'], row))), 200
+    return _request_device_readings_metric(device_uuid, 'max', VALUE_QUERY)
 
 
-@app.route('/devices/<string:device_uuid>/readings/max/', methods=['GET'])
-def request_device_readings_max(device_uuid):
+@app.route('/devices/<string:device_uuid>/readings/median/', methods=['GET'])
+@_conditional
+def request_device_readings_median(device_uuid):
     """
-    This endpoint allows clients to GET the max sensor reading for a device.
+    This endpoint allows clients to GET the median sensor reading for a device.
 
     Mandatory Query Parameters:
     * type -> The type of sensor value a client is looking for
@@ -134,37 +302,31 @@ def request_device_readings_max(device_uuid):
     * end -> The epoch end time for a sensor being created
     """
 
-    conn = _get_db_connection()
-    cur = conn.cursor()
+    return _request_device_readings_metric(device_uuid, 'median', VALUE_QUERY)
 
-    try:
-        # Validate the request args
-        data = DeviceReadingValueInputSchema().load(request.args)
-    except ValidationError as err:
-        return err.messages, 400
 
-    # Construct the query
-    query = 'select * from readings where device_uuid = ? and type = ?'
-    if data['start']:
-        query += ' and date_created >= ?'
-    if data['end']:
-        query += ' and date_created < ?'
-    query += ' order by value desc, date_created limit 1'
+@app.route('/devices/<string:device_uuid>/readings/mean/', methods=['GET'])
+@_conditional
+def request_device_readings_mean(device_uuid):
+    """
+    This endpoint allows clients to GET the mean sensor readings for a device.
 
-    params = tuple(p for p in (device_uuid, data['type'], data['start'], data['end']) if p)
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
 
-    # Execute the query
-    cur.execute(query, params)
-    row = cur.fetchone()
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    """
 
-    # Return the JSON
-    return jsonify(dict(zip(['device_uuid', 'type', 'value', 'date_created'], row))), 200
+    return _request_device_readings_metric(device_uuid, 'mean', VALUE_QUERY)
 
 
-@app.route('/devices/<string:device_uuid>/readings/median/', methods=['GET'])
-def request_device_readings_median(device_uuid):
+@app.route('/devices/<string:device_uuid>/readings/mode/', methods=['GET'])
+@_conditional
+def request_device_readings_mode(device_uuid):
     """
-    This endpoint allows clients to GET the median sensor reading for a device.
+    This endpoint allows clients to GET the mode sensor reading value for a device.
 
     Mandatory Query Parameters:
     * type -> The type of sensor value a client is looking for
@@ -174,43 +336,67 @@ def request_device_readings_median(device_uuid):
     * end -> The epoch end time for a sensor being created
     """
 
-    conn = _get_db_connection()
-    cur = conn.cursor()
+    return _request_device_readings_metric(device_uuid, 'mode', VALUE_QUERY)
+
+
+@app.route('/devices/<string:device_uuid>/readings/quartiles/', methods=['GET'])
+@_conditional
+def request_device_readings_quartiles(device_uuid):
+    """
+    This endpoint allows clients to GET the 1st and 3rd quartile
+    sensor reading value for a device.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    """
+
+    return _request_device_readings_metric(device_uuid, 'quartiles', QUARTILES_QUERY)
+
+
+@app.route('/devices/<string:device_uuid>/readings/percentile/', methods=['GET'])
+@_conditional
+def request_device_readings_percentile(device_uuid):
+    """
+    This endpoint allows clients to GET an arbitrary percentile of the
+    sensor reading values for a device, using the nearest-rank method.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+    * p -> The percentile to return, between 0 and 100
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    """
+
+    conn = _get_db_connection(device_uuid)
 
     try:
         # Validate the request args
-        data = DeviceReadingValueInputSchema().load(request.args)
+        with timed('validation'):
+            data = PERCENTILE_QUERY.load(request.args)
     except ValidationError as err:
         return err.messages, 400
 
-    # Construct the query
-    # The below query is a little convoluted - depending on the number of
-    # records I might decide just to do this in python rathen than in the
-    # SQL query
-    # I demonstrate how to do it in python earlier in the git commit history
-    where_query = 'where device_uuid = ? and type = ?'
-    if data['start']:
-        where_query += ' and date_created >= ?'
-    if data['end']:
-        where_query += ' and date_created < ?'
-
-    query = f'select * from readings {where_query}'
-    query += f' order by value, date_created limit 1 offset (select count(*) / 2 from readings {where_query})'
-
-    params = 2 * tuple(p for p in (device_uuid, data['type'], data['start'], data['end']) if p)
-
-    # Execute the query
-    cur.execute(query, params)
-    row = cur.fetchone()
+    with timed('materialization'):
+        histogram = value_histogram(conn, device_uuid, data['type'], data['start'], data['end'])
+        if not histogram:
+            return 'no readings found', 404
+        value = histogram.percentile(data['p'])
 
     # Return the JSON
-    return jsonify(dict(zip(['device_uuid', 'type', 'value', 'date_created'], row))), 200
+    with timed('serialization'):
+        return jsonify(dict(value=value)), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/mean/', methods=['GET'])
-def request_device_readings_mean(device_uuid):
+@app.route('/devices/<string:device_uuid>/readings/stats/', methods=['GET'])
+@_conditional
+def request_device_readings_stats(device_uuid):
     """
-    This endpoint allows clients to GET the mean sensor readings for a device.
+    This endpoint allows clients to GET every metric for a device in one
+    request, computed together from the same rollups and histograms.
 
     Mandatory Query Parameters:
     * type -> The type of sensor value a client is looking for
@@ -218,38 +404,118 @@ def request_device_readings_mean(device_uuid):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * metrics -> Comma separated subset of min, max, median, mean, mode
+        and quartiles to compute. Defaults to all of them.
     """
 
-    conn = _get_db_connection()
-    cur = conn.cursor()
-
     try:
         # Validate the request args
-        data = DeviceReadingValueInputSchema().load(request.args)
+        with timed('validation'):
+            data = DeviceReadingStatsInputSchema().load(request.args)
     except ValidationError as err:
         return err.messages, 400
 
-    # Construct the query
-    query = 'select avg(value) as mean_value from readings where device_uuid = ? and type = ?'
-    if data['start']:
-        query += ' and date_created >= ?'
-    if data['end']:
-        query += ' and date_created < ?'
+    results = _compute_metrics(device_uuid, data, data['metrics'])
+    if results is None:
+        return 'no readings found', 404
+
+    # Return the JSON
+    with timed('serialization'):
+        return jsonify(results), 200
+
+
+def _compute_metrics(device_uuid, data, metrics):
+    cache = _get_metric_cache()
+    if cache is None:
+        with timed('materialization'):
+            return compute_stats(_get_db_connection(device_uuid), device_uuid, data['type'], data['start'], data['end'],
+                                 metrics)
+
+    # Serve what we can from the cache and compute the rest together. Results
+    # cached at an earlier version of the device are only served when the
+    # writes since, by whichever process or tool, missed their window
+    version = _get_device_version(device_uuid)
+    version = 0 if version is None else version[0]
+    written = {}
+
+    def written_after(since):
+        if since not in written:
+            written[since] = written_since(_get_db_connection(device_uuid), device_uuid, data['type'], since)
+        return written[since]
+
+    keys = {metric: (device_uuid, data['type'], data['start'], data['end'], metric) for metric in metrics}
+    results = {}
+    for metric, key in keys.items():
+        value = cache.get(key, version, written_after)
+        if value is not MISSING:
+            results[metric] = value
+
+    missing = [metric for metric in metrics if metric not in results]
+    if missing:
+        token = cache.token()
+        with timed('materialization'):
+            computed = compute_stats(_get_db_connection(device_uuid), device_uuid, data['type'], data['start'],
+                                     data['end'], missing)
+        for metric in missing:
+            # Windows without readings are cached as None
+            results[metric] = None if computed is None else computed[metric]
+            cache.put(keys[metric], results[metric], token, version)
+
+    if any(value is None for value in results.values()):
+        return None
+    return results
+
+
+@app.route('/devices/<string:device_uuid>/readings/series/', methods=['GET'])
+@_conditional
+def request_device_readings_series(device_uuid):
+    """
+    This endpoint allows clients to GET a device's readings of one type
+    downsampled for charting, however many readings the window holds.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
 
-    params = tuple(p for p in (device_uuid, data['type'], data['start'], data['end']) if p)
+    Optional Query Parameters
+    * interval -> Width of the buckets in seconds
+    * points -> Number of buckets to split the window in, instead of an
+        interval. Defaults to 300.
+    * method -> buckets, the default, for the count, min, max and mean of
+        every bucket, or lttb for one reading per bucket picked to keep
+        the shape of the series (Largest-Triangle-Three-Buckets)
+    """
 
-    # Execute the query
-    cur.execute(query, params)
-    row = cur.fetchone()
+    conn = _get_db_connection(device_uuid)
+
+    try:
+        # Validate the request args
+        with timed('validation'):
+            data = DeviceReadingSeriesInputSchema().load(request.args)
+    except ValidationError as err:
+        return err.messages, 400
+
+    with timed('materialization'):
+        if data['method'] == 'lttb':
+            points = [dict(date_created=date_created, value=value) for date_created, value in
+                      lttb_series(conn, device_uuid, data['type'], data['start'], data['end'], data['interval'])]
+        else:
+            points = [dict(start=bucket, count=count, min=low, max=high, mean=round(mean, 2))
+                      for bucket, count, low, high, mean in
+                      bucket_series(conn, device_uuid, data['type'], data['start'], data['end'], data['interval'])]
 
     # Return the JSON
-    return jsonify(dict(value=round(row['mean_value']))), 200
+    with timed('serialization'):
+        return jsonify(dict(type=data['type'], method=data['method'], interval=data['interval'], points=points)), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/mode/', methods=['GET'])
-def request_device_readings_mode(device_uuid):
+@app.route('/readings/fleet/stats/', methods=['GET'])
+def request_fleet_stats():
     """
-    This endpoint allows clients to GET the mode sensor reading value for a device.
+    This endpoint allows clients to GET the min, max, mean and percentiles
+    of a sensor type across the whole fleet, or a set of devices. The work
+    is split by device across a pool of worker processes.
 
     Mandatory Query Parameters:
     * type -> The type of sensor value a client is looking for
@@ -257,86 +523,644 @@ def request_device_readings_mode(device_uuid):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * devices -> Comma separated uuids of the devices to include.
+        Defaults to every device.
+    * percentiles -> Comma separated percentiles to compute, using the
+        nearest-rank method. Defaults to 50,95,99.
     """
 
-    conn = _get_db_connection()
-    cur = conn.cursor()
+    try:
+        # Validate the request args
+        with timed('validation'):
+            data = FleetStatsInputSchema().load(request.args)
+    except ValidationError as err:
+        return err.messages, 400
+
+    # Fan out across the shards, with the devices each of them holds
+    if data['devices']:
+        devices = group_by_shard(_get_db_base_path(), app.config['SHARD_COUNT'], data['devices'], key=lambda d: d)
+    shards = []
+    for path in _get_shard_paths():
+        conn = _get_shard_connection(path)
+        if data['devices']:
+            shards.append((conn, path, devices.get(path, [])))
+        else:
+            shards.append((conn, path, list_devices(conn, data['type'], data['start'], data['end'])))
+
+    with timed('materialization'):
+        results = fleet_stats(shards, data['type'], data['start'], data['end'], data['percentiles'],
+                              workers=app.config['FLEET_WORKERS'],
+                              min_parallel=app.config['FLEET_MIN_PARALLEL_DEVICES'])
+    if results is None:
+        return 'no readings found', 404
+
+    # Return the JSON
+    with timed('serialization'):
+        return jsonify(results), 200
+
+
+@app.route('/readings/batch/stats/', methods=['POST'])
+def request_batch_stats():
+    """
+    This endpoint allows clients to POST a query for the metrics of many
+    devices at once, computed with a few queries grouped by device rather
+    than a request per device.
+
+    The body is a JSON object with:
+    * devices -> The uuids of the devices to include
+    * type -> The type of sensor value a client is looking for
+    * start -> Optional, the epoch start time for a sensor being created
+    * end -> Optional, the epoch end time for a sensor being created
+    * metrics -> Optional, a subset of min, max, median, mean, mode and
+        quartiles to compute. Defaults to all of them.
+
+    The response maps every device to its metrics, as returned by
+    /devices/<uuid>/readings/stats/, or to null when it has no readings
+    in the window.
+    """
+
+    try:
+        # Validate the request body
+        with timed('validation'):
+            data = BatchStatsInputSchema().load(request.get_json(force=True, silent=True))
+    except ValidationError as err:
+        return err.messages, 400
+
+    # Each shard answers for the devices it holds
+    devices = group_by_shard(_get_db_base_path(), app.config['SHARD_COUNT'], dict.fromkeys(data['devices']),
+                             key=lambda d: d)
+    results = {}
+    with timed('materialization'):
+        for path, shard_devices in devices.items():
+            results.update(batch_stats(_get_shard_connection(path), shard_devices, data['type'], data['start'],
+                                       data['end'], data['metrics']))
+
+    # Return the JSON
+    with timed('serialization'):
+        return jsonify(results), 200
+
+
+@app.route('/devices/<string:device_uuid>/readings/latest/', methods=['GET'])
+@_conditional
+def request_device_readings_latest(device_uuid):
+    """
+    This endpoint allows clients to GET the latest reading of each sensor
+    type for a device, keyed by type.
+
+    Optional Query Parameters
+    * type -> The type of sensor value a client is looking for
+    """
 
     try:
         # Validate the request args
-        data = DeviceReadingValueInputSchema().load(request.args)
+        with timed('validation'):
+            data = LATEST_QUERY.load(request.args)
     except ValidationError as err:
         return err.messages, 400
 
-    # Construct the query
-    query = 'select value as mode_value from readings where device_uuid = ? and type = ?'
-    if data['start']:
-        query += ' and date_created >= ?'
-    if data['end']:
-        query += ' and date_created < ?'
-    # if 2 different values have the same frequency of occurence, take the smaller number
-    query += 'group by value order by count(*) desc, value limit 1'
+    path = shard_path(_get_db_base_path(), app.config['SHARD_COUNT'], device_uuid)
+    with timed('materialization'):
+        latest = latest_readings(_get_shard_connection(path), device_uuid, data['type'], _get_latest_index(path))
+    if not latest:
+        return 'no readings found', 404
 
-    params = tuple(p for p in (device_uuid, data['type'], data['start'], data['end']) if p)
+    # Return the JSON
+    with timed('serialization'):
+        return jsonify(_latest_dicts(device_uuid, latest)), 200
+
+
+@app.route('/readings/batch/latest/', methods=['POST'])
+def request_batch_latest():
+    """
+    This endpoint allows clients to POST a query for the latest readings of
+    many devices at once.
+
+    The body is a JSON object with:
+    * devices -> The uuids of the devices to include
+    * type -> Optional, the type of sensor value a client is looking for
+
+    The response maps every device to its latest reading of each type, as
+    returned by /devices/<uuid>/readings/latest/, or to null when it has no
+    readings.
+    """
+
+    try:
+        # Validate the request body
+        with timed('validation'):
+            data = BatchLatestInputSchema().load(request.get_json(force=True, silent=True))
+    except ValidationError as err:
+        return err.messages, 400
 
-    # Execute the query
-    cur.execute(query, params)
-    row = cur.fetchone()
+    # Each shard answers for the devices it holds
+    devices = group_by_shard(_get_db_base_path(), app.config['SHARD_COUNT'], dict.fromkeys(data['devices']),
+                             key=lambda d: d)
+    results = {}
+    with timed('materialization'):
+        for path, shard_devices in devices.items():
+            latest = batch_latest_readings(_get_shard_connection(path), shard_devices, data['type'],
+                                           _get_latest_index(path))
+            results.update((device_uuid, _latest_dicts(device_uuid, readings) or None)
+                           for device_uuid, readings in latest.items())
 
     # Return the JSON
-    return jsonify(dict(value=row['mode_value'])), 200
+    with timed('serialization'):
+        return jsonify(results), 200
 
 
-@app.route('/devices/<string:device_uuid>/readings/quartiles/', methods=['GET'])
-def request_device_readings_quartiles(device_uuid):
+def _latest_dicts(device_uuid, latest):
+    return {sensor_type: dict(device_uuid=device_uuid, type=sensor_type, value=value, date_created=date_created)
+            for sensor_type, (value, date_created) in latest.items()}
+
+
+@app.route('/devices/<string:device_uuid>/readings/stream/', methods=['GET'])
+def request_device_readings_stream(device_uuid):
     """
-    This endpoint allows clients to GET the 1st and 3rd quartile
-    sensor reading value for a device.
+    This endpoint allows clients to subscribe to a device's readings as they
+    are written, as server-sent events. Each event is a reading dict with
+    an id to resume from, sent back in the Last-Event-ID header.
 
-    Mandatory Query Parameters:
+    Optional Query Parameters
+    * type -> The type of sensor value a client is looking for
+    * last_event_id -> The id of the last event received, like the
+        Last-Event-ID header
+    """
+
+    return _stream_subscription(DeviceReadingStreamInputSchema(), device_uuid)
+
+
+@app.route('/readings/stream/', methods=['GET'])
+def request_readings_stream():
+    """
+    This endpoint allows clients to subscribe to the readings of the whole
+    fleet as they are written, as server-sent events like
+    /devices/<uuid>/readings/stream/.
+
+    Optional Query Parameters
     * type -> The type of sensor value a client is looking for
+    * devices -> Comma separated uuids of the devices to include.
+        Defaults to every device.
+    * last_event_id -> The id of the last event received, like the
+        Last-Event-ID header
+    """
+
+    return _stream_subscription(FleetStreamInputSchema())
+
+
+def _stream_subscription(schema, device_uuid=None):
+    try:
+        # Validate the request args
+        with timed('validation'):
+            data = schema.load(request.args)
+    except ValidationError as err:
+        return err.messages, 400
+
+    try:
+        subscription = _get_reading_hub().subscribe(device_uuid, data['type'], data.get('devices'),
+                                                    request.headers.get('Last-Event-ID') or data['last_event_id'])
+    except TooManySubscribers:
+        return 'too many streams', 503, {'Retry-After': str(app.config['INGEST_RETRY_AFTER'])}
+    return Response(stream_with_context(sse_chunks(subscription, app.config['STREAM_HEARTBEAT'])),
+                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/readings/export/', methods=['GET'])
+def request_readings_export():
+    """
+    This endpoint allows clients to GET the readings of every device, for
+    bulk export. The readings are streamed in the binary format of
+    columnar.py, or as NDJSON when the client only accepts
+    application/x-ndjson.
+
+    Optional Query Parameters:
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * type -> The type of sensor value a client is looking for
     """
 
-    conn = _get_db_connection()
-    cur = conn.cursor()
-
     try:
         # Validate the request args
-        data = DeviceReadingQuartilesInputSchema().load(request.args)
+        with timed('validation'):
+            data = EXPORT_QUERY.load(request.args)
     except ValidationError as err:
         return err.messages, 400
 
-    # Construct the query
-    query = 'select value from readings where device_uuid = ? and type = ? and date_created >= ? and date_created < ?'
-    params = (device_uuid, data['type'], data['start'], data['end'])
+    # Export one shard after the other
+    rows = chain.from_iterable(iter_fleet_readings(_get_shard_connection(path), data['type'], data['start'], data['end'])
+                               for path in _get_shard_paths())
+
+    return _stream_readings(rows, {}, [columnar.MIMETYPE, 'application/x-ndjson'])
+
+
+def _stream_readings(rows, headers, mimetypes):
+    # Pick the format the client prefers out of the ones we offer, the first
+    # of them being the default
+    mimetype = request.accept_mimetypes.best_match(mimetypes) or mimetypes[0]
+
+    # The rows are built as the chunks are encoded, so each is timed as its
+    # own phase while the response streams
+    rows = timed_iter('materialization', rows)
+    if mimetype == columnar.MIMETYPE:
+        chunks = columnar.encode_batches(batched(rows, 4096))
+    elif mimetype == 'application/x-ndjson':
+        chunks = ndjson_chunks(rows)
+    else:
+        chunks = json_chunks(rows)
+
+    return Response(stream_with_context(timed_iter('serialization', chunks)), 200, headers, mimetype=mimetype)
 
-    # Execute the query
-    cur.execute(query, params)
-    rows = cur.fetchall()
 
-    # Should also be possible to calculate the first and third quartiles
-    # with a complicated SQL query, but this is simpler
-    values = sorted([r['value'] for r in rows])
-    mid = len(values) // 2
+def _request_device_readings_metric(device_uuid, metric, schema):
+    try:
+        # Validate the request args
+        with timed('validation'):
+            data = schema.load(request.args)
+    except ValidationError as err:
+        return err.messages, 400
 
-    q1 = round(statistics.median(values[:mid]))
-    q3 = round(statistics.median(values[-mid:]))
+    results = _compute_metrics(device_uuid, data, [metric])
+    if results is None:
+        return 'no readings found', 404
+
+    # The mean and mode are plain numbers, wrap them up as before
+    result = results[metric]
+    if metric in ('mean', 'mode'):
+        result = dict(value=result)
 
     # Return the JSON
-    return jsonify(dict(quartile_1=q1, quartile_3=q3)), 200
+    with timed('serialization'):
+        return jsonify(result), 200
 
 
-def _get_db_connection():
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
+@app.route('/readings/bulk/', methods=['POST'])
+def request_readings_bulk():
+    """
+    This endpoint allows clients to POST readings for many devices at once.
+
+    The body is a JSON array of readings, or NDJSON when sent with an
+    application/x-ndjson content type. Each reading takes the same
+    parameters as a POST to /devices/<uuid>/readings/ plus:
+    * device_uuid -> The uuid of the device the reading belongs to
+
+    The batch is written in a single transaction. The response reports the
+    number of readings inserted along with the errors for each rejected
+    item, by index.
+    """
+
+    try:
+        items, _ = parse_readings_body(request.data, request.mimetype)
+    except ValueError:
+        return dict(_schema=['Invalid JSON.']), 400
+
+    # Validate the whole batch, it is then written in one transaction
+    with timed('validation'):
+        rows, errors = validate_readings(READING_BULK, items)
+
+    return _write_readings(rows, errors, many=True)
+
+
+def _write_readings(rows, errors, many):
+    # Only reject a batch outright when nothing in it was usable
+    if errors and not rows:
+        return jsonify(dict(inserted=0, errors=errors)), 400
+
+    # Each shard is written on its own, a batch costs one transaction per
+    # shard it touches
+    shards = group_by_shard(_get_db_base_path(), app.config['SHARD_COUNT'], rows)
+
+    writer = _get_writer()
+    if writer is not None:
+        # The writer queues the whole batch at once, and tells every process
+        # about it once it is committed, this one included
+        wait = not app.config['INGEST_QUEUE'] or app.config['INGEST_DURABLE_ACK']
+        try:
+            writer.write(dict(shards), wait)
+        except IngestQueueFull:
+            return 'ingest queue is full', 503, {'Retry-After': str(app.config['INGEST_RETRY_AFTER'])}
+        except TimeoutError:
+            return 'timed out waiting for the readings to be committed', 503
+        except WriterError as err:
+            return 'failed to commit the readings: {}'.format(err), 500
+        except (EOFError, OSError):
+            return 'the writer is unavailable', 503, {'Retry-After': str(app.config['INGEST_RETRY_AFTER'])}
+
+        if not wait:
+            if many:
+                return jsonify(dict(queued=len(rows), errors=errors)), 202
+            return 'accepted', 202
+    elif not app.config['INGEST_QUEUE']:
+        for path, shard_rows in shards.items():
+            versions = insert_readings(_get_shard_connection(path), shard_rows)
+            _readings_committed(path, shard_rows, versions)
+    elif rows:
+        # Queued on every shard at once, or on none of them
+        try:
+            tickets = put_batches({_get_ingest_queue(path): shard_rows for path, shard_rows in shards.items()})
+        except IngestQueueFull:
+            return 'ingest queue is full', 503, {'Retry-After': str(app.config['INGEST_RETRY_AFTER'])}
+
+        if app.config['INGEST_DURABLE_ACK']:
+            try:
+                for ticket in tickets:
+                    ticket.wait(app.config['INGEST_ACK_TIMEOUT'])
+            except TimeoutError:
+                return 'timed out waiting for the readings to be committed', 503
+            except Exception as err:
+                return 'failed to commit the readings: {}'.format(err), 500
+        else:
+            # The readings are queued but not committed yet
+            if many:
+                return jsonify(dict(queued=len(rows), errors=errors)), 202
+            return 'accepted', 202
+
+    if many:
+        return jsonify(dict(inserted=len(rows), errors=errors)), 201
+    return 'success', 201
+
+
+def _get_ingest_queue(path):
+    # There is a queue, and so a writer thread, per shard
+    return get_ingest_queue(path,
+                            maxsize=app.config['INGEST_QUEUE_SIZE'],
+                            batch_size=app.config['INGEST_BATCH_SIZE'],
+                            flush_interval=app.config['INGEST_FLUSH_INTERVAL'],
+                            on_commit=functools.partial(_readings_committed, path))
+
+
+def _readings_committed(path, rows, versions, sequence=None):
+    # Called with the (device_uuid, type, value, date_created) rows of every
+    # committed write to the shard at path, whichever thread committed it,
+    # or whichever process when there is a writer process, and the versions
+    # it left their devices at. sequence numbers the rows for the live
+    # streams (see ReadingHub.publish)
+    if _metric_cache is not None:
+        _metric_cache.invalidate(rows)
+    index = _latest_indexes.get(path)
+    if index is not None:
+        index.update(rows, versions)
+    # Nobody is listening until the first stream is opened
+    if _reading_hub is not None:
+        _reading_hub.publish(rows, sequence)
+
+
+@app.route('/cache/', methods=['GET'])
+def request_cache_stats():
+    """
+    This endpoint allows clients to GET the metric cache counters.
+    """
 
-    return conn
+    cache = _get_metric_cache()
+    if cache is None:
+        return jsonify(dict(enabled=False)), 200
+
+    return jsonify(dict(enabled=True, **cache.stats())), 200
+
+
+_metric_cache = None
+_reading_hub = None
+_reading_hub_lock = threading.Lock()
+_writer = None
+_writer_lock = threading.Lock()
+# Shard path -> LatestIndex
+_latest_indexes = {}
+_latest_indexes_lock = threading.Lock()
+
+
+def _get_metric_cache():
+    # The cache is off while testing unless it is turned on explicitly
+    enabled = app.config['METRIC_CACHE']
+    if enabled is None:
+        enabled = not app.config['TESTING']
+    if not enabled:
+        return None
+
+    global _metric_cache
+    if _metric_cache is None:
+        _metric_cache = MetricCache(max_entries=app.config['METRIC_CACHE_SIZE'],
+                                    open_ttl=app.config['METRIC_CACHE_OPEN_TTL'])
+    return _metric_cache
+
+
+def _get_latest_index(path):
+    # The index is off while testing unless it is turned on explicitly
+    enabled = app.config['LATEST_INDEX']
+    if enabled is None:
+        enabled = not app.config['TESTING']
+    if not enabled:
+        return None
+
+    with _latest_indexes_lock:
+        if path not in _latest_indexes:
+            conn = _get_pool().acquire(path)
+            try:
+                # Taken in from now on, so nothing committed while it loads is missed
+                _latest_indexes[path] = LatestIndex()
+                _latest_indexes[path].load(conn)
+            except BaseException:
+                _latest_indexes.pop(path, None)
+                raise
+            finally:
+                _get_pool().release(conn, path)
+        return _latest_indexes[path]
+
+
+def warm_latest_indexes():
+    """
+    Load the latest reading index of every shard, so the first requests
+    for latest readings do not have to.
+    """
+    for path in _get_shard_paths():
+        _get_latest_index(path)
+
+
+def close_streams():
+    """
+    End every live stream, so a server draining its requests is not held
+    up by them. Clients reconnect elsewhere and resume.
+    """
+    if _reading_hub is not None:
+        _reading_hub.close()
+
+
+def _get_reading_hub():
+    global _reading_hub
+    with _reading_hub_lock:
+        if _reading_hub is None:
+            _reading_hub = ReadingHub(buffer_size=app.config['STREAM_BUFFER_SIZE'],
+                                      history=app.config['STREAM_HISTORY'],
+                                      epoch=app.config['STREAM_EPOCH'],
+                                      max_subscribers=app.config['STREAM_MAX_SUBSCRIBERS'])
+        return _reading_hub
+
+
+def follow_writer():
+    """
+    Start taking in the commits of the writer process, so the live streams
+    of this process see every write, whichever process it came in on, the
+    metric cache drops the entries they fall into and the latest indexes
+    take them in. The hub is started up front, so its event ids keep in
+    step with the writer's from the first commit.
+    """
+    _get_reading_hub()
+    return _get_writer().follow(_readings_committed)
+
+
+def _get_writer():
+    global _writer
+    if app.config['WRITER_ADDRESS'] is None:
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriterClient(app.config['WRITER_ADDRESS'], app.config['WRITER_AUTHKEY'])
+        return _writer
+
+
+@app.route('/db/pool/', methods=['GET'])
+def request_db_pool_stats():
+    """
+    This endpoint allows clients to GET the connection pool counters, to
+    check how often requests reuse a pooled connection.
+    """
+
+    return jsonify(_get_pool().stats()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def request_metrics():
+    """
+    This endpoint allows clients to GET the request timings, slow queries,
+    metric cache and connection pool counters in the Prometheus text format.
+    """
+
+    lines = _request_seconds.render() + _phase_seconds.render()
+
+    slow_queries = instrumentation.get_slow_queries()
+    if slow_queries is not None:
+        lines += slow_queries.render()
+
+    cache = _get_metric_cache()
+    if cache is not None:
+        stats = cache.stats()
+        lines += render_samples('canary_metric_cache_entries', 'gauge', 'Results held by the metric cache',
+                                [([], stats.pop('entries'))])
+        lines += render_samples('canary_metric_cache_total', 'counter', 'Metric cache events',
+                                [([('event', name)], value) for name, value in sorted(stats.items())])
+
+    if _reading_hub is not None:
+        stats = _reading_hub.stats()
+        lines += render_samples('canary_stream_subscribers', 'gauge', 'Live reading streams open',
+                                [([], stats['subscribers'])])
+        lines += render_samples('canary_stream_events_total', 'counter', 'Live reading stream events',
+                                [([('event', 'published')], stats['published']),
+                                 ([('event', 'evicted')], stats['evictions'])])
+
+    stats = _get_pool().stats()
+    lines += render_samples('canary_db_pool_connections', 'gauge', 'Connections opened by the pool',
+                            [([('state', state)], stats[state]) for state in ('open', 'idle')])
+    lines += render_samples('canary_db_pool_acquires_total', 'counter', 'Connections checked out of the pool',
+                            [([('result', 'hit')], stats['hits']), ([('result', 'miss')], stats['misses'])])
+
+    return Response('\n'.join(lines) + '\n', 200, mimetype='text/plain; version=0.0.4')
+
+
+# Request durations, and how long each phase of them took
+_request_seconds = TimingHistogram('canary_request_duration_seconds', 'Time taken to serve requests',
+                                   ('route', 'method', 'metric', 'type', 'status'))
+_phase_seconds = TimingHistogram('canary_request_phase_seconds', 'Time requests spent in each phase',
+                                 ('route', 'metric', 'type', 'phase'))
+
+
+@app.before_request
+def _start_request_timer():
+    if not app.config['INSTRUMENTATION']:
+        return
+
+    # Labelled with the route rather than the path, the metric the endpoint
+    # computes, and the sensor type when it is a known one, so the number of
+    # series stays bounded
+    prefix = 'request_device_readings_'
+    endpoint = request.endpoint or ''
+    sensor_type = request.args.get('type')
+    g.request_timer = instrumentation.start_request(dict(
+        route=request.url_rule.rule if request.url_rule else '',
+        method=request.method,
+        metric=endpoint[len(prefix):] if endpoint.startswith(prefix) else '',
+        type=sensor_type if sensor_type in SENSOR_TYPES else '',
+    ))
+
+
+@app.after_request
+def _record_request_status(response):
+    timer = g.get('request_timer')
+    if timer is not None:
+        timer.labels['status'] = str(response.status_code)
+    return response
+
+
+@app.teardown_request
+def _observe_request_timer(exception):
+    # Streamed responses are torn down once the last chunk has been sent
+    timer = g.pop('request_timer', None)
+    if timer is None:
+        return
+
+    instrumentation.finish_request(timer)
+    labels = timer.labels
+    _request_seconds.observe((labels['route'], labels['method'], labels['metric'], labels['type'],
+                              labels.get('status', '500')), time.perf_counter() - timer.started)
+    for phase, seconds in timer.totals.items():
+        _phase_seconds.observe((labels['route'], labels['metric'], labels['type'], phase), seconds)
+
+
+def _get_db_connection(device_uuid):
+    # A device's readings all live in one shard, so per-device requests
+    # only ever touch that one
+    return _get_shard_connection(shard_path(_get_db_base_path(), app.config['SHARD_COUNT'], device_uuid))
+
+
+def _get_shard_connection(path):
+    # A connection is checked out of the pool once per app context and
+    # given back to it on teardown
+    connections = g.setdefault('db_connections', {})
+    if path not in connections:
+        connections[path] = _get_pool().acquire(path)
+
+    return connections[path]
+
+
+def _get_shard_paths():
+    return shard_paths(_get_db_base_path(), app.config['SHARD_COUNT'])
+
+
+@app.teardown_appcontext
+def _release_db_connections(exception):
+    for path, conn in g.pop('db_connections', {}).items():
+        _get_pool().release(conn, path)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    # Under the lock, two requests racing for the first connection would
+    # each build a pool and one of them would never be closed
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(pragmas=app.config['SQLITE_PRAGMAS'],
+                                   cached_statements=app.config['SQLITE_CACHED_STATEMENTS'],
+                                   max_idle=app.config['SQLITE_POOL_MAX_IDLE'],
+                                   factory=InstrumentedConnection if app.config['INSTRUMENTATION'] else Connection)
+            instrumentation.configure(app.config['SLOW_QUERY_THRESHOLD'] if app.config['INSTRUMENTATION'] else None,
+                                      app.config['SLOW_QUERY_EXPLAIN_INTERVAL'])
+        return _pool
+
+
+def _get_db_base_path():
+    # Set the db that we want
+    if app.config['TESTING']:
+        return 'test_database.db'
+    return app.config['DATABASE']
 
 
 if __name__ == '__main__':
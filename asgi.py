@@ -0,0 +1,277 @@
+"""
+ASGI entry point, served with any ASGI server, e.g.
+
+    uvicorn asgi:application
+
+Connections live on the event loop, which reads request bodies and writes
+responses however slowly the devices send and receive them. Only a request
+whose body has fully arrived is handed to the Flask app in app.py, on a
+bounded pool of ASGI_WORKERS threads, so the routes, the schemas and the
+SQLite work are exactly the ones the WSGI server runs. Once
+ASGI_MAX_PENDING requests are queued for or running on the pool, new ones
+get a 503.
+
+Responses are written back on the loop too. A body of known length is
+built in full on the thread, which is then free before the client has read
+any of it. A streamed body goes through a bounded queue: the thread only
+waits when the client has fallen that far behind, and gives up on it after
+ASGI_SEND_TIMEOUT seconds or once it disconnects.
+
+A live stream (text/event-stream) holds its thread for as long as it is
+open, so at most ASGI_MAX_STREAMS are served at once, fewer than the
+threads, and the others get a 503. On shutdown the streams are ended first,
+so the requests left can finish.
+"""
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from app import app, close_streams, warm_latest_indexes
+
+
+class ExecutorApp(object):
+    """
+    Serve a WSGI app over ASGI, running it on a bounded thread pool.
+    """
+
+    def __init__(self, wsgi_app, max_workers, max_pending, retry_after=1, max_body_size=None, send_timeout=30,
+                 send_buffer=16, max_streams=None, on_startup=None, on_shutdown=None):
+        if max_streams is None:
+            max_streams = max_workers // 2
+        if max_streams >= max_workers:
+            raise ValueError('max_streams must leave some of the {} workers to other requests'.format(max_workers))
+
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.max_body_size = max_body_size
+        # A streamed response is abandoned when the client has not taken any
+        # of send_buffer queued chunks for send_timeout seconds
+        self.send_timeout = send_timeout
+        self.send_buffer = send_buffer
+        self.max_streams = max_streams
+        # Called on a thread when the server starts, before it takes
+        # requests, and when it stops, before the requests left are waited on
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.pending = 0
+        self._stream_slots = threading.BoundedSemaphore(max_streams)
+        self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        # Read the whole body here on the loop, however slowly it arrives
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+            body += message.get('body', b'')
+            if self.max_body_size is not None and len(body) > self.max_body_size:
+                return await _send_response(send, 413, [], b'request body is too large')
+            if not message.get('more_body'):
+                break
+
+        if self.pending >= self.max_pending:
+            return await _send_response(send, 503, [(b'retry-after', str(self.retry_after).encode())],
+                                        b'server is busy')
+
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue(max(self.send_buffer, 2))
+        gone = threading.Event()
+
+        def put(message):
+            if gone.is_set():
+                raise _Abandoned()
+            future = asyncio.run_coroutine_threadsafe(messages.put(message), loop)
+            try:
+                future.result(self.send_timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise _Abandoned()
+
+        # The whole of a request runs on one thread, as it would under a WSGI
+        # server, so the Flask contexts and the pooled connections of a
+        # streamed response stay with it. The thread is released as soon as
+        # its last chunk is queued, and the loop sends the rest
+        sender = asyncio.ensure_future(_send_messages(send, messages, gone))
+        watcher = asyncio.ensure_future(_watch_disconnect(receive, gone))
+        self.pending += 1
+        try:
+            try:
+                await loop.run_in_executor(self._get_executor(), _respond, self.wsgi_app,
+                                           _environ(scope, bytes(body)), put, self._stream_slots, self.retry_after)
+            finally:
+                self.pending -= 1
+            await sender
+        except _Abandoned:
+            # Returning before the response is complete closes the connection
+            return
+        finally:
+            sender.cancel()
+            watcher.cancel()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.on_startup is not None:
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(None, self.on_startup)
+                    except Exception as err:
+                        # The server reports it and exits, rather than
+                        # serving without whatever failed to start
+                        await send({'type': 'lifespan.startup.failed', 'message': str(err)})
+                        return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # End the live streams, which would never finish, then let
+                # the requests still running finish
+                if self.on_shutdown is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, self.on_shutdown)
+                if self._executor is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+                    self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='asgi')
+        return self._executor
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+
+    return environ
+
+
+class _Abandoned(Exception):
+    """
+    Raised on the worker thread when the client of a streamed response has
+    gone away or stopped reading.
+    """
+
+
+def _respond(wsgi_app, environ, put, stream_slots, retry_after):
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started.append({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        return write
+
+    def write(chunk):
+        if started:
+            put(started.pop())
+        if chunk:
+            put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    chunks = wsgi_app(environ, start_response)
+    stream = started and (b'content-type', b'text/event-stream') in (
+        (name, value.split(b';', 1)[0]) for name, value in started[0]['headers'])
+    if stream and not stream_slots.acquire(blocking=False):
+        # Every stream slot is taken: close this one, which ends its
+        # subscription, and turn it away
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        put({'type': 'http.response.start', 'status': 503,
+             'headers': [(b'retry-after', str(retry_after).encode()), (b'content-type', b'text/plain; charset=utf-8')]})
+        put({'type': 'http.response.body', 'body': b'too many streams'})
+        return
+
+    try:
+        if started and any(name == b'content-length' for name, _ in started[0]['headers']):
+            # Not a stream: build the whole body here, so the queue never
+            # fills and the thread never waits on the client
+            body = b''.join(chunks)
+            put(started.pop())
+            put({'type': 'http.response.body', 'body': body})
+            return
+
+        for chunk in chunks:
+            write(chunk)
+        write(b'')
+        put({'type': 'http.response.body', 'body': b''})
+    finally:
+        # Closing the response releases its pooled connections
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if stream:
+            stream_slots.release()
+
+
+async def _send_messages(send, messages, gone):
+    # Send the queued messages until the last chunk of the body. Once the
+    # client is gone the rest are taken and dropped, so the thread never
+    # waits on a full queue for it
+    while True:
+        message = await messages.get()
+        if not gone.is_set():
+            try:
+                await send(message)
+            except OSError:
+                gone.set()
+        if message['type'] == 'http.response.body' and not message.get('more_body'):
+            return
+
+
+async def _watch_disconnect(receive, gone):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    gone.set()
+
+
+async def _send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers + [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+application = ExecutorApp(app,
+                          max_workers=app.config['ASGI_WORKERS'],
+                          max_pending=app.config['ASGI_MAX_PENDING'],
+                          retry_after=app.config['INGEST_RETRY_AFTER'],
+                          max_body_size=app.config['MAX_CONTENT_LENGTH'],
+                          send_timeout=app.config['ASGI_SEND_TIMEOUT'],
+                          max_streams=app.config['ASGI_MAX_STREAMS'],
+                          on_startup=warm_latest_indexes,
+                          on_shutdown=close_streams)
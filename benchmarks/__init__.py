@@ -0,0 +1,18 @@
+"""
+Load generation and latency benchmarks, run from the repository root:
+
+    python -m benchmarks generate --db bench.db --devices 1000 --readings 1000
+    python -m benchmarks mix --db bench.db --count 20000 --out mix.jsonl
+    python -m benchmarks replay --db bench.db --mix mix.jsonl --out results.json
+    python -m benchmarks serve --db bench.db --mix mix.jsonl --workers 1,2,4
+    python -m benchmarks validate --count 10000
+
+generate writes a synthetic fleet straight into SQLite, mix writes a request
+mix against it in the JSON-lines format of requests.jsonl (record captures
+one from live traffic instead), and replay runs a mix against the app and
+reports throughput, latency percentiles and the SQLite work done per
+endpoint as JSON. serve replays the GETs of a mix against serve.py with
+each number of reader processes, while its POSTs are sent alongside.
+validate times parsing and validating a batch of readings with marshmallow
+and with the precompiled loaders of schemas.py.
+"""
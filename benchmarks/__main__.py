@@ -0,0 +1,111 @@
+import argparse
+import json
+import sys
+from app import app
+from benchmarks.generate import default_end, device_uuids, generate_fleet
+from benchmarks.mix import DEFAULT_WEIGHTS, RecordingMiddleware, load_mix, make_mix, save_mix
+from benchmarks.replay import replay
+from benchmarks.serving import benchmark_serving
+from benchmarks.validation import benchmark_validation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Load generation and latency benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='Write a synthetic fleet into SQLite')
+    generate.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    _fleet_arguments(generate)
+    generate.add_argument('--shards', type=int, default=1, help='Number of shards (default: %(default)s)')
+    generate.add_argument('--type-mix', default='temperature=0.5,humidity=0.5',
+                          help='Share of the readings of each type (default: %(default)s)')
+    generate.add_argument('--batch-size', type=int, default=10000, help='Readings per transaction (default: %(default)s)')
+
+    mix = commands.add_parser('mix', help='Write a request mix against a generated fleet')
+    _fleet_arguments(mix)
+    mix.add_argument('--count', type=int, default=10000, help='Number of requests (default: %(default)s)')
+    mix.add_argument('--weights', default=','.join('{}={}'.format(k, v) for k, v in DEFAULT_WEIGHTS.items()),
+                     help='Relative weight of each kind of request (default: %(default)s)')
+    mix.add_argument('--out', required=True, help='Mix file to write')
+
+    record = commands.add_parser('record', help='Serve the app and record the requests it gets')
+    record.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    record.add_argument('--shards', type=int, default=1, help='Number of shards (default: %(default)s)')
+    record.add_argument('--port', type=int, default=5000, help='Port to serve on (default: %(default)s)')
+    record.add_argument('--out', required=True, help='Mix file to append the requests to')
+
+    replay_parser = commands.add_parser('replay', help='Replay a request mix and report the latencies')
+    replay_parser.add_argument('--mix', required=True, help='Mix file to replay')
+    replay_parser.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    replay_parser.add_argument('--shards', type=int, default=1, help='Number of shards (default: %(default)s)')
+    replay_parser.add_argument('--url', help='Replay against the server at this URL rather than in process')
+    replay_parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight (default: %(default)s)')
+    replay_parser.add_argument('--no-work', dest='work', action='store_false',
+                               help='Skip the second run counting the SQLite work per endpoint')
+    replay_parser.add_argument('--no-cache', dest='cache', action='store_false', help='Turn the metric cache off')
+    replay_parser.add_argument('--out', help='File to write the JSON report to (default: stdout)')
+
+    serving = commands.add_parser('serve', help='Replay a request mix against serve.py with more and more readers')
+    serving.add_argument('--mix', required=True, help='Mix file to replay')
+    serving.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    serving.add_argument('--shards', type=int, default=1, help='Number of shards (default: %(default)s)')
+    serving.add_argument('--workers', default='1,2,4', help='Reader process counts to run with (default: %(default)s)')
+    serving.add_argument('--concurrency', type=int, default=16, help='GETs in flight (default: %(default)s)')
+    serving.add_argument('--writers', type=int, default=2, help='Threads sending the POSTs (default: %(default)s)')
+    serving.add_argument('--out', help='File to write the JSON report to (default: stdout)')
+
+    validate = commands.add_parser('validate', help='Compare marshmallow and precompiled validation of a batch')
+    validate.add_argument('--count', type=int, default=10000, help='Readings in the batch (default: %(default)s)')
+    validate.add_argument('--repeat', type=int, default=5, help='Runs to take the best of (default: %(default)s)')
+    validate.add_argument('--invalid', type=float, default=0.01,
+                          help='Share of invalid readings in the batch (default: %(default)s)')
+    validate.add_argument('--seed', type=int, default=0, help='Random seed (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        results = generate_fleet(args.db, args.devices, args.readings, _pairs(args.type_mix, float), args.span,
+                                 args.end, args.seed, args.shards, args.batch_size)
+        _write_json(results, None)
+    elif args.command == 'mix':
+        devices = device_uuids(args.devices, args.seed)
+        end = default_end() if args.end is None else args.end
+        requests = make_mix(devices, args.count, args.span, end, weights=_pairs(args.weights, int), seed=args.seed)
+        save_mix(requests, args.out)
+    elif args.command == 'serve':
+        workers = [int(count) for count in args.workers.split(',')]
+        _write_json(benchmark_serving(args.db, args.shards, workers, load_mix(args.mix), args.concurrency,
+                                      args.writers), args.out)
+    elif args.command == 'validate':
+        _write_json(benchmark_validation(args.count, args.repeat, args.invalid, args.seed), None)
+    elif args.command == 'record':
+        app.config.update(DATABASE=args.db, SHARD_COUNT=args.shards)
+        app.wsgi_app = RecordingMiddleware(app.wsgi_app, args.out)
+        app.run(port=args.port, threaded=True)
+    else:
+        app.config.update(DATABASE=args.db, SHARD_COUNT=args.shards, METRIC_CACHE=args.cache)
+        _write_json(replay(load_mix(args.mix), args.url, args.concurrency, args.work), args.out)
+
+
+def _fleet_arguments(parser):
+    parser.add_argument('--devices', type=int, default=100, help='Number of devices (default: %(default)s)')
+    parser.add_argument('--readings', type=int, default=1000, help='Readings per device (default: %(default)s)')
+    parser.add_argument('--span', type=int, default=7 * 86400, help='Seconds the readings cover (default: %(default)s)')
+    parser.add_argument('--end', type=int, help='Epoch the readings end at (default: the last midnight UTC)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: %(default)s)')
+
+
+def _pairs(value, kind):
+    return {name: kind(number) for name, number in (pair.split('=') for pair in value.split(','))}
+
+
+def _write_json(results, path):
+    if path:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
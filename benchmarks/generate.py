@@ -0,0 +1,102 @@
+import heapq
+import random
+import sqlite3
+import sys
+import time
+import uuid
+from db import migrate
+from ingest import insert_readings
+from retrieval import batched
+from shards import group_by_shard, shard_paths
+
+DEFAULT_TYPE_MIX = {'temperature': 0.5, 'humidity': 0.5}
+
+# Where the values of each type wander around: (baseline, spread, step)
+_WALKS = {
+    'temperature': (22, 8, 1.5),
+    'humidity': (50, 20, 3),
+}
+
+
+def default_end():
+    # The last midnight UTC, so a fleet generated on the same day is the same
+    return int(time.time()) // 86400 * 86400
+
+
+def device_uuids(count, seed=0):
+    """
+    Return count device uuids, the same ones for the same seed.
+    """
+    generator = random.Random(seed)
+    return [str(uuid.UUID(int=generator.getrandbits(128), version=4)) for _ in range(count)]
+
+
+def iter_fleet(devices, readings_per_device, type_mix, span, end, seed=0):
+    """
+    Yield (device_uuid, type, value, date_created) rows for every device in
+    date_created order, the way they would arrive from a live fleet.
+
+    Each device reports at a regular interval over [end - span, end), with
+    some jitter, and the values of each type follow a random walk around a
+    baseline, bounded to 0-100.
+    """
+    types = list(type_mix)
+    weights = [type_mix[sensor_type] for sensor_type in types]
+    interval = span / readings_per_device
+
+    def readings(index, device_uuid):
+        generator = random.Random('{}:{}'.format(seed, index))
+        values = {sensor_type: _WALKS.get(sensor_type, (50, 25, 2))[0] + generator.uniform(-5, 5)
+                  for sensor_type in types}
+        offset = generator.uniform(0, interval)
+        for i in range(readings_per_device):
+            sensor_type = generator.choices(types, weights)[0]
+            baseline, spread, step = _WALKS.get(sensor_type, (50, 25, 2))
+            # Drift back towards the baseline so the walk stays in range
+            value = values[sensor_type] + generator.gauss(0, step) + (baseline - values[sensor_type]) / spread
+            values[sensor_type] = value
+            date_created = int(end - span + offset + i * interval + generator.uniform(-interval, interval) / 4)
+            date_created = min(max(date_created, end - span), end - 1)
+            yield date_created, device_uuid, sensor_type, min(max(round(value), 0), 100)
+
+    streams = [readings(index, device_uuid) for index, device_uuid in enumerate(devices)]
+    for date_created, device_uuid, sensor_type, value in heapq.merge(*streams):
+        yield device_uuid, sensor_type, value, date_created
+
+
+def generate_fleet(base_path, devices, readings_per_device, type_mix=None, span=7 * 86400, end=None, seed=0,
+                   shard_count=1, batch_size=10000, log=sys.stderr):
+    """
+    Write a synthetic fleet into the shards of base_path, through the same
+    insert path as the app so the partitions and aggregates are built along
+    the way. The same arguments always give the same readings, end defaults
+    to the last midnight UTC.
+
+    Returns the parameters the fleet was generated with, along with how
+    many readings were written and how fast.
+    """
+    type_mix = type_mix or DEFAULT_TYPE_MIX
+    end = default_end() if end is None else end
+
+    conns = {}
+    for path in shard_paths(base_path, shard_count):
+        conns[path] = sqlite3.connect(path)
+        migrate(conns[path])
+
+    written = 0
+    started = time.monotonic()
+    rows = iter_fleet(device_uuids(devices, seed), readings_per_device, type_mix, span, end, seed)
+    for batch in batched(rows, batch_size):
+        for path, shard_rows in group_by_shard(base_path, shard_count, batch).items():
+            insert_readings(conns[path], shard_rows)
+
+        written += len(batch)
+        print('{} readings written ({:.0f}/s)'.format(written, written / (time.monotonic() - started)), file=log)
+
+    for conn in conns.values():
+        conn.close()
+
+    seconds = time.monotonic() - started
+    return dict(devices=devices, readings_per_device=readings_per_device, type_mix=type_mix, span=span, end=end,
+                seed=seed, shards=shard_count, readings=written, seconds=round(seconds, 3),
+                readings_per_second=round(written / seconds) if seconds else None)
@@ -0,0 +1,129 @@
+import io
+import json
+import random
+import threading
+from urllib.parse import urlencode
+
+# How often each kind of request shows up in a generated mix
+DEFAULT_WEIGHTS = {
+    'readings': 15,
+    'readings_page': 10,
+    'min': 8,
+    'max': 8,
+    'mean': 8,
+    'median': 6,
+    'mode': 4,
+    'quartiles': 4,
+    'percentile': 6,
+    'stats': 10,
+    'post': 15,
+    'post_batch': 3,
+    'fleet_stats': 1,
+}
+
+# Window lengths metric requests pick from, None for the whole history
+_WINDOWS = [None, 3600, 6 * 3600, 86400, 7 * 86400]
+
+
+def make_mix(devices, count, span, end, types=('temperature', 'humidity'), weights=None, seed=0):
+    """
+    Return count requests over the given devices, picked according to
+    weights, with windows inside [end - span, end). The same arguments
+    always give the same requests.
+
+    Every request is a dict of method, path, query, headers and body, as
+    written to and read from a mix file.
+    """
+    weights = weights or DEFAULT_WEIGHTS
+    generator = random.Random(seed)
+    kinds = list(weights)
+
+    def window():
+        length = generator.choice(_WINDOWS)
+        if length is None or length >= span:
+            return {}
+        start = generator.randrange(end - span, end - length)
+        return dict(start=start, end=start + length)
+
+    def reading():
+        return dict(type=generator.choice(types), value=generator.randint(0, 100),
+                    date_created=end - generator.randrange(0, 3600))
+
+    requests = []
+    for kind in generator.choices(kinds, [weights[kind] for kind in kinds], k=count):
+        device_uuid = generator.choice(devices)
+        path = '/devices/{}/readings/'.format(device_uuid)
+        query = dict(type=generator.choice(types))
+        body = None
+
+        if kind == 'readings':
+            query.update(window())
+        elif kind == 'readings_page':
+            query.update(limit=100, **window())
+        elif kind == 'percentile':
+            path += 'percentile/'
+            query.update(p=generator.choice([50, 90, 95, 99]), **window())
+        elif kind == 'post':
+            query = {}
+            body = json.dumps(reading())
+        elif kind == 'post_batch':
+            query = {}
+            body = json.dumps([reading() for _ in range(100)])
+        elif kind == 'fleet_stats':
+            path = '/readings/fleet/stats/'
+            query.update(window())
+        else:
+            path += kind + '/'
+            query.update(window())
+
+        requests.append(dict(method='POST' if body else 'GET', path=path, query=urlencode(query),
+                             headers={'Content-Type': 'application/json'} if body else {}, body=body))
+
+    return requests
+
+
+def load_mix(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_mix(requests, path):
+    with open(path, 'w') as f:
+        for request in requests:
+            f.write(json.dumps(request, sort_keys=True) + '\n')
+
+
+class RecordingMiddleware(object):
+    """
+    WSGI middleware appending every request the app serves to a mix file,
+    so live traffic can be replayed later.
+    """
+
+    # Request headers kept in the recording
+    HEADERS = ('Content-Type', 'Accept')
+
+    def __init__(self, wsgi_app, path):
+        self.wsgi_app = wsgi_app
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else b''
+
+        headers = {}
+        for name in self.HEADERS:
+            key = 'CONTENT_TYPE' if name == 'Content-Type' else 'HTTP_' + name.upper().replace('-', '_')
+            if environ.get(key):
+                headers[name] = environ[key]
+
+        request = dict(method=environ['REQUEST_METHOD'], path=environ.get('PATH_INFO', ''),
+                       query=environ.get('QUERY_STRING', ''), headers=headers,
+                       body=body.decode('utf-8') if body else None)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(request, sort_keys=True) + '\n')
+
+        # Hand the app a fresh copy of the body we read
+        environ['wsgi.input'] = io.BytesIO(body)
+        return self.wsgi_app(environ, start_response)
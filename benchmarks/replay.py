@@ -0,0 +1,244 @@
+import datetime
+import http.client
+import math
+import os
+import platform
+import sqlite3
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from werkzeug.exceptions import HTTPException
+from app import app, _get_metric_cache, _get_pool
+
+PERCENTILES = (50, 95, 99)
+
+_STMT_QUERY = 'select sql, nstep, nscan from sqlite_stmt'
+
+
+def replay(mix, url=None, concurrency=1, measure_work=True):
+    """
+    Send every request of the mix, from concurrency threads, and report
+    throughput and latency percentiles overall and per endpoint.
+
+    Requests go to the server at url, or straight to the app in this
+    process when there is none. In process, the mix is then replayed a
+    second time on a single thread, with the metric cache cleared, to count
+    the SQL statements each endpoint runs and the work SQLite does for them
+    (see WorkCounter). The latencies come from the first run only, and the
+    POSTs of the mix are written twice.
+
+    Returns a JSON-serialisable report.
+    """
+    send = _http_sender(url) if url else _app_sender()
+    endpoints = _endpoint_namer()
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for request, (status, seconds) in zip(mix, executor.map(send, mix)):
+            endpoint = endpoints(request)
+            latencies[endpoint].append(seconds)
+            statuses[endpoint][status] += 1
+    duration = time.perf_counter() - started
+
+    report = dict(
+        meta=_meta(url, concurrency, len(mix)),
+        total=_summarise([seconds for values in latencies.values() for seconds in values], duration,
+                         sum(statuses.values(), Counter())),
+        endpoints={endpoint: _summarise(latencies[endpoint], duration, statuses[endpoint])
+                   for endpoint in sorted(latencies)},
+    )
+    report['meta']['seconds'] = round(duration, 3)
+
+    if measure_work and not url:
+        for endpoint, work in _measure_work(mix, endpoints).items():
+            report['endpoints'][endpoint].update(work)
+
+    return report
+
+
+class WorkCounter(object):
+    """
+    Count the statements run on the connections checked out of a
+    ConnectionPool, and the work SQLite does for them.
+
+    SQLite does not count the rows a statement reads through an index, so
+    the work is taken from its per-statement counters in sqlite_stmt:
+    vm_steps, the virtual machine instructions run, which grow with every
+    row visited, and full_scan_steps, the rows stepped through by full
+    table scans, which should stay at 0.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.counts = Counter()
+        self._before = {}
+
+    def __enter__(self):
+        # Shadow the pool's methods on the instance only
+        acquire, release = self.pool.acquire, self.pool.release
+
+        def traced_acquire(path):
+            conn = acquire(path)
+            conn.set_trace_callback(self._trace)
+            self._before[id(conn)] = _stmt_counters(conn)
+            return conn
+
+        def traced_release(conn, path):
+            conn.set_trace_callback(None)
+            before = self._before.pop(id(conn), {})
+            for sql, (steps, scans) in _stmt_counters(conn).items():
+                before_steps, before_scans = before.get(sql, (0, 0))
+                self.counts['vm_steps'] += max(steps - before_steps, 0)
+                self.counts['full_scan_steps'] += max(scans - before_scans, 0)
+            release(conn, path)
+
+        self.pool.acquire = traced_acquire
+        self.pool.release = traced_release
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.pool.acquire
+        del self.pool.release
+
+    def take(self):
+        counts, self.counts = self.counts, Counter()
+        return counts
+
+    def _trace(self, statement):
+        # Statements run by triggers are traced as comments
+        if not statement.startswith('--') and statement != _STMT_QUERY:
+            self.counts['statements'] += 1
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of sorted values with the nearest-rank method.
+    """
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def _summarise(latencies, duration, statuses):
+    latencies = sorted(latencies)
+    summary = dict(
+        requests=len(latencies),
+        statuses={str(status): count for status, count in sorted(statuses.items())},
+        throughput=round(len(latencies) / duration, 1) if duration else None,
+        mean_ms=round(sum(latencies) / len(latencies) * 1000, 3),
+        max_ms=round(latencies[-1] * 1000, 3),
+    )
+    for p in PERCENTILES:
+        summary['p{}_ms'.format(p)] = round(percentile(latencies, p) * 1000, 3)
+    return summary
+
+
+def _measure_work(mix, endpoints):
+    cache = _get_metric_cache()
+    if cache is not None:
+        cache.clear()
+
+    send = _app_sender()
+    totals = defaultdict(Counter)
+    requests = Counter()
+    with WorkCounter(_get_pool()) as counter:
+        for request in mix:
+            send(request)
+            endpoint = endpoints(request)
+            totals[endpoint].update(counter.take())
+            requests[endpoint] += 1
+
+    return {endpoint: {'{}_per_request'.format(name): round(totals[endpoint][name] / requests[endpoint], 1)
+                       for name in ['statements', 'vm_steps', 'full_scan_steps']}
+            for endpoint in requests}
+
+
+def _app_sender():
+    local = threading.local()
+
+    def send(request):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+
+        started = time.perf_counter()
+        response = local.client.open(request['path'], method=request['method'], query_string=request['query'],
+                                     headers=request.get('headers') or {}, data=request.get('body'))
+        response.get_data()
+        response.close()
+        return response.status_code, time.perf_counter() - started
+
+    return send
+
+
+def _http_sender(url):
+    parts = urlsplit(url)
+    local = threading.local()
+
+    def send(request):
+        # One keep-alive connection per thread
+        if not hasattr(local, 'conn'):
+            local.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+
+        path = parts.path.rstrip('/') + request['path']
+        if request['query']:
+            path += '?' + request['query']
+        body = request.get('body')
+
+        started = time.perf_counter()
+        try:
+            local.conn.request(request['method'], path, body=body.encode('utf-8') if body else None,
+                               headers=request.get('headers') or {})
+            response = local.conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            local.conn.close()
+            del local.conn
+            status = 0
+        return status, time.perf_counter() - started
+
+    return send
+
+
+def _endpoint_namer():
+    # Group requests by the route that serves them
+    adapter = app.url_map.bind('localhost')
+
+    def name(request):
+        try:
+            rule, _ = adapter.match(request['path'], method=request['method'], return_rule=True)
+        except HTTPException:
+            return '{} (unmatched)'.format(request['method'])
+        return '{} {}'.format(request['method'], rule.rule)
+
+    return name
+
+
+def _meta(url, concurrency, requests):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(
+        commit=commit,
+        started=datetime.datetime.utcnow().isoformat() + 'Z',
+        target=url or 'in-process',
+        concurrency=concurrency,
+        requests=requests,
+        python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version,
+        cpus=os.cpu_count(),
+    )
+
+
+def _stmt_counters(conn):
+    counters = defaultdict(lambda: (0, 0))
+    for sql, steps, scans in conn.execute(_STMT_QUERY):
+        if sql != _STMT_QUERY:
+            counters[sql] = (counters[sql][0] + steps, counters[sql][1] + scans)
+    return counters
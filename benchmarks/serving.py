@@ -0,0 +1,92 @@
+import itertools
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from benchmarks.replay import _http_sender, _meta, _summarise, replay
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def benchmark_serving(db, shards, worker_counts, mix, concurrency=16, writers=2, log=sys.stderr):
+    """
+    Serve the database with serve.py once per entry of worker_counts, that
+    many reader processes, and replay the GETs of the mix against it from
+    concurrency threads while writers threads keep sending its POSTs.
+
+    Reports the read throughput and latencies of each run next to the
+    write latencies and statuses, to show reads scaling with the readers
+    while the writes, all committed by the single writer process, keep
+    their latency and never fail on a locked database.
+    """
+    reads = [request for request in mix if request['method'] == 'GET']
+    writes = [request for request in mix if request['method'] == 'POST']
+
+    runs = []
+    for workers in worker_counts:
+        with tempfile.TemporaryFile('w+') as server_log:
+            process, url = _start_server(db, shards, workers, server_log)
+            try:
+                # Once through every endpoint first, so each reader has its
+                # connections and indexes warm
+                replay(reads[:200], url, concurrency, measure_work=False)
+
+                stopping = threading.Event()
+                latencies = []
+                statuses = Counter()
+
+                def write():
+                    send = _http_sender(url)
+                    for request in itertools.cycle(writes):
+                        if stopping.is_set():
+                            return
+                        status, seconds = send(request)
+                        latencies.append(seconds)
+                        statuses[status] += 1
+
+                threads = [threading.Thread(target=write) for _ in range(writers if writes else 0)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                report = replay(reads, url, concurrency, measure_work=False)
+                stopping.set()
+                for thread in threads:
+                    thread.join()
+                duration = time.perf_counter() - started
+            finally:
+                process.send_signal(signal.SIGTERM)
+                process.wait()
+
+        run = dict(workers=workers, reads=report['total'])
+        if latencies:
+            run['writes'] = _summarise(latencies, duration, statuses)
+        runs.append(run)
+        print('{} readers: {} reads/s, p99 {} ms'.format(workers, run['reads']['throughput'], run['reads']['p99_ms']),
+              file=log)
+
+    meta = _meta('serve.py', concurrency, len(reads))
+    meta.update(writers=writers, shards=shards)
+    return dict(meta=meta, runs=runs)
+
+
+def _start_server(db, shards, workers, server_log):
+    # On a free port, read back from what serve.py prints when it is up
+    process = subprocess.Popen([sys.executable, os.path.join(_ROOT, 'serve.py'), '--workers', str(workers),
+                                '--port', '0', '--db', db, '--shards', str(shards)],
+                               cwd=_ROOT, stdout=server_log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline and process.poll() is None:
+        server_log.seek(0)
+        match = re.search(r'Serving on (http://\S+)', server_log.read())
+        if match:
+            return process, match.group(1)
+        time.sleep(0.1)
+
+    process.kill()
+    server_log.seek(0)
+    raise RuntimeError('serve.py did not start:\n' + server_log.read())
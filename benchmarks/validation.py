@@ -0,0 +1,61 @@
+import json
+import random
+import time
+from marshmallow import ValidationError
+from ingest import parse_readings_body
+from schemas import READING, DeviceReadingSchema
+
+
+def make_batch(count, invalid=0.01, seed=0):
+    """
+    Return a JSON array body of count readings, the given share of them
+    invalid, and a quarter of them without a date_created.
+    """
+    generator = random.Random(seed)
+    items = []
+    for _ in range(count):
+        item = dict(type=generator.choice(['temperature', 'humidity']), value=generator.randint(0, 100))
+        if generator.random() >= 0.25:
+            item['date_created'] = 1700000000 + generator.randrange(86400)
+        if generator.random() < invalid:
+            item['value'] = generator.choice([101, -1, 'high', None])
+        items.append(item)
+    return json.dumps(items).encode()
+
+
+def benchmark_validation(count=10000, repeat=5, invalid=0.01, seed=0):
+    """
+    Time parsing and validating a JSON batch of count readings with
+    DeviceReadingSchema's own load, the way POSTs used to, and with the
+    precompiled FastSchema. Returns the best of repeat runs of each, in
+    readings per second.
+    """
+    body = make_batch(count, invalid, seed)
+
+    def marshmallow_loads():
+        items, _ = parse_readings_body(body, 'application/json')
+        schema = DeviceReadingSchema()
+        results = []
+        for item in items:
+            try:
+                results.append(schema.load(item))
+            except ValidationError as err:
+                results.append(err)
+        return results
+
+    def fast_loads():
+        items, _ = parse_readings_body(body, 'application/json')
+        return READING.load_many(items)
+
+    results = dict(readings=count, invalid=invalid)
+    for name, load in [('marshmallow', marshmallow_loads), ('fast', fast_loads)]:
+        best = min(_time(load) for _ in range(repeat))
+        results['{}_readings_per_second'.format(name)] = round(count / best)
+    results['speedup'] = round(results['fast_readings_per_second'] / results['marshmallow_readings_per_second'], 1)
+    return results
+
+
+def _time(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
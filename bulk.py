@@ -0,0 +1,289 @@
+import argparse
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from db import create_partitions, migrate, partition_start, resume_partitions, suspend_partitions
+from ingest import insert_readings, validate_readings
+from retrieval import COLUMNS, batched, iter_fleet_readings, iter_readings, ndjson_chunks
+from schemas import READING_BULK, SENSOR_TYPES
+from shards import group_by_shard, shard_path, shard_paths
+
+FORMATS = ['csv', 'ndjson']
+
+
+def file_format(path, default=None):
+    """
+    Guess the format of a file from its extension, looking past a .gz.
+    """
+    _, extension = os.path.splitext(path[:-3] if path.endswith('.gz') else path)
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.ndjson', '.jsonl', '.json'):
+        return 'ndjson'
+    if default is None:
+        raise ValueError('Cannot tell the format of {}, give it with --format'.format(path))
+    return default
+
+
+def open_text(path, mode='r'):
+    """
+    Open a file as text, through gzip when it ends in .gz. - stands for
+    stdin or stdout.
+    """
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    # utf-8-sig drops the byte order mark spreadsheets like to put in CSVs
+    encoding = 'utf-8-sig' if mode == 'r' else 'utf-8'
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding=encoding, newline='')
+    return open(path, mode, encoding=encoding, newline='')
+
+
+def read_chunks(path, fmt, chunk_lines=10000):
+    """
+    Yield a file as (fieldnames, first_line, lines) chunks of up to
+    chunk_lines lines, for parse_chunk. fieldnames is the header of a CSV,
+    and None for NDJSON. Quoted CSV fields cannot hold newlines.
+    """
+    f = open_text(path)
+    try:
+        fieldnames = None
+        number = 1
+        if fmt == 'csv':
+            header = f.readline()
+            fieldnames = next(csv.reader([header]), [])
+            number += 1
+
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == chunk_lines:
+                yield fieldnames, number, lines
+                number += len(lines)
+                lines = []
+        if lines:
+            yield fieldnames, number, lines
+    finally:
+        # stdin is left open for whoever reads it next
+        if f is not sys.stdin:
+            f.close()
+
+
+def parse_chunk(fieldnames, first_line, lines):
+    """
+    Parse and validate a chunk of lines with the rules of the bulk readings
+    endpoint. Returns (rows, errors), where rows are (device_uuid, type,
+    value, date_created) tuples ready to insert and errors are
+    (line number, messages) of the rejected lines.
+
+    Lines are NDJSON objects without fieldnames, and CSV records with them.
+    Empty CSV fields count as missing, so an empty date_created is stamped
+    like a reading POSTed without one.
+    """
+    numbers = []
+    items = []
+    errors = []
+    for number, line in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+
+        if fieldnames is None:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None
+        else:
+            values = next(csv.reader([line]))
+            if len(values) != len(fieldnames):
+                errors.append((number, {'_schema': ['Expected {} fields, got {}.'.format(len(fieldnames), len(values))]}))
+                continue
+            item = {name: value for name, value in zip(fieldnames, values) if value != ''}
+
+        numbers.append(number)
+        items.append(item)
+
+    rows, rejected = validate_readings(READING_BULK, items)
+    errors.extend((numbers[index], messages) for index, messages in rejected.items())
+    errors.sort(key=lambda error: error[0])
+    return rows, errors
+
+
+def parse_files(paths, fmt=None, workers=None, chunk_lines=10000):
+    """
+    Yield (path, rows, errors) for every chunk of the files, in file order,
+    as returned by parse_chunk.
+
+    The chunks are parsed by workers processes while the caller writes the
+    previous ones, with at most two chunks per worker in flight so a large
+    file is never read ahead into memory. With workers=0 they are parsed
+    in this process.
+    """
+    chunks = ((path, chunk) for path in paths for chunk in read_chunks(path, fmt or file_format(path), chunk_lines))
+    if workers == 0:
+        for path, chunk in chunks:
+            yield (path, *parse_chunk(*chunk))
+        return
+
+    workers = workers or os.cpu_count()
+    # Spawned rather than forked, like the fleet pool
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        in_flight = deque()
+        for path, chunk in chunks:
+            in_flight.append((path, pool.submit(parse_chunk, *chunk)))
+            if len(in_flight) >= 2 * workers:
+                path, future = in_flight.popleft()
+                yield (path, *future.result())
+        while in_flight:
+            path, future = in_flight.popleft()
+            yield (path, *future.result())
+
+
+def import_readings(base_path, shard_count, paths, fmt=None, workers=None, batch_size=200000, chunk_lines=10000,
+                    log=sys.stderr):
+    """
+    Load the readings of CSV or NDJSON files, gzipped or not, into the
+    shards of base_path. Returns (imported, rejected).
+
+    This is an offline tool: stop the API first. Rejected lines are
+    reported to log and skipped. Each partition written to is suspended
+    while it loads (see suspend_partitions), and the readings go in with
+    one insert_readings per batch_size readings, so a transaction holds
+    hundreds of thousands of them. The partitions are resumed at the end,
+    which rebuilds their aggregates and indexes in bulk. A load that was
+    killed before it got there is resumed when the next one starts.
+    """
+    conns = {}
+    suspended = {}
+    for path in shard_paths(base_path, shard_count):
+        conns[path] = sqlite3.connect(path)
+        migrate(conns[path])
+        resume_partitions(conns[path])
+        suspended[path] = set()
+
+    imported = 0
+    rejected = 0
+    pending = []
+    started = time.monotonic()
+
+    def flush():
+        nonlocal imported
+        for path, rows in group_by_shard(base_path, shard_count, pending).items():
+            dates = {row[3] for row in rows}
+            create_partitions(conns[path], dates)
+            firsts = {partition_start(date_created) for date_created in dates} - suspended[path]
+            if firsts:
+                suspend_partitions(conns[path], sorted(firsts))
+                suspended[path].update(firsts)
+            insert_readings(conns[path], rows)
+
+        imported += len(pending)
+        pending.clear()
+        print('{} readings imported ({:.0f}/s), {} rejected'.format(
+            imported, imported / (time.monotonic() - started), rejected), file=log)
+
+    try:
+        for path, rows, errors in parse_files(paths, fmt, workers, chunk_lines):
+            for number, messages in errors:
+                print('{}:{}: {}'.format(path, number, json.dumps(messages, sort_keys=True)), file=log)
+            rejected += len(errors)
+
+            pending.extend(rows)
+            if len(pending) >= batch_size:
+                flush()
+        if pending:
+            flush()
+    finally:
+        for path, conn in conns.items():
+            if suspended[path]:
+                print('{}: rebuilding {} partitions'.format(path, len(suspended[path])), file=log)
+            resume_partitions(conn)
+            conn.close()
+
+    print('{} readings imported and indexed ({:.0f}/s overall)'.format(
+        imported, imported / (time.monotonic() - started)), file=log)
+    return imported, rejected
+
+
+def export_readings(base_path, shard_count, out, fmt, device_uuid=None, sensor_type=None, start=None, end=None):
+    """
+    Write the readings of one device, in date order, or of the whole fleet,
+    shard by shard in storage order, to the text file out as CSV or NDJSON.
+    Rows are streamed off the cursors, so nothing is held in memory.
+    Returns the number of readings written.
+    """
+    if device_uuid is not None:
+        paths = [shard_path(base_path, shard_count, device_uuid)]
+    else:
+        paths = shard_paths(base_path, shard_count)
+
+    count = 0
+    writer = csv.writer(out, lineterminator='\n') if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(COLUMNS)
+
+    for path in paths:
+        conn = sqlite3.connect(path)
+        if device_uuid is not None:
+            rows = iter_readings(conn, device_uuid, sensor_type, start, end)
+        else:
+            rows = iter_fleet_readings(conn, sensor_type, start, end)
+
+        for batch in batched(rows, 500):
+            if writer is not None:
+                writer.writerows(row[1:] for row in batch)
+            else:
+                out.writelines(ndjson_chunks(batch, len(batch)))
+            count += len(batch)
+        conn.close()
+
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline bulk import and export of readings as CSV or NDJSON.')
+    parser.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    parser.add_argument('--shards', type=int, default=1, help='Number of shards (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importer = commands.add_parser('import', help='Load readings from files, with the API stopped')
+    importer.add_argument('files', nargs='*',
+                          help='CSV or NDJSON files, .gz for gzipped, - for stdin. '
+                               'Without any, finishes a load that was interrupted')
+    importer.add_argument('--format', choices=FORMATS, help='Format of the files (default: from their extension)')
+    importer.add_argument('--workers', type=int, default=os.cpu_count(),
+                          help='Parsing processes, 0 to parse in this one (default: %(default)s)')
+    importer.add_argument('--batch-size', type=int, default=200000, help='Readings per transaction (default: %(default)s)')
+
+    exporter = commands.add_parser('export', help='Dump the readings of a device or of the fleet')
+    exporter.add_argument('--device', help='Device uuid (default: every device)')
+    exporter.add_argument('--type', choices=SENSOR_TYPES, help='Sensor type (default: every type)')
+    exporter.add_argument('--start', type=int, help='Earliest date_created, inclusive')
+    exporter.add_argument('--end', type=int, help='Latest date_created, exclusive')
+    exporter.add_argument('--format', choices=FORMATS, help='Output format (default: from the output extension)')
+    exporter.add_argument('--output', default='-', help='Output file, .gz to gzip it (default: stdout)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'import':
+        imported, rejected = import_readings(args.db, args.shards, args.files, args.format, args.workers,
+                                             args.batch_size)
+        print('Imported {} readings, rejected {}.'.format(imported, rejected))
+    else:
+        fmt = args.format or file_format(args.output, 'ndjson')
+        out = open_text(args.output, 'w')
+        try:
+            count = export_readings(args.db, args.shards, out, fmt, args.device, args.type, args.start, args.end)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print('Exported {} readings.'.format(count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
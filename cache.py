@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+MISSING = object()
+
+
+class MetricCache(object):
+    """
+    Bounded LRU cache of metric results, keyed on
+    (device_uuid, type, start, end, metric).
+
+    A window that closed in the past only changes when a late reading is
+    inserted into it, so those entries are kept until they are evicted or
+    invalidated. Windows that are still open (no end, or an end in the
+    future) are only kept for open_ttl seconds. Every insert must be passed
+    to invalidate, which drops exactly the entries whose (device_uuid, type,
+    window) the new readings fall into.
+
+    A result computed while readings were being inserted may already be out
+    of date, so take a token() before computing it and hand it to put,
+    which drops the result if its series has been invalidated since.
+
+    invalidate only sees the writes of this process. Other processes, the
+    retention and bulk tools and resharding all bump the write version of
+    the devices they change (see db.device_version), so results are also
+    put with the version of their device, read before computing them. get
+    returns one cached at an earlier version only if the dates written
+    since, which it is handed a function to look up (see db.written_since),
+    do not reach its window.
+    """
+
+    def __init__(self, max_entries=10000, open_ttl=5):
+        self.max_entries = max_entries
+        self.open_ttl = open_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # key -> (value, expires, version), expires is None for closed windows
+        self._entries = OrderedDict()
+        # (device_uuid, type) -> keys cached for it
+        self._series = defaultdict(set)
+        # Counts invalidations, (device_uuid, type) -> count at its latest
+        # one. Only the most recent max_entries series are remembered, the
+        # others are assumed invalidated as recently as the newest forgotten.
+        self._clock = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None, written_since=None):
+        """
+        Return the value cached for key at the given device version, or
+        MISSING. An entry cached at an earlier version is still returned,
+        and moved to version, when written_since(its version) gives a
+        (low, high) range of dates written since that misses its window.
+        written_since returns None when it cannot tell.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is not None and entry[2] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        written = None
+        if entry is not None and written_since is not None and _older(entry[2], version):
+            written = written_since(entry[2])
+
+        with self._lock:
+            current = self._entries.get(key)
+            if written is not None and current is entry and not _reaches(key, *written):
+                self._entries[key] = (entry[0], entry[1], version)
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if current is not None and current is entry and _older(entry[2], version):
+                self._remove(key)
+            self.misses += 1
+            return MISSING
+
+    def token(self):
+        with self._lock:
+            return self._clock
+
+    def put(self, key, value, token, version=None):
+        end = key[3]
+        expires = None
+        if end is None or end > time.time():
+            expires = time.monotonic() + self.open_ttl
+
+        with self._lock:
+            # Readings were inserted into the series while value was computed
+            if self._invalidated.get(key[:2], self._forgotten) > token:
+                return
+
+            self._entries[key] = (value, expires, version)
+            self._entries.move_to_end(key)
+            self._series[key[:2]].add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, rows):
+        """
+        Drop the entries the inserted (device_uuid, type, value, date_created)
+        rows fall into.
+        """
+        dates = defaultdict(list)
+        for device_uuid, sensor_type, _, date_created in rows:
+            dates[(device_uuid, sensor_type)].append(date_created)
+
+        with self._lock:
+            self._clock += 1
+            for series, series_dates in dates.items():
+                self._invalidated[series] = self._clock
+                self._invalidated.move_to_end(series)
+
+                for key in list(self._series.get(series, ())):
+                    start, end = key[2], key[3]
+                    if any((start is None or date >= start) and (end is None or date < end) for date in series_dates):
+                        self._remove(key)
+                        self.invalidations += 1
+
+            while len(self._invalidated) > self.max_entries:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._series.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries), hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, invalidations=self.invalidations)
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._series[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self._series[key[:2]]
+
+
+def _older(cached, version):
+    return cached is not None and version is not None and cached < version
+
+
+def _reaches(key, low, high):
+    # Whether dates from low to high may fall in the window of key
+    start, end = key[2], key[3]
+    return low is not None and (start is None or high >= start) and (end is None or low < end)
@@ -0,0 +1,155 @@
+"""
+Compact columnar binary format for readings.
+
+A stream starts with the 4 byte magic b'CNRY' and a version byte, followed
+by blocks of readings. Every block is:
+
+* uint32 -> The number of readings n in the block. 0 ends the stream.
+* The device_uuid and type dictionary entries first seen in this block, as
+  a uint32 count for each followed by every string as a uint32 byte length
+  and its UTF-8 bytes (a uint16 one in version 1 streams). The dictionaries carry over from block to block.
+* n uint32 -> The device_uuid of each reading, as a dictionary index
+* n uint8 -> The type of each reading, as a dictionary index
+* n int64 -> The date_created of each reading
+* n uint8 -> The value of each reading, which is bounded to 0-100
+
+All integers are little-endian. Only the standard library is used, so the
+decoder below can be copied into client code as it is.
+"""
+import struct
+import sys
+from array import array
+
+MIMETYPE = 'application/vnd.canary.columnar'
+
+MAGIC = b'CNRY'
+VERSION = 2
+
+_COUNT = struct.Struct('<I')
+# Byte length of the dictionary strings, by version. Nothing bounds the
+# length of a device_uuid, so it is no longer a uint16
+_LENGTHS = {1: struct.Struct('<H'), 2: _COUNT}
+
+
+def encode_batches(batches):
+    """
+    Encode batches of (rowid, device_uuid, type, value, date_created) rows,
+    yielding one block of bytes per batch. The columns are packed straight
+    from the row tuples without building a dict per reading.
+    """
+    yield MAGIC + bytes([VERSION])
+
+    devices = {}
+    types = {}
+    for rows in batches:
+        if not rows:
+            continue
+
+        new_devices = _extend_dictionary(devices, (row[1] for row in rows))
+        new_types = _extend_dictionary(types, (row[2] for row in rows))
+
+        columns = [
+            array('I', [devices[row[1]] for row in rows]),
+            array('B', [types[row[2]] for row in rows]),
+            array('q', [row[4] for row in rows]),
+            array('B', [row[3] for row in rows]),
+        ]
+
+        block = [_COUNT.pack(len(rows)), _encode_strings(new_devices), _encode_strings(new_types)]
+        block += [_little_endian(column) for column in columns]
+        yield b''.join(block)
+
+    yield _COUNT.pack(0)
+
+
+def decode_columns(stream):
+    """
+    Decode a columnar stream from a binary file-like object, yielding a dict
+    of device_uuid, type, value and date_created lists for every block.
+    """
+    header = stream.read(len(MAGIC) + 1)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a columnar readings stream')
+    if header[len(MAGIC)] not in _LENGTHS:
+        raise ValueError('Unsupported columnar readings version {}'.format(header[len(MAGIC)]))
+    length = _LENGTHS[header[len(MAGIC)]]
+
+    devices = []
+    types = []
+    while True:
+        count, = _COUNT.unpack(_read(stream, _COUNT.size))
+        if not count:
+            return
+
+        devices += _decode_strings(stream, length)
+        types += _decode_strings(stream, length)
+
+        device_ids = _read_array(stream, 'I', count)
+        type_ids = _read_array(stream, 'B', count)
+        dates = _read_array(stream, 'q', count)
+        values = _read_array(stream, 'B', count)
+
+        yield dict(
+            device_uuid=[devices[i] for i in device_ids],
+            type=[types[i] for i in type_ids],
+            value=values.tolist(),
+            date_created=dates.tolist(),
+        )
+
+
+def decode_readings(stream):
+    """
+    Decode a columnar stream from a binary file-like object, yielding a
+    reading dict per reading.
+    """
+    for columns in decode_columns(stream):
+        for device_uuid, sensor_type, value, date_created in zip(
+                columns['device_uuid'], columns['type'], columns['value'], columns['date_created']):
+            yield dict(device_uuid=device_uuid, type=sensor_type, value=value, date_created=date_created)
+
+
+def _extend_dictionary(dictionary, strings):
+    new = []
+    for string in strings:
+        if string not in dictionary:
+            dictionary[string] = len(dictionary)
+            new.append(string)
+    return new
+
+
+def _encode_strings(strings):
+    encoded = [_COUNT.pack(len(strings))]
+    for string in strings:
+        data = string.encode('utf-8')
+        encoded.append(_LENGTHS[VERSION].pack(len(data)) + data)
+    return b''.join(encoded)
+
+
+def _decode_strings(stream, length):
+    count, = _COUNT.unpack(_read(stream, _COUNT.size))
+    strings = []
+    for _ in range(count):
+        size, = length.unpack(_read(stream, length.size))
+        strings.append(_read(stream, size).decode('utf-8'))
+    return strings
+
+
+def _little_endian(column):
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tobytes()
+
+
+def _read_array(stream, typecode, count):
+    column = array(typecode)
+    column.frombytes(_read(stream, column.itemsize * count))
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated columnar readings stream')
+    return data
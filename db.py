@@ -0,0 +1,770 @@
+import os
+import sqlite3
+import threading
+import time
+from schemas import MAX_DATE, ROLLUP_RESOLUTIONS, SENSOR_TYPES
+
+# Folds a new reading into an existing rollup row. On a tie for the min or
+# max value the earlier reading wins, matching the order the min and max
+# endpoints have always used.
+_ROLLUP_UPSERT = (
+    'ON CONFLICT (device_uuid, type, resolution, bucket) DO UPDATE SET '
+    'count = count + excluded.count, total = total + excluded.total, '
+    'min_date = CASE WHEN excluded.min_value < min_value OR '
+    '(excluded.min_value = min_value AND excluded.min_date < min_date) THEN excluded.min_date ELSE min_date END, '
+    'min_value = min(min_value, excluded.min_value), '
+    'max_date = CASE WHEN excluded.max_value > max_value OR '
+    '(excluded.max_value = max_value AND excluded.max_date < max_date) THEN excluded.max_date ELSE max_date END, '
+    'max_value = max(max_value, excluded.max_value)'
+)
+
+# Ids of the sensor types, by their position in SENSOR_TYPES. New types are
+# appended there, and need a migration adding them to sensor_types.
+SENSOR_TYPE_IDS = {name: index + 1 for index, name in enumerate(SENSOR_TYPES)}
+
+# Width in seconds of the time partitions the readings are stored in. Each
+# partition is a table of its own, so expiring one is a DROP TABLE rather
+# than a DELETE. It is a whole number of weeks, so no rollup or histogram
+# bucket ever straddles two partitions. Changing it needs a migration.
+PARTITION_SIZE = 7 * 86400
+
+# Every partition gets the indexes and triggers the readings table had.
+# These are the text layout of migration 5, since rewritten by migration 6.
+_TEXT_PARTITION_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS "{name}_device_type_date" ON {table} (device_uuid, type, date_created, value)',
+    'CREATE INDEX IF NOT EXISTS "{name}_device_type_value" ON {table} (device_uuid, type, value, date_created)',
+    'CREATE TRIGGER IF NOT EXISTS "{name}_histogram_insert" AFTER INSERT ON {table} BEGIN '
+    'INSERT INTO reading_histograms (device_uuid, type, bucket, value, count) '
+    'VALUES (NEW.device_uuid, NEW.type, NEW.date_created - ((NEW.date_created % 3600) + 3600) % 3600, NEW.value, 1) '
+    'ON CONFLICT (device_uuid, type, bucket, value) DO UPDATE SET count = count + 1; END',
+    'CREATE TRIGGER IF NOT EXISTS "{name}_histogram_delete" AFTER DELETE ON {table} BEGIN '
+    'UPDATE reading_histograms SET count = count - 1 WHERE device_uuid = OLD.device_uuid AND type = OLD.type '
+    'AND bucket = OLD.date_created - ((OLD.date_created % 3600) + 3600) % 3600 AND value = OLD.value; END',
+    'CREATE TRIGGER IF NOT EXISTS "{name}_rollup_insert" AFTER INSERT ON {table} BEGIN '
+    'INSERT INTO reading_rollups SELECT NEW.device_uuid, NEW.type, column1, '
+    'NEW.date_created - ((NEW.date_created % column1) + column1) % column1, '
+    '1, NEW.value, NEW.value, NEW.date_created, NEW.value, NEW.date_created '
+    'FROM (VALUES (60), (3600), (86400)) WHERE true ' + _ROLLUP_UPSERT + '; END',
+)
+_TEXT_COLUMNS = 'device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER'
+
+# The same with the device and type dictionary encoded, as integer ids into
+# the devices and sensor_types tables
+_PARTITION_INDEXES = tuple(statement.replace('device_uuid', 'device_id') for statement in _TEXT_PARTITION_INDEXES)
+_COLUMNS = 'device_id INTEGER, type INTEGER, value INTEGER, date_created INTEGER'
+
+
+def _partition_readings(conn):
+    # Move the readings into partitions. Their aggregates are already in
+    # reading_histograms and reading_rollups, so the rows are copied before
+    # the triggers are created, and a temporary date index (dropped along
+    # with the old table) turns each copy into a range seek.
+    conn.execute('CREATE TABLE IF NOT EXISTS reading_partitions (first INTEGER PRIMARY KEY)')
+    conn.execute('CREATE INDEX IF NOT EXISTS readings_date ON readings (date_created)')
+
+    query = 'SELECT DISTINCT date_created - ((date_created % {size}) + {size}) % {size} FROM readings'
+    for (first,) in conn.execute(query.format(size=PARTITION_SIZE)).fetchall():
+        _create_partition_table(conn, first, _TEXT_COLUMNS)
+        conn.execute('INSERT INTO {} SELECT device_uuid, type, value, date_created FROM readings '
+                     'WHERE date_created >= ? AND date_created < ? ORDER BY rowid'.format(partition_table(first)),
+                     (first, first + PARTITION_SIZE))
+        _create_partition_indexes(conn, first, _TEXT_PARTITION_INDEXES)
+
+    conn.execute('DROP TABLE readings')
+    _create_readings_view(conn, encoded=False)
+
+
+def _encode_readings(conn):
+    # Swap the device_uuid and type strings of every partition and aggregate
+    # for integer ids. The triggers of the text layout are dropped first, the
+    # aggregates are rebuilt here. Every partition is then copied to a new
+    # table keeping its rowids, and so the pagination cursors handed out,
+    # after the old one is renamed out of the way. It is dropped along with
+    # its indexes before the new ones, of the same names, are created.
+    conn.execute('CREATE TABLE IF NOT EXISTS devices (id INTEGER PRIMARY KEY, uuid TEXT NOT NULL UNIQUE)')
+    conn.execute('CREATE TABLE IF NOT EXISTS sensor_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+    conn.executemany('INSERT OR IGNORE INTO sensor_types (id, name) VALUES (?, ?)',
+                     [(type_id, name) for name, type_id in SENSOR_TYPE_IDS.items()])
+    conn.execute('DROP VIEW IF EXISTS readings')
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        conn.execute('DROP TRIGGER "{}"'.format(name))
+
+    # Table -> (key columns after the device and type, value columns)
+    tables = {
+        'reading_histograms': (['bucket', 'value'], ['count']),
+        'reading_rollups': (['resolution', 'bucket'],
+                            ['count', 'total', 'min_value', 'min_date', 'max_value', 'max_date']),
+    }
+    for table in tables:
+        conn.execute('ALTER TABLE {0} RENAME TO {0}_text'.format(table))
+        # Every device and type ever seen is in the aggregates, expired or not
+        conn.execute('INSERT OR IGNORE INTO devices (uuid) SELECT DISTINCT device_uuid FROM {}_text'.format(table))
+        conn.execute('INSERT OR IGNORE INTO sensor_types (name) SELECT DISTINCT type FROM {}_text'.format(table))
+
+    for table, (keys, values) in tables.items():
+        conn.execute('CREATE TABLE {} (device_id INTEGER, type INTEGER, {}, PRIMARY KEY (device_id, type, {})) '
+                     'WITHOUT ROWID'.format(table, ', '.join(column + ' INTEGER' for column in keys + values),
+                                            ', '.join(keys)))
+        conn.execute('INSERT INTO {0} SELECT d.id, t.id, {1} FROM {0}_text a JOIN devices d ON d.uuid = a.device_uuid '
+                     'JOIN sensor_types t ON t.name = a.type'.format(table, ', '.join('a.' + c for c in keys + values)))
+        conn.execute('DROP TABLE {}_text'.format(table))
+
+    for (first,) in conn.execute('SELECT first FROM reading_partitions').fetchall():
+        table = partition_table(first)
+        conn.execute('ALTER TABLE {} RENAME TO "readings_{}_text"'.format(table, first))
+        _create_partition_table(conn, first)
+        conn.execute('INSERT INTO {} (rowid, device_id, type, value, date_created) '
+                     'SELECT r.rowid, d.id, t.id, r.value, r.date_created FROM "readings_{}_text" r '
+                     'JOIN devices d ON d.uuid = r.device_uuid JOIN sensor_types t ON t.name = r.type '
+                     'ORDER BY r.rowid'.format(table, first))
+        conn.execute('DROP TABLE "readings_{}_text"'.format(first))
+        _create_partition_indexes(conn, first)
+
+    _create_readings_view(conn)
+
+
+# Versioned schema migrations. Each entry is a tuple of statements, or
+# functions taking the connection, that moves the schema up by one version,
+# and the version of a database is tracked with PRAGMA user_version, so the
+# position of a migration in this list (plus one) is the version a database
+# reports once it has been applied.
+# Never edit a migration that has shipped - append a new one instead.
+MIGRATIONS = [
+    # 1: The original readings table
+    (
+        'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)',
+    ),
+    # 2: Key the readings on (device_uuid, type, date_created). Every endpoint
+    # filters on exactly that prefix, so this turns each query into a range
+    # seek. Including value makes it a covering index for all of them.
+    (
+        'CREATE INDEX IF NOT EXISTS readings_device_type_date ON readings (device_uuid, type, date_created, value)',
+    ),
+    # 3: Per (device_uuid, type, hour) histograms of the reading values, kept
+    # current by triggers so every write path maintains them. A second index
+    # ordered by value lets us seek straight to the reading at a given rank.
+    (
+        'CREATE TABLE IF NOT EXISTS reading_histograms (device_uuid TEXT, type TEXT, bucket INTEGER, value INTEGER, '
+        'count INTEGER, PRIMARY KEY (device_uuid, type, bucket, value)) WITHOUT ROWID',
+        'INSERT INTO reading_histograms (device_uuid, type, bucket, value, count) '
+        'SELECT device_uuid, type, date_created - ((date_created % 3600) + 3600) % 3600, value, count(*) '
+        'FROM readings GROUP BY 1, 2, 3, 4',
+        'CREATE TRIGGER IF NOT EXISTS readings_histogram_insert AFTER INSERT ON readings BEGIN '
+        'INSERT INTO reading_histograms (device_uuid, type, bucket, value, count) '
+        'VALUES (NEW.device_uuid, NEW.type, NEW.date_created - ((NEW.date_created % 3600) + 3600) % 3600, NEW.value, 1) '
+        'ON CONFLICT (device_uuid, type, bucket, value) DO UPDATE SET count = count + 1; END',
+        'CREATE TRIGGER IF NOT EXISTS readings_histogram_delete AFTER DELETE ON readings BEGIN '
+        'UPDATE reading_histograms SET count = count - 1 WHERE device_uuid = OLD.device_uuid AND type = OLD.type '
+        'AND bucket = OLD.date_created - ((OLD.date_created % 3600) + 3600) % 3600 AND value = OLD.value; END',
+        'CREATE INDEX IF NOT EXISTS readings_device_type_value ON readings (device_uuid, type, value, date_created)',
+    ),
+    # 4: Minute, hour and day rollups of count, total, min and max, along
+    # with the date of the earliest min and max reading so those endpoints can
+    # still return a full reading. Kept current by a trigger like the
+    # histograms, and backfilled by replaying the existing readings through
+    # the same upsert.
+    (
+        'CREATE TABLE IF NOT EXISTS reading_rollups (device_uuid TEXT, type TEXT, resolution INTEGER, bucket INTEGER, '
+        'count INTEGER, total INTEGER, min_value INTEGER, min_date INTEGER, max_value INTEGER, max_date INTEGER, '
+        'PRIMARY KEY (device_uuid, type, resolution, bucket)) WITHOUT ROWID',
+        'INSERT INTO reading_rollups SELECT r.device_uuid, r.type, s.column1, '
+        'r.date_created - ((r.date_created % s.column1) + s.column1) % s.column1, '
+        '1, r.value, r.value, r.date_created, r.value, r.date_created '
+        'FROM readings r, (VALUES (60), (3600), (86400)) s WHERE true ' + _ROLLUP_UPSERT,
+        'CREATE TRIGGER IF NOT EXISTS readings_rollup_insert AFTER INSERT ON readings BEGIN '
+        'INSERT INTO reading_rollups SELECT NEW.device_uuid, NEW.type, column1, '
+        'NEW.date_created - ((NEW.date_created % column1) + column1) % column1, '
+        '1, NEW.value, NEW.value, NEW.date_created, NEW.value, NEW.date_created '
+        'FROM (VALUES (60), (3600), (86400)) WHERE true ' + _ROLLUP_UPSERT + '; END',
+    ),
+    # 5: Split the readings into a table per PARTITION_SIZE of date_created,
+    # catalogued in reading_partitions, and replace the readings table with
+    # a read-only view over all of them for ad-hoc queries.
+    (
+        _partition_readings,
+    ),
+    # 6: Store the device and type of every reading, histogram and rollup as
+    # integer ids: a device_id into a new devices table of uuids, and a type
+    # into sensor_types, numbered after SENSOR_TYPES. The readings view
+    # decodes them back.
+    (
+        _encode_readings,
+    ),
+    # 7: A write version per device, bumped by every change to its readings
+    # along with the time of the change in milliseconds, for conditional GETs
+    (
+        'ALTER TABLE devices ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE devices ADD COLUMN modified INTEGER',
+        "UPDATE devices SET version = 1, modified = CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)",
+    ),
+    # 8: The partitions a bulk load is running without their indexes and
+    # triggers, with the rowid its readings start after
+    (
+        'CREATE TABLE IF NOT EXISTS bulk_loads (first INTEGER PRIMARY KEY, after_rowid INTEGER NOT NULL)',
+    ),
+    # 9: Index the aggregates on their buckets, so retention deletes the
+    # ones of expired partitions with range seeks, and finds the devices of
+    # a partition from its daily rollups. The triggers only add to them
+    # when a reading opens a new bucket.
+    (
+        'CREATE INDEX IF NOT EXISTS reading_rollups_bucket ON reading_rollups (resolution, bucket, device_id)',
+        'CREATE INDEX IF NOT EXISTS reading_histograms_bucket ON reading_histograms (bucket)',
+    ),
+    # 10: The range of dates each of the last WRITE_LOG_VERSIONS versions of
+    # a device wrote to, per type, so a process can tell whether the writes
+    # of the others reached the windows it has results cached for
+    (
+        'CREATE TABLE IF NOT EXISTS device_writes (device_id INTEGER, version INTEGER, type INTEGER, '
+        'low INTEGER, high INTEGER, PRIMARY KEY (device_id, version, type)) WITHOUT ROWID',
+    ),
+]
+
+# Width in seconds of the time buckets in reading_histograms. This is baked
+# into the triggers above, so changing it needs a migration.
+HISTOGRAM_BUCKET = 3600
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Versions of each device kept in device_writes. A result cached further
+# back than that is recomputed, whichever dates were written since.
+WRITE_LOG_VERSIONS = 16
+
+# A (value, date_created) pair packed into a single integer that orders like
+# the pair, so one min() or max() per group picks the whole reading, ties
+# going to the earlier one. Values are 0-100 and the schemas keep dates
+# within MAX_DATE, under half of it, so it stays far inside 64 bits.
+_PACKING = 2 * (MAX_DATE + 1)
+
+# Fold the histograms and rollups of a partition's readings past a rowid in
+# with grouped queries, rather than a trigger firing per reading. The
+# rollups unpack the min and max readings picked with _PACKING, so only
+# readings validated by the schemas, dated within MAX_DATE, may be loaded
+# with their partitions suspended.
+_HISTOGRAM_REBUILD = (
+    'INSERT INTO reading_histograms (device_id, type, bucket, value, count) '
+    'SELECT device_id, type, date_created - ((date_created % {bucket}) + {bucket}) % {bucket}, value, count(*) '
+    'FROM {table} WHERE rowid > ? GROUP BY 1, 2, 3, 4 '
+    'ON CONFLICT (device_id, type, bucket, value) DO UPDATE SET count = count + excluded.count'
+)
+_ROLLUP_REBUILD = (
+    'INSERT INTO reading_rollups SELECT device_id, type, {resolution}, bucket, count, total, '
+    'min_value, low - min_value * {packing}, max_value, max_value * {packing} - high '
+    'FROM (SELECT *, (low + {packing} / 2) / {packing} AS min_value, (high + {packing} / 2) / {packing} AS max_value '
+    'FROM (SELECT device_id, type, date_created - ((date_created % {resolution}) + {resolution}) % {resolution} AS bucket, '
+    'count(*) AS count, sum(value) AS total, min(value * {packing} + date_created) AS low, '
+    'max(value * {packing} - date_created) AS high FROM {table} WHERE rowid > ? GROUP BY 1, 2, 3)) WHERE true '
+) + _ROLLUP_UPSERT.replace('device_uuid', 'device_id')
+
+# The devices with readings in a partition, from their daily rollups
+_PARTITION_DEVICES = ('SELECT DISTINCT device_id FROM reading_rollups '
+                      'WHERE resolution = 86400 AND bucket >= ? AND bucket < ?')
+
+# Pragmas applied to every pooled connection when it is opened
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # Negative sizes are in KiB, so this is a 64MiB page cache
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Bring the database behind conn up to SCHEMA_VERSION.
+
+    The migrations run inside a single write transaction, so concurrent
+    processes starting up against the same file apply them exactly once.
+    Returns the version the database was at before migrating.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = get_schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f'Database schema version {version} is newer than this code ({SCHEMA_VERSION})')
+
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+
+        # PRAGMA does not take bound parameters, SCHEMA_VERSION is an int we control
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+    # A database is only ever migrated from scratch when it was recreated,
+    # so the device ids cached for it are no good anymore
+    if version < SCHEMA_VERSION:
+        _device_ids.get(_database_path(conn), {}).clear()
+
+    return version
+
+
+def partition_start(date_created):
+    return date_created - date_created % PARTITION_SIZE
+
+
+def partition_table(first):
+    """
+    Return the quoted name of the partition table starting at first, ready
+    to be formatted into a query.
+    """
+    return '"readings_{}"'.format(first)
+
+
+def partitions(conn, start=None, end=None):
+    """
+    Return the tables of the partitions overlapping [start, end), oldest
+    first. None stands for an open start or end.
+    """
+    # Always bounded, so the lookup stays a rowid range seek
+    lower = -2 ** 63 if start is None else start - PARTITION_SIZE
+    upper = 2 ** 63 - 1 if end is None else end
+    query = 'select first from reading_partitions where first > ? and first < ? order by first'
+    return [partition_table(first) for (first,) in conn.execute(query, (lower, upper))]
+
+
+def create_partitions(conn, dates):
+    """
+    Make sure there is a partition for each of the dates.
+
+    A new partition is created along with its indexes and triggers in one
+    transaction, so no reading can land in it before its aggregates are
+    maintained. Concurrent writers creating the same partition are fine,
+    every statement is idempotent.
+    """
+    firsts = {partition_start(date_created) for date_created in dates}
+    query = 'select first from reading_partitions where first in ({})'.format(','.join('?' * len(firsts)))
+    missing = firsts - {first for (first,) in conn.execute(query, list(firsts))}
+    if not missing:
+        return
+
+    # Join the caller's transaction if there is one
+    owned = not conn.in_transaction
+    if owned:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        for first in sorted(missing):
+            _create_partition_table(conn, first)
+            _create_partition_indexes(conn, first)
+        _create_readings_view(conn)
+
+        if owned:
+            conn.execute('COMMIT')
+    except BaseException:
+        if owned:
+            conn.execute('ROLLBACK')
+        raise
+
+
+def drop_partitions(conn, firsts):
+    """
+    Drop the partitions starting at firsts, inside the caller's transaction.
+    The triggers do not fire on a DROP TABLE, so the aggregates of their
+    readings are kept.
+    """
+    # Their devices lose readings, so they get a new version. They are
+    # found from the daily rollups of the partitions, a range seek on their
+    # bucket index, rather than from every reading. A day never straddles
+    # two partitions. A device whose readings in the period had expired
+    # before may get a version it did not need, which only costs a 200.
+    # The dates they lose are logged as the span of the partitions.
+    writes = {}
+    for first in firsts:
+        for (device,) in conn.execute(_PARTITION_DEVICES, (first, first + PARTITION_SIZE)):
+            for type_id in SENSOR_TYPE_IDS.values():
+                low, high = writes.get((device, type_id), (first, first))
+                writes[(device, type_id)] = (min(low, first), max(high, first + PARTITION_SIZE - 1))
+    touch_devices(conn, {device for device, _ in writes}, writes)
+
+    for first in firsts:
+        conn.execute('DROP TABLE IF EXISTS {}'.format(partition_table(first)))
+        conn.execute('DELETE FROM reading_partitions WHERE first = ?', (first,))
+    _create_readings_view(conn)
+
+
+def suspend_partitions(conn, firsts):
+    """
+    Drop the indexes and triggers of the partitions starting at firsts, so a
+    bulk load pays for the inserts alone. Each is recorded in bulk_loads
+    with the rowid its new readings start after, and stays suspended until
+    resume_partitions, even across a crash. Until then, the aggregates and
+    the index seeks of every endpoint miss the loaded readings, so only
+    suspend partitions while the API is down.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for first in firsts:
+            after, = conn.execute('SELECT coalesce(max(rowid), 0) FROM {}'.format(partition_table(first))).fetchone()
+            conn.execute('INSERT OR IGNORE INTO bulk_loads (first, after_rowid) VALUES (?, ?)', (first, after))
+
+            query = "SELECT type, name FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger')"
+            for kind, name in conn.execute(query, ('readings_{}'.format(first),)).fetchall():
+                conn.execute('DROP {} "{}"'.format(kind.upper(), name))
+
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def resume_partitions(conn, rebuild=True):
+    """
+    Bring back every partition suspended by suspend_partitions: fold the
+    readings loaded into it into the histograms and rollups with a grouped
+    query per aggregate, then rebuild its indexes and triggers. Without
+    rebuild, for a caller that copied the aggregates in itself, only the
+    indexes and triggers are. Returns the start of every partition resumed.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        loads = conn.execute('SELECT first, after_rowid FROM bulk_loads ORDER BY first').fetchall()
+        for first, after in loads:
+            table = partition_table(first)
+            if rebuild:
+                conn.execute(_HISTOGRAM_REBUILD.format(table=table, bucket=HISTOGRAM_BUCKET), (after,))
+                for resolution in ROLLUP_RESOLUTIONS:
+                    conn.execute(_ROLLUP_REBUILD.format(table=table, resolution=resolution, packing=_PACKING),
+                                 (after,))
+            _create_partition_indexes(conn, first)
+
+        conn.execute('DELETE FROM bulk_loads')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+    return [first for first, _ in loads]
+
+
+def _create_partition_table(conn, first, columns=_COLUMNS):
+    conn.execute('INSERT OR IGNORE INTO reading_partitions (first) VALUES (?)', (first,))
+    conn.execute('CREATE TABLE IF NOT EXISTS {} ({} CHECK (date_created >= {} AND date_created < {}))'.format(
+        partition_table(first), columns, first, first + PARTITION_SIZE))
+
+
+def _create_partition_indexes(conn, first, statements=_PARTITION_INDEXES):
+    for statement in statements:
+        conn.execute(statement.format(name='readings_{}'.format(first), table=partition_table(first)))
+
+
+def _create_readings_view(conn, encoded=True):
+    if encoded:
+        select = ('SELECT d.uuid, t.name, r.value, r.date_created FROM {} r '
+                  'JOIN devices d ON d.id = r.device_id JOIN sensor_types t ON t.id = r.type')
+    else:
+        select = 'SELECT device_uuid, type, value, date_created FROM {}'
+    selects = [select.format(partition_table(first))
+               for (first,) in conn.execute('SELECT first FROM reading_partitions ORDER BY first').fetchall()]
+    if not selects:
+        selects = ['SELECT NULL, NULL, NULL, NULL WHERE false']
+
+    # A compound SELECT is capped at 500 terms, so nest them in groups
+    while len(selects) > 100:
+        selects = ['SELECT * FROM ({})'.format(' UNION ALL '.join(selects[i:i + 100]))
+                   for i in range(0, len(selects), 100)]
+
+    conn.execute('DROP VIEW IF EXISTS readings')
+    conn.execute('CREATE VIEW readings (device_uuid, type, value, date_created) AS ' + ' UNION ALL '.join(selects))
+
+
+class Connection(sqlite3.Connection):
+    """
+    Connection caching the ids of the devices table, in a cache shared by
+    every Connection to the same database file in the process.
+
+    A device keeps its id for good once it has one, so the cached ids never
+    go stale. Unknown uuids are not cached, another process may add them.
+    """
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        path = _database_path(self)
+        self.device_ids = _device_ids.setdefault(path, {}) if path else {}
+
+
+# Database path -> {device_uuid: device_id}
+_device_ids = {}
+
+
+def device_id(conn, device_uuid):
+    """
+    Return the id of a device, or None when it has no readings. None never
+    matches in a query, so it can be bound as is.
+    """
+    cache = getattr(conn, 'device_ids', None)
+    if cache is not None and device_uuid in cache:
+        return cache[device_uuid]
+
+    row = conn.execute('SELECT id FROM devices WHERE uuid = ?', (device_uuid,)).fetchone()
+    if row is None:
+        return None
+    if cache is not None:
+        cache[device_uuid] = row[0]
+    return row[0]
+
+
+def find_devices(conn, device_uuids):
+    """
+    Return {device_uuid: device_id} for the given devices that have
+    readings, looking the ones that are not cached up in chunks.
+    """
+    cache = getattr(conn, 'device_ids', None)
+    ids = {}
+    missing = []
+    for device_uuid in device_uuids:
+        if cache is not None and device_uuid in cache:
+            ids[device_uuid] = cache[device_uuid]
+        else:
+            missing.append(device_uuid)
+
+    found = {}
+    for batch in _chunks(missing, 500):
+        query = 'SELECT uuid, id FROM devices WHERE uuid IN ({})'.format(','.join('?' * len(batch)))
+        found.update(conn.execute(query, batch).fetchall())
+
+    if cache is not None:
+        cache.update(found)
+    ids.update(found)
+    return ids
+
+
+def create_devices(conn, device_uuids):
+    """
+    Return {device_uuid: device_id} for the given devices, adding the ones
+    that are new to the devices table.
+
+    New devices are committed in a transaction of their own, so their ids
+    are only cached once they are there for good. In the caller's
+    transaction, they are looked up but not cached.
+    """
+    cache = getattr(conn, 'device_ids', None)
+    ids = {}
+    missing = set()
+    for device_uuid in device_uuids:
+        if cache is not None and device_uuid in cache:
+            ids[device_uuid] = cache[device_uuid]
+        else:
+            missing.add(device_uuid)
+    if not missing:
+        return ids
+
+    owned = not conn.in_transaction
+    if owned:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('INSERT OR IGNORE INTO devices (uuid) VALUES (?)', [(d,) for d in missing])
+        for batch in _chunks(list(missing), 500):
+            query = 'SELECT uuid, id FROM devices WHERE uuid IN ({})'.format(','.join('?' * len(batch)))
+            ids.update(conn.execute(query, batch).fetchall())
+
+        if owned:
+            conn.execute('COMMIT')
+    except BaseException:
+        if owned:
+            conn.execute('ROLLBACK')
+        raise
+
+    if owned and cache is not None:
+        cache.update((device_uuid, ids[device_uuid]) for device_uuid in missing)
+    return ids
+
+
+def touch_devices(conn, device_ids, writes=None):
+    """
+    Bump the version of the devices and stamp them as modified now. Call it
+    in the transaction that writes their readings, so the new version is
+    committed along with them and every process sees both or neither.
+
+    The new versions are logged in device_writes with the (low, high) dates
+    written per type, from writes as {(device_id, type_id): (low, high)}.
+    Devices it leaves out are logged as changing every date of every type.
+    Returns {device_id: version} of the new versions.
+    """
+    device_ids = list(device_ids)
+    writes = dict(writes or {})
+    written = {device for device, _ in writes}
+    for device in device_ids:
+        if device not in written:
+            writes.update(((device, type_id), (-MAX_DATE, MAX_DATE)) for type_id in SENSOR_TYPE_IDS.values())
+
+    modified = _now_ms()
+    conn.executemany('UPDATE devices SET version = version + 1, modified = ? WHERE id = ?',
+                     [(modified, device) for device in device_ids])
+    conn.executemany('INSERT OR REPLACE INTO device_writes SELECT id, version, ?, ?, ? FROM devices WHERE id = ?',
+                     [(type_id, low, high, device) for (device, type_id), (low, high) in writes.items()])
+    conn.executemany('DELETE FROM device_writes WHERE device_id = ? AND version <= '
+                     '(SELECT version FROM devices WHERE id = ?) - ?',
+                     [(device, device, WRITE_LOG_VERSIONS) for device in device_ids])
+    return device_versions(conn, device_ids)
+
+
+def device_version(conn, device_uuid):
+    """
+    Return (version, modified) of a device, modified in epoch milliseconds,
+    or None when it has no readings.
+    """
+    row = conn.execute('SELECT version, modified FROM devices WHERE uuid = ?', (device_uuid,)).fetchone()
+    return None if row is None else tuple(row)
+
+
+def written_since(conn, device_uuid, sensor_type, since):
+    """
+    Return the (low, high) range of the dates of sensor_type written to a
+    device after its version since, (None, None) when none were, or None
+    when device_writes does not go back that far.
+    """
+    version, low, high = conn.execute(
+        'SELECT d.version, min(w.low), max(w.high) FROM devices d LEFT JOIN device_writes w '
+        'ON w.device_id = d.id AND w.version > ? AND w.type = ? WHERE d.uuid = ?',
+        (since, SENSOR_TYPE_IDS[sensor_type], device_uuid)).fetchone()
+    if version is None or since < version - WRITE_LOG_VERSIONS:
+        return None
+    return low, high
+
+
+def device_versions(conn, device_ids):
+    """
+    Return {device_id: version} for the given device ids, in chunks.
+    """
+    versions = {}
+    for batch in _chunks(list(device_ids), 500):
+        query = 'SELECT id, version FROM devices WHERE id IN ({})'.format(','.join('?' * len(batch)))
+        versions.update(conn.execute(query, batch).fetchall())
+    return versions
+
+
+def device_uuids(conn):
+    """
+    Return {device_id: device_uuid} for every device.
+    """
+    return dict(conn.execute('SELECT id, uuid FROM devices').fetchall())
+
+
+def sensor_type_names(conn):
+    """
+    Return {type_id: name} for every sensor type.
+    """
+    return dict(conn.execute('SELECT id, name FROM sensor_types').fetchall())
+
+
+def _database_path(conn):
+    # Nothing to share for in-memory and temporary databases
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return os.path.abspath(path) if path else None
+
+
+def _now_ms():
+    return time.time_ns() // 1000000
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def full_scans(conn, query, params=()):
+    """
+    Return the steps of the query plan for query that fall back to a full
+    table or index SCAN rather than a SEARCH. An empty list means the query
+    is answered with range seeks only.
+    """
+    plan = conn.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()
+    return [row[3] for row in plan if row[3].startswith('SCAN')]
+
+
+class ConnectionPool(object):
+    """
+    Pool of SQLite connections shared by the threads of a worker.
+
+    A connection is handed to one thread at a time and goes back to the pool
+    when it is released, so the cost of connecting, applying pragmas and
+    parsing the schema is paid once per pooled connection rather than once
+    per request. At most max_idle connections per database path are kept
+    around, anything beyond that is closed on release. Prepared statements
+    are cached per connection by the sqlite3 module, up to cached_statements
+    of them. Each database is migrated the first time the pool connects to
+    it. Connections are made with factory, a subclass of Connection.
+    """
+
+    def __init__(self, pragmas=None, cached_statements=256, max_idle=16, factory=Connection):
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self.cached_statements = cached_statements
+        self.factory = factory
+        self.max_idle = max_idle
+        self.hits = 0
+        self.misses = 0
+        self._idle = {}
+        self._connections = set()
+        self._migrated = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        with self._lock:
+            idle = self._idle.get(path)
+            if idle:
+                self.hits += 1
+                return idle.pop()
+            self.misses += 1
+
+        conn = self._connect(path)
+
+        with self._lock:
+            self._connections.add(conn)
+        return conn
+
+    def release(self, conn, path):
+        # Never hand out a connection halfway through a transaction
+        if conn.in_transaction:
+            conn.rollback()
+
+        with self._lock:
+            idle = self._idle.setdefault(path, [])
+            if len(idle) < self.max_idle and conn in self._connections:
+                idle.append(conn)
+                return
+            self._connections.discard(conn)
+
+        conn.close()
+
+    def close(self):
+        """
+        Close every connection the pool has opened.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, set()
+            self._idle = {}
+            self._migrated = set()
+
+        for conn in connections:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, open=len(self._connections),
+                        idle=sum(len(idle) for idle in self._idle.values()))
+
+    def _connect(self, path):
+        # A pooled connection moves between threads, but it is only ever
+        # used by the one thread that currently holds it
+        conn = sqlite3.connect(path, cached_statements=self.cached_statements, check_same_thread=False,
+                               factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+
+        if path not in self._migrated:
+            migrate(conn)
+            self._migrated.add(path)
+
+        return conn
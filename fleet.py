@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from db import SENSOR_TYPE_IDS, Connection
+from stats import Histogram, value_histogram, value_summary
+
+
+class FleetPartial(object):
+    """
+    Aggregates for a partition of the fleet that can be merged with the
+    partials of the other partitions: the number of devices with readings,
+    the count and total of the values, the min and max reading as
+    (value, date_created, device_uuid), and the value histogram.
+    """
+
+    def __init__(self, devices=0, count=0, total=0, min=None, max=None, counts=None):
+        self.devices = devices
+        self.count = count
+        self.total = total
+        self.min = min
+        self.max = max
+        self.counts = Counter() if counts is None else counts
+
+    def merge(self, other):
+        self.devices += other.devices
+        self.count += other.count
+        self.total += other.total
+        self.counts.update(other.counts)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or _max_order(other.max) < _max_order(self.max)):
+            self.max = other.max
+        return self
+
+
+def partial_stats(conn, devices, sensor_type, start=None, end=None):
+    """
+    Compute the FleetPartial of the given devices' readings of one type over
+    [start, end), from the same rollups and histograms as the per-device
+    metrics.
+    """
+    partial = FleetPartial()
+    for device_uuid in devices:
+        summary = value_summary(conn, device_uuid, sensor_type, start, end)
+        if not summary:
+            continue
+
+        histogram = value_histogram(conn, device_uuid, sensor_type, start, end)
+        partial.merge(FleetPartial(
+            devices=1,
+            count=summary.count,
+            total=summary.total,
+            min=summary.min + (device_uuid,),
+            max=summary.max + (device_uuid,),
+            counts=Counter(dict(histogram.counts)),
+        ))
+
+    return partial
+
+
+def fleet_stats(shards, sensor_type, start=None, end=None, percentiles=(50, 95, 99), workers=None, min_parallel=64):
+    """
+    Compute the min, max, mean and percentiles of a type across devices.
+
+    shards is a list of (conn, path, devices) giving the devices to include
+    from each shard. The devices are split into partitions across worker
+    processes, each worker computes the FleetPartial of its partition
+    against the shard at path, and the partials are merged at the end.
+    Fewer than min_parallel devices are not worth shipping to other
+    processes, so they are computed right here on each shard's conn.
+    Returns None when none of the devices have readings.
+    """
+    workers = workers or os.cpu_count()
+    partial = FleetPartial()
+
+    if sum(len(devices) for _, _, devices in shards) < min_parallel:
+        for conn, _, devices in shards:
+            partial.merge(partial_stats(conn, devices, sensor_type, start, end))
+    else:
+        pool = _get_pool(workers)
+        futures = []
+        for _, path, devices in shards:
+            # Every shard is split across all the workers, so the load stays
+            # even however the devices are spread over the shards
+            size = -(-len(devices) // workers)
+            futures += [pool.submit(_partial_stats_worker, path, devices[i:i + size], sensor_type, start, end)
+                        for i in range(0, len(devices), size)]
+        for future in futures:
+            partial.merge(future.result())
+
+    if not partial.count:
+        return None
+
+    def reading(value, date_created, device_uuid):
+        return dict(device_uuid=device_uuid, type=sensor_type, value=value, date_created=date_created)
+
+    histogram = Histogram(partial.counts)
+    return dict(
+        count=partial.count,
+        devices=partial.devices,
+        min=reading(*partial.min),
+        max=reading(*partial.max),
+        mean=round(partial.total / partial.count),
+        percentiles={'{:g}'.format(p): histogram.percentile(p) for p in percentiles},
+    )
+
+
+def list_devices(conn, sensor_type, start=None, end=None):
+    """
+    Return the uuid of every device with readings of the given type, on the
+    days overlapping [start, end) when given. They are found from the daily
+    rollups, so a device whose readings on those days all fall outside the
+    window is still listed, and left for partial_stats to skip.
+    """
+    query = 'select distinct device_id from reading_rollups where type = ? and resolution = 86400'
+    params = [SENSOR_TYPE_IDS.get(sensor_type)]
+    if start is not None:
+        query += ' and bucket > ?'
+        params.append(start - 86400)
+    if end is not None:
+        query += ' and bucket < ?'
+        params.append(end)
+    return [row[0] for row in conn.execute('select uuid from devices where id in ({})'.format(query), params)]
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def _max_order(reading):
+    # The max is the highest value, ties going to the earliest reading
+    value, date_created, device_uuid = reading
+    return -value, date_created, device_uuid
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Each worker process keeps one connection per database open
+_worker_connections = {}
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Workers are spawned rather than forked, a fork of a process
+            # with running threads can inherit locks that are never released
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _partial_stats_worker(path, devices, sensor_type, start, end):
+    if path not in _worker_connections:
+        _worker_connections[path] = sqlite3.connect(path, factory=Connection)
+    return partial_stats(_worker_connections[path], devices, sensor_type, start, end)
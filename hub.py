@@ -0,0 +1,240 @@
+import json
+import threading
+import uuid
+from collections import deque
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription(object):
+    """
+    A subscriber's bounded buffer of the (event_id, row) events the hub
+    fans out to it.
+
+    reset is True when the subscriber asked to resume from an event the
+    hub no longer remembers, so some events in between were missed and it
+    should fetch the readings again. evicted is set by the hub when the
+    subscriber fell so far behind its buffer filled up. It then gets no new
+    events, only what is still buffered.
+    """
+
+    def __init__(self, hub, device_uuid=None, sensor_type=None, devices=None):
+        self.hub = hub
+        self.device_uuid = device_uuid
+        self.sensor_type = sensor_type
+        self.devices = None if devices is None else frozenset(devices)
+        self.reset = False
+        self.evicted = False
+        self.closed = False
+        self._events = deque()
+        self._ready = threading.Condition(hub._lock)
+
+    def matches(self, row):
+        device_uuid, sensor_type = row[0], row[1]
+        return ((self.device_uuid is None or device_uuid == self.device_uuid) and
+                (self.sensor_type is None or sensor_type == self.sensor_type) and
+                (self.devices is None or device_uuid in self.devices))
+
+    def get(self, timeout=None):
+        """
+        Return the buffered events, waiting up to timeout seconds for one.
+        Returns an empty list on timeout, and None once the subscription
+        was evicted or closed and everything buffered has been returned.
+        """
+        with self._ready:
+            self._ready.wait_for(lambda: self._events or self.evicted or self.closed, timeout)
+            events = list(self._events)
+            self._events.clear()
+            if not events and (self.evicted or self.closed):
+                return None
+            return events
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class ReadingHub(object):
+    """
+    In-process fan-out of committed readings to live subscribers.
+
+    Every published row gets the next event id, a sequence number prefixed
+    with an epoch drawn when the hub is created, so ids handed out before a
+    restart are never mistaken for new ones. The last history events are
+    kept so a subscriber can resume after the id it saw last.
+
+    Each subscriber holds at most buffer_size events. Publishing never
+    blocks on a subscriber: one whose buffer is full is evicted on the spot,
+    and it can come back and resume from its last event id.
+
+    Hubs in several processes hand out the same ids when they share an
+    epoch and are published the same rows with the same sequence numbers,
+    like the readers of serve.py, so a subscriber can resume on any of them.
+
+    Past max_subscribers, subscribe raises TooManySubscribers.
+    """
+
+    def __init__(self, buffer_size=1000, history=10000, epoch=None, max_subscribers=None):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.epoch = epoch or uuid.uuid4().hex[:8]
+        self.published = 0
+        self.evictions = 0
+        self._sequence = 0
+        self._history = deque(maxlen=history)
+        # device_uuid -> subscriptions to that device
+        self._by_device = {}
+        # Fleet-wide subscriptions
+        self._fleet = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, device_uuid=None, sensor_type=None, devices=None, last_event_id=None):
+        """
+        Subscribe to the readings of one device, or of the fleet when
+        device_uuid is None, optionally restricted to a type and to a list
+        of devices. With a last_event_id, the remembered events after it are
+        replayed first.
+        """
+        subscription = Subscription(self, device_uuid, sensor_type, devices)
+        with self._lock:
+            # Counted under the same lock as it is added, so concurrent
+            # subscribers can never take the hub past the limit
+            if self.max_subscribers is not None and self._subscribers() >= self.max_subscribers:
+                raise TooManySubscribers('{} subscribers already'.format(self.max_subscribers))
+
+            if last_event_id is not None:
+                after = self._sequence_of(last_event_id)
+                # The history has to reach back to the event right after it
+                oldest = self._history[0][0] if self._history else self._sequence + 1
+                if after is None or after > self._sequence or after < oldest - 1:
+                    subscription.reset = True
+                else:
+                    replay = [(self._event_id(sequence), row) for sequence, row in self._history
+                              if sequence > after and subscription.matches(row)]
+                    if len(replay) > self.buffer_size:
+                        subscription.reset = True
+                        replay = replay[-self.buffer_size:]
+                    subscription._events.extend(replay)
+
+            if device_uuid is None:
+                self._fleet.add(subscription)
+            else:
+                self._by_device.setdefault(device_uuid, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._remove(subscription)
+            subscription.closed = True
+            subscription._ready.notify_all()
+
+    def close(self):
+        """
+        Close every subscription, so their streams end, e.g. on shutdown.
+        """
+        with self._lock:
+            subscriptions = [*self._fleet, *(s for device in self._by_device.values() for s in device)]
+        for subscription in subscriptions:
+            subscription.close()
+
+    def publish(self, rows, sequence=None):
+        """
+        Fan the committed (device_uuid, type, value, date_created) rows out
+        to the subscribers they match. sequence numbers the first of the
+        rows when they are numbered by someone else, otherwise they follow
+        on from the last ones published.
+        """
+        with self._lock:
+            if sequence is not None:
+                if sequence != self._sequence + 1:
+                    # Some rows never got here, nobody can resume across them
+                    self._history.clear()
+                self._sequence = sequence - 1
+
+            woken = set()
+            for row in rows:
+                self._sequence += 1
+                self._history.append((self._sequence, row))
+                self.published += 1
+
+                # Copied, evicting one removes it from its set
+                for subscription in [*self._by_device.get(row[0], ()), *self._fleet]:
+                    if subscription.evicted or not subscription.matches(row):
+                        continue
+                    if len(subscription._events) >= self.buffer_size:
+                        # Too slow to keep up, it can resume from the history
+                        subscription.evicted = True
+                        self._remove(subscription)
+                        self.evictions += 1
+                    else:
+                        subscription._events.append((self._event_id(self._sequence), row))
+                    woken.add(subscription)
+
+            for subscription in woken:
+                subscription._ready.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                subscribers=self._subscribers(),
+                published=self.published,
+                evictions=self.evictions,
+            )
+
+    def _subscribers(self):
+        return len(self._fleet) + sum(len(s) for s in self._by_device.values())
+
+    def _remove(self, subscription):
+        if subscription.device_uuid is None:
+            self._fleet.discard(subscription)
+        else:
+            subscriptions = self._by_device.get(subscription.device_uuid)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._by_device[subscription.device_uuid]
+
+    def _event_id(self, sequence):
+        return '{}-{}'.format(self.epoch, sequence)
+
+    def _sequence_of(self, event_id):
+        # The sequence number of one of our event ids, None for anything else
+        epoch, _, sequence = event_id.partition('-')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+
+def sse_chunks(subscription, heartbeat=15, retry=1000):
+    """
+    Encode a subscription's events as a text/event-stream, one reading per
+    event, for as long as the subscription lasts. A comment is sent after
+    heartbeat seconds without events, so dead connections are noticed.
+    The subscription is closed when the stream is.
+    """
+    try:
+        yield 'retry: {}\n\n'.format(retry)
+        if subscription.reset:
+            yield 'event: reset\ndata: {}\n\n'
+
+        while True:
+            events = subscription.get(heartbeat)
+            if events is None:
+                if subscription.evicted:
+                    yield 'event: evicted\ndata: {}\n\n'
+                return
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+
+            yield ''.join('id: {}\nevent: reading\ndata: {}\n\n'.format(event_id, _encode_row(row))
+                          for event_id, row in events)
+    finally:
+        subscription.close()
+
+
+def _encode_row(row):
+    device_uuid, sensor_type, value, date_created = row
+    return json.dumps(dict(device_uuid=device_uuid, type=sensor_type, value=value, date_created=date_created),
+                      sort_keys=True, separators=(',', ':'))
@@ -0,0 +1,309 @@
+import atexit
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from marshmallow import ValidationError
+from db import SENSOR_TYPE_IDS, Connection, create_devices, create_partitions, migrate, partition_start, partition_table, \
+    touch_devices
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonlines', 'application/x-jsonlines')
+
+INSERT_READING = 'insert into {} (device_id,type,value,date_created) VALUES (?,?,?,?)'
+
+
+def parse_readings_body(body, mimetype):
+    """
+    Parse a POSTed readings payload.
+
+    The body may be a single JSON object, a JSON array of objects, or NDJSON
+    (one object per line). Returns (items, many), where many is False only
+    for a single JSON object so callers can keep the original response for it.
+    Lines of an NDJSON body that are not valid JSON are returned as None and
+    reported as per-item errors by validate_readings. Any other body that is
+    not valid JSON raises ValueError.
+    """
+    if mimetype in NDJSON_MIMETYPES:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items, True
+
+    data = json.loads(body)
+    if isinstance(data, list):
+        return data, True
+
+    return [data], False
+
+
+def validate_readings(schema, items, device_uuid=None):
+    """
+    Validate a batch of readings with a FastSchema, so readings without a
+    date_created are all stamped with the same time.
+
+    Returns (rows, errors) where rows are (device_uuid, type, value, date_created)
+    tuples ready to insert and errors maps the index of each rejected item to
+    its validation messages. When device_uuid is given it is used for every
+    row, otherwise each item must carry its own.
+    """
+    rows = []
+    errors = {}
+    for index, data in enumerate(schema.load_many(items)):
+        if isinstance(data, ValidationError):
+            errors[index] = data.messages
+            continue
+
+        rows.append((device_uuid or data['device_uuid'], data['type'], data['value'], data['date_created']))
+
+    return rows, errors
+
+
+def insert_readings(conn, rows):
+    """
+    Insert the rows with one executemany per time partition inside a single
+    transaction, so a batch costs one commit no matter how many readings it
+    holds. Partitions the rows fall into, and devices that are new, are
+    created first if need be.
+
+    The rows are (device_uuid, type, value, date_created) tuples, and are
+    stored with the device and type encoded as their ids. The version of
+    every device written to is bumped in the same transaction, and logged
+    with the range of dates written to each of its types. Returns the
+    versions the write committed, as {device_uuid: (device_id, version)}.
+    """
+    device_ids = create_devices(conn, {row[0] for row in rows})
+
+    partitioned = defaultdict(list)
+    writes = {}
+    for device_uuid, sensor_type, value, date_created in rows:
+        row = (device_ids[device_uuid], SENSOR_TYPE_IDS[sensor_type], value, date_created)
+        partitioned[partition_start(date_created)].append(row)
+        low, high = writes.get(row[:2], (date_created, date_created))
+        writes[row[:2]] = (min(low, date_created), max(high, date_created))
+
+    create_partitions(conn, partitioned)
+    with conn:
+        for first, partition_rows in partitioned.items():
+            conn.executemany(INSERT_READING.format(partition_table(first)), partition_rows)
+        versions = touch_devices(conn, set(device_ids.values()), writes)
+    return {device_uuid: (device, versions[device]) for device_uuid, device in device_ids.items()}
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestTicket(object):
+    """
+    Handed back for every batch put on an IngestQueue. wait() blocks until
+    the group commit holding the batch has finished, and re-raises the
+    error if that commit failed.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.error = None
+        self._committed = threading.Event()
+
+    def wait(self, timeout=None):
+        if not self._committed.wait(timeout):
+            raise TimeoutError('Timed out waiting for the readings to be committed')
+        if self.error is not None:
+            raise self.error
+
+    def _done(self, error=None):
+        self.error = error
+        self._committed.set()
+
+
+class IngestQueue(object):
+    """
+    Write-behind ingest: validated rows are put on a bounded in-process
+    queue and a single writer thread drains it in group commits on a
+    WAL-mode connection, so concurrent requests never contend for the
+    database write lock.
+
+    A group commit is written once batch_size rows are pending, or
+    flush_interval seconds after the first pending batch arrived, whichever
+    comes first. maxsize bounds the number of pending batches. on_commit, if
+    given, is called from the writer thread with the rows of every group
+    commit once it has succeeded, and the versions it left their devices at
+    (see insert_readings).
+    """
+
+    def __init__(self, path, maxsize=10000, batch_size=1000, flush_interval=0.05, on_commit=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_commit = on_commit
+        self._queue = queue.Queue(maxsize)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._thread.start()
+
+    def put(self, rows):
+        """
+        Queue rows for the writer without blocking. Raises IngestQueueFull
+        when the queue is at capacity.
+        """
+        with _put_lock:
+            if self._closed:
+                raise IngestQueueFull('The ingest queue is closed')
+
+            ticket = IngestTicket(rows)
+            try:
+                self._queue.put_nowait(ticket)
+            except queue.Full:
+                raise IngestQueueFull('The ingest queue is full')
+
+        return ticket
+
+    def full(self):
+        return self._closed or self._queue.full()
+
+    def flush(self):
+        """
+        Block until everything queued so far has been committed.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Stop accepting rows, drain what is pending and stop the writer.
+        """
+        with _put_lock:
+            if self._closed:
+                return
+            self._closed = True
+        # Outside the lock, the writer may have to make room for it first
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self._drain()
+        except Exception as err:
+            logger.exception('The ingest writer of %s stopped', self.path)
+            error = err
+        else:
+            error = IngestQueueFull('The ingest queue is closed')
+
+        # Nothing will commit what is left, so fail it rather than have its
+        # requests wait on it forever
+        with _put_lock:
+            self._closed = True
+        while True:
+            try:
+                ticket = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if ticket is not None:
+                ticket._done(error)
+            self._queue.task_done()
+
+    def _drain(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=Connection)
+        conn.execute('PRAGMA journal_mode=WAL')
+        migrate(conn)
+
+        stopping = False
+        while not stopping:
+            ticket = self._queue.get()
+            if ticket is None:
+                self._queue.task_done()
+                break
+
+            # Gather a group until it is big enough or the interval has passed
+            tickets = [ticket]
+            pending = len(ticket.rows)
+            deadline = time.monotonic() + self.flush_interval
+            while pending < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    ticket = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if ticket is None:
+                    stopping = True
+                    self._queue.task_done()
+                    break
+                tickets.append(ticket)
+                pending += len(ticket.rows)
+
+            self._commit(conn, tickets)
+
+        conn.close()
+
+    def _commit(self, conn, tickets):
+        error = None
+        rows = [row for ticket in tickets for row in ticket.rows]
+        try:
+            versions = insert_readings(conn, rows)
+        except Exception as err:
+            logger.exception('Failed to commit %d queued readings batches', len(tickets))
+            error = err
+
+        if error is None and self.on_commit is not None:
+            try:
+                self.on_commit(rows, versions)
+            except Exception:
+                logger.exception('on_commit failed for %d readings', len(rows))
+
+        for ticket in tickets:
+            ticket._done(error)
+            self._queue.task_done()
+
+
+# Held while rows are put on a queue, and while put_batches checks every
+# queue of a batch and puts its rows on them, so no other put can take the
+# room it found in between. Reentrant, as put_batches calls put.
+_put_lock = threading.RLock()
+
+
+def put_batches(batches):
+    """
+    Put the rows of {IngestQueue: rows} on every queue at once, returning
+    their tickets. Raises IngestQueueFull, with nothing queued, when any of
+    the queues is full or closed, so a batch is never half queued.
+    """
+    with _put_lock:
+        if any(ingest_queue.full() for ingest_queue in batches):
+            raise IngestQueueFull('The ingest queue is full')
+        return [ingest_queue.put(rows) for ingest_queue, rows in batches.items()]
+
+
+_ingest_queues = {}
+_ingest_queues_lock = threading.Lock()
+
+
+def get_ingest_queue(path, **options):
+    """
+    Return the process wide IngestQueue writing to path, starting it on
+    first use with the given options.
+    """
+    with _ingest_queues_lock:
+        if path not in _ingest_queues:
+            _ingest_queues[path] = IngestQueue(path, **options)
+        return _ingest_queues[path]
+
+
+@atexit.register
+def close_ingest_queues():
+    """
+    Drain and stop every ingest queue, so pending readings are not lost on
+    shutdown.
+    """
+    with _ingest_queues_lock:
+        while _ingest_queues:
+            _, ingest_queue = _ingest_queues.popitem()
+            ingest_queue.close()
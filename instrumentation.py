@@ -0,0 +1,296 @@
+import bisect
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from db import Connection
+
+PHASES = ['validation', 'sql', 'materialization', 'serialization']
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_local = threading.local()
+
+
+class PhaseTimer(object):
+    """
+    Split the time of a request between the phases it goes through.
+
+    Phases nest, and the time spent in an inner phase is taken out of the
+    one around it, so every moment counts towards a single phase: the SQL
+    run while the results are being built counts as sql, not as
+    materialization. Time outside any phase is not counted.
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.started = time.perf_counter()
+        self.totals = defaultdict(float)
+        self._stack = []
+        self._since = self.started
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self._stack:
+            self.totals[self._stack[-1]] += now - self._since
+        self._stack.append(phase)
+        self._since = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self.totals[self._stack.pop()] += now - self._since
+        self._since = now
+
+
+def start_request(labels):
+    _local.timer = PhaseTimer(labels)
+    return _local.timer
+
+
+def finish_request(timer):
+    # Another request may have started on this thread while the response of
+    # this one was still open
+    if current_timer() is timer:
+        _local.timer = None
+
+
+def current_timer():
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def timed(phase):
+    """
+    Count the time spent in the block towards phase of the current request.
+    """
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+
+    timer.enter(phase)
+    try:
+        yield
+    finally:
+        timer.exit()
+
+
+def timed_iter(phase, items):
+    """
+    Count the time spent producing each of items towards phase of the
+    current request, for generators consumed while a response streams.
+    """
+    items = iter(items)
+    while True:
+        with timed(phase):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+
+class TimingHistogram(object):
+    """
+    Prometheus histogram of durations in seconds, by label values.
+    """
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket, +Inf included], sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, values, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((values, list(counts), total) for values, (counts, total) in self._series.items())
+
+        for values, counts, total in series:
+            labels = list(zip(self.labels, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(_sample(self.name + '_bucket', labels + [('le', str(bound))], cumulative))
+            lines.append(_sample(self.name + '_sum', labels, total))
+            lines.append(_sample(self.name + '_count', labels, cumulative))
+        return lines
+
+
+class SlowQueryLog(object):
+    """
+    Count the statements that take longer than threshold seconds, by SQL
+    with the partition tables folded together, and keep the EXPLAIN QUERY
+    PLAN of each. A statement is explained again at most every
+    explain_interval seconds, and only the max_queries most recently slow
+    statements are kept.
+    """
+
+    def __init__(self, threshold, explain_interval=60, max_queries=100):
+        self.threshold = threshold
+        self.explain_interval = explain_interval
+        self.max_queries = max_queries
+        # query -> [count, total seconds, plan, explained at]
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, conn, sql, parameters, seconds):
+        query = _normalize(sql)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._queries.get(query)
+            if entry is None:
+                entry = self._queries[query] = [0, 0.0, None, None]
+            self._queries.move_to_end(query)
+            entry[0] += 1
+            entry[1] += seconds
+            explain = entry[3] is None or now - entry[3] >= self.explain_interval
+            if explain:
+                entry[3] = now
+
+            while len(self._queries) > self.max_queries:
+                self._queries.popitem(last=False)
+
+        if explain:
+            # Straight through sqlite3.Connection, this is not a query to time
+            plan = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+            # Every partition is planned alike, keep each step once
+            entry[2] = '; '.join(OrderedDict.fromkeys(_normalize(row[3]) for row in plan))
+
+    def render(self):
+        name = 'canary_slow_queries'
+        lines = ['# HELP {}_total Statements slower than {}s, with their latest plan'.format(name, self.threshold),
+                 '# TYPE {}_total counter'.format(name)]
+        with self._lock:
+            queries = [(query, list(entry)) for query, entry in self._queries.items()]
+
+        for query, (count, total, plan, _) in queries:
+            lines.append(_sample(name + '_total', [('query', query), ('plan', plan or '')], count))
+        lines += ['# HELP {}_seconds_total Time spent in statements slower than {}s'.format(name, self.threshold),
+                  '# TYPE {}_seconds_total counter'.format(name)]
+        for query, (count, total, plan, _) in queries:
+            lines.append(_sample(name + '_seconds_total', [('query', query)], total))
+        return lines
+
+
+class InstrumentedConnection(Connection):
+    """
+    Connection whose statements count towards the sql phase of the current
+    request, and are handed to the slow query log when they run long.
+    """
+
+    def execute(self, sql, parameters=()):
+        return self.cursor(InstrumentedCursor).execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor(InstrumentedCursor).executemany(sql, parameters)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor timing its execution and every fetch. SQLite runs a query as its
+    rows are stepped through, so a statement's time is the sum of them all.
+    """
+
+    def execute(self, sql, parameters=()):
+        self._statement = (sql, parameters)
+        self._seconds = 0.0
+        self._timed(super().execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, parameters):
+        # Never logged, there is no single set of parameters to plan with
+        self._statement = None
+        self._seconds = 0.0
+        self._timed(super().executemany, sql, parameters)
+        return self
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(super().fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def _timed(self, fn, *args, **kwargs):
+        timer = current_timer()
+        if timer is not None:
+            timer.enter('sql')
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            if timer is not None:
+                timer.exit()
+
+            # Logged once, when the statement's time first reaches the threshold
+            self._seconds += seconds
+            slow_queries = _slow_queries
+            if self._statement is not None and slow_queries is not None and self._seconds >= slow_queries.threshold:
+                statement, self._statement = self._statement, None
+                slow_queries.record(self.connection, statement[0], statement[1], self._seconds)
+
+
+_slow_queries = None
+
+
+def configure(slow_query_threshold, explain_interval=60):
+    """
+    Set up the slow query log shared by every InstrumentedConnection, None
+    turns it off.
+    """
+    global _slow_queries
+    if slow_query_threshold is None:
+        _slow_queries = None
+    else:
+        _slow_queries = SlowQueryLog(slow_query_threshold, explain_interval)
+
+
+def get_slow_queries():
+    return _slow_queries
+
+
+def render_samples(name, kind, help, samples):
+    """
+    Render a metric of the given kind, gauge or counter, with a sample per
+    (labels, value) in samples.
+    """
+    lines = ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind)]
+    for labels, value in samples:
+        lines.append(_sample(name, labels, value))
+    return lines
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(label, _escape(str(v))) for label, v in labels) + '}'
+    return '{} {}'.format(name, repr(float(value)) if isinstance(value, float) else value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _normalize(sql):
+    return re.sub(r'\s+', ' ', re.sub(r'"?readings_-?\d+"?', 'readings_*', sql)).strip()
@@ -0,0 +1,221 @@
+import threading
+from array import array
+from db import SENSOR_TYPE_IDS, device_versions, find_devices, partition_start, partition_table
+from schemas import SENSOR_TYPES
+
+# Stands in for the value of a (device, type) known to have no readings at
+# the version of its device, values are 0-100
+_NO_READING = -1
+
+
+class LatestIndex(object):
+    """
+    The latest reading of every device and type in one database, by
+    date_created then by when it was written.
+
+    Each type has a pair of arrays indexed by device id, one byte for the
+    value and eight for the date, so the index costs 9 bytes per device and
+    type however many readings there are, and a lookup is two array reads. The
+    devices table hands out ids from 1 up, so the arrays stay dense.
+
+    Every device also has the write version (see db.device_version) its
+    slots are current at, a type without readings included. The commits of
+    this process are taken in with update, which moves the version along
+    with them. Any other process or tool changing the readings of a device
+    bumps its version in the same transaction, so lookup reads the versions
+    first and reads a device again only when its version moved without the
+    index: one seek on its daily rollups, and one on the partition holding
+    the last day of each type it has readings of.
+    """
+
+    def __init__(self):
+        self._values = {type_id: array('b') for type_id in SENSOR_TYPE_IDS.values()}
+        self._dates = {type_id: array('q') for type_id in SENSOR_TYPE_IDS.values()}
+        self._versions = array('q')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(sum(1 for value in values if value != _NO_READING) for values in self._values.values())
+
+    def get(self, device, type_id):
+        """
+        Return (value, date_created) of the latest reading of a device id
+        and type id as the index holds it, or None, without checking its
+        version.
+        """
+        values = self._values.get(type_id)
+        # Read both under the lock, so they are never from two different readings
+        with self._lock:
+            if device is None or values is None or device >= len(values) or values[device] == _NO_READING:
+                return None
+            return values[device], self._dates[type_id][device]
+
+    def lookup(self, conn, devices):
+        """
+        Return {device_id: {type_id: (value, date_created)}} of the latest
+        readings of the device ids that have readings, reading those whose
+        version moved since the index last had them again first.
+        """
+        # Read before the readings, so they are never older than the version
+        versions = device_versions(conn, {device for device in devices if device is not None})
+        with self._lock:
+            stale = [device for device, version in versions.items() if self._version(device) != version]
+
+        for device in stale:
+            readings = _query_latest(conn, device)
+            with self._lock:
+                for type_id in SENSOR_TYPE_IDS.values():
+                    self._reset(device, type_id, readings.get(type_id))
+                self._versions[device] = versions[device]
+
+        results = {}
+        with self._lock:
+            for device in versions:
+                results[device] = {}
+                for type_id, values in self._values.items():
+                    if values[device] != _NO_READING:
+                        results[device][type_id] = values[device], self._dates[type_id][device]
+        return results
+
+    def load(self, conn):
+        """
+        Warm the index from the partitions, with one query per partition
+        grouped by device and type.
+
+        The daily rollups tell which day each (device, type) last had a
+        reading, so only the partitions holding one of those days are read,
+        and each (device, type) is only taken from the partition holding its
+        day. Loading can run while readings are written: the versions are
+        read first, so a device written to in the meantime is read again on
+        its next lookup.
+        """
+        versions = dict(conn.execute('SELECT id, version FROM devices').fetchall())
+
+        # (device_id, type) -> first of the partition holding its latest reading
+        latest = {}
+        query = ('select device_id, type, max(bucket) from reading_rollups '
+                 'where resolution = 86400 group by device_id, type')
+        for device, type_id, day in conn.execute(query):
+            latest[device, type_id] = partition_start(day)
+
+        # The latest date of each (device, type) is found in a grouped scan,
+        # then its readings at that date are seeked to for the one written
+        # last. A single max() makes SQLite take the other columns from the
+        # row it picked.
+        query = ('select device_id, type, value, date_created, max(rowid) from {0} '
+                 'where (device_id, type, date_created) in '
+                 '(select device_id, type, max(date_created) from {0} group by device_id, type) '
+                 'group by device_id, type')
+        tables = conn.execute('SELECT first FROM reading_partitions').fetchall()
+        needed = set(latest.values())
+        found = {}
+        for (first,) in tables:
+            if first not in needed:
+                continue
+
+            for device, type_id, value, date_created, _ in conn.execute(query.format(partition_table(first))):
+                if latest.get((device, type_id)) == first:
+                    found[device, type_id] = value, date_created
+
+        with self._lock:
+            for device, version in versions.items():
+                for type_id in SENSOR_TYPE_IDS.values():
+                    self._reset(device, type_id, found.get((device, type_id)))
+                self._versions[device] = version
+
+    def update(self, rows, versions):
+        """
+        Take in the (device_uuid, type, value, date_created) rows of a
+        commit, and the {device_uuid: (device_id, version)} it left their
+        devices at (see insert_readings). A device whose slots were current
+        at the version before is current at the new one, the others are
+        left for lookup to read again.
+        """
+        with self._lock:
+            current = {device_uuid: device for device_uuid, (device, version) in versions.items()
+                       if self._version(device) == version - 1}
+            for device_uuid, sensor_type, value, date_created in rows:
+                device = current.get(device_uuid)
+                if device is None:
+                    continue
+
+                # The rows are in the order they were written, so the last
+                # one wins a tie on the date
+                type_id = SENSOR_TYPE_IDS[sensor_type]
+                if self._values[type_id][device] == _NO_READING or date_created >= self._dates[type_id][device]:
+                    self._reset(device, type_id, (value, date_created))
+            for device_uuid, device in current.items():
+                self._versions[device] = versions[device_uuid][1]
+
+    def _version(self, device):
+        return self._versions[device] if device < len(self._versions) else None
+
+    def _reset(self, device, type_id, reading):
+        values = self._values[type_id]
+        dates = self._dates[type_id]
+        if device >= len(values):
+            # Grow by half again, so the arrays are copied a logarithmic number of times
+            size = max(device + 1, len(values) * 3 // 2)
+            values.extend(array('b', [_NO_READING]) * (size - len(values)))
+            dates.extend(array('q', [0]) * (size - len(dates)))
+            if size > len(self._versions):
+                self._versions.extend(array('q', [-1]) * (size - len(self._versions)))
+
+        values[device], dates[device] = reading if reading is not None else (_NO_READING, 0)
+
+
+def latest_readings(conn, device_uuid, sensor_type=None, index=None):
+    """
+    Return {type: (value, date_created)} of the latest reading of each type
+    of a device, from the index when there is one, otherwise seeking to the
+    end of the device's index range in the newest partitions.
+    """
+    return batch_latest_readings(conn, [device_uuid], sensor_type, index)[device_uuid]
+
+
+def batch_latest_readings(conn, device_uuids, sensor_type=None, index=None):
+    """
+    Return {device_uuid: {type: (value, date_created)}} for many devices,
+    like latest_readings, looking their ids up in chunks first.
+    """
+    ids = find_devices(conn, device_uuids)
+    types = [sensor_type] if sensor_type else SENSOR_TYPES
+    type_ids = [SENSOR_TYPE_IDS[name] for name in types]
+    if index is not None:
+        indexed = index.lookup(conn, set(ids.values()))
+
+    results = {}
+    for device_uuid in device_uuids:
+        device = ids.get(device_uuid)
+        if device is None:
+            readings = {}
+        elif index is not None:
+            readings = indexed.get(device, {})
+        else:
+            readings = _query_latest(conn, device, type_ids)
+        results[device_uuid] = {name: readings[SENSOR_TYPE_IDS[name]] for name in types
+                                if SENSOR_TYPE_IDS[name] in readings}
+    return results
+
+
+def _query_latest(conn, device, type_ids=None):
+    # {type_id: (value, date_created)} of the latest readings of a device.
+    # The daily rollups give the last day of each type it has readings of,
+    # so only the partition holding that day is read, the one written last
+    # winning a tie. Rollups kept for expired partitions point nowhere.
+    days = ('select type, max(bucket) from reading_rollups where device_id = ? and resolution = 86400 '
+            'group by type')
+    query = ('select value, date_created from {} where device_id = ? and type = ? '
+             'order by date_created desc, rowid desc limit 1')
+    firsts = {first for (first,) in conn.execute('SELECT first FROM reading_partitions')}
+    latest = {}
+    for type_id, day in conn.execute(days, (device,)).fetchall():
+        first = partition_start(day)
+        if (type_ids is not None and type_id not in type_ids) or first not in firsts:
+            continue
+
+        row = conn.execute(query.format(partition_table(first)), (device, type_id)).fetchone()
+        if row is not None:
+            latest[type_id] = tuple(row)
+    return latest
@@ -0,0 +1,65 @@
+import argparse
+import sqlite3
+import time
+from db import PARTITION_SIZE, ROLLUP_RESOLUTIONS, drop_partitions, migrate
+from shards import shard_paths
+
+_HISTOGRAM_DELETE = 'DELETE FROM reading_histograms WHERE bucket < ?'
+_ROLLUP_DELETE = 'DELETE FROM reading_rollups WHERE resolution = ? AND bucket < ?'
+
+
+def expire_partitions(conn, before, downsample=True):
+    """
+    Drop every partition whose readings are all older than before.
+
+    A partition is dropped as a whole table, so there is no per-row work
+    on the readings and writers are only held up for as long as the DROP TABLE takes. With
+    downsample, the minute, hour and day rollups and the hourly histograms
+    the triggers kept for the expired readings stay behind, and the metric
+    and fleet endpoints keep answering over the expired period from them.
+    Otherwise those are deleted as well. Returns the start of every
+    partition dropped.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        query = 'select first from reading_partitions where first <= ? order by first'
+        expired = [first for (first,) in conn.execute(query, (before - PARTITION_SIZE,))]
+        drop_partitions(conn, expired)
+
+        if expired and not downsample:
+            # The aggregates are not partitioned, so unlike the readings
+            # they are removed with a DELETE, a range seek on their bucket
+            # indexes covering only the expired rows
+            end = expired[-1] + PARTITION_SIZE
+            conn.execute(_HISTOGRAM_DELETE, (end,))
+            for resolution in ROLLUP_RESOLUTIONS:
+                conn.execute(_ROLLUP_DELETE, (resolution, end))
+
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+    return expired
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drop the partitions of readings older than the retention period.')
+    parser.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    parser.add_argument('--shards', type=int, default=1, help='Number of shards (default: %(default)s)')
+    parser.add_argument('--keep-days', type=int, required=True, help='Days of raw readings to keep')
+    parser.add_argument('--no-downsample', dest='downsample', action='store_false',
+                        help='Delete the rollups and histograms of the expired readings too')
+    args = parser.parse_args(argv)
+
+    before = int(time.time()) - args.keep_days * 86400
+    for path in shard_paths(args.db, args.shards):
+        conn = sqlite3.connect(path)
+        migrate(conn)
+        expired = expire_partitions(conn, before, args.downsample)
+        conn.close()
+        print('{}: dropped {} partitions'.format(path, len(expired)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import heapq
+import json
+from db import SENSOR_TYPE_IDS, device_id, device_uuids, partitions, sensor_type_names
+from schemas import SENSOR_TYPES
+
+COLUMNS = ['device_uuid', 'type', 'value', 'date_created']
+
+
+def iter_readings(conn, device_uuid, sensor_type=None, start=None, end=None, after=None, batch_size=1000):
+    """
+    Yield a device's readings as (rowid, device_uuid, type, value, date_created)
+    tuples in (date_created, rowid) order, straight off the cursor.
+
+    after is a (date_created, rowid) keyset cursor, only readings that come
+    after it are returned. Without a sensor_type, each type is read along
+    its own index range and the streams are merged, so the rows are never
+    sorted or held in memory as a whole.
+    """
+    types = [sensor_type] if sensor_type else SENSOR_TYPES
+    device = device_id(conn, device_uuid)
+    streams = [_iter_type(conn, device_uuid, device, t, start, end, after, batch_size) for t in types]
+    if len(streams) == 1:
+        return streams[0]
+
+    return heapq.merge(*streams, key=lambda row: (row[4], row[0]))
+
+
+def iter_fleet_readings(conn, sensor_type=None, start=None, end=None, batch_size=1000):
+    """
+    Yield every device's readings as (rowid, device_uuid, type, value, date_created)
+    tuples, in storage order.
+
+    This is a bulk export, so rather than seeking device by device it reads
+    the partitions overlapping the window sequentially and filters on the way.
+    The devices and types are decoded from maps of them all, read up front.
+    """
+    conditions = []
+    params = []
+    if sensor_type:
+        conditions.append('type = ?')
+        params.append(SENSOR_TYPE_IDS.get(sensor_type))
+    if start is not None:
+        conditions.append('date_created >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('date_created < ?')
+        params.append(end)
+
+    query = 'select rowid, device_id, type, value, date_created from {}'
+    if conditions:
+        query += ' where ' + ' and '.join(conditions)
+
+    uuids = device_uuids(conn)
+    names = sensor_type_names(conn)
+    for table in partitions(conn, start, end):
+        for rowid, device, type_id, value, date_created in _iter_cursor(conn.execute(query.format(table), params),
+                                                                        batch_size):
+            yield rowid, uuids[device], names[type_id], value, date_created
+
+
+def json_chunks(rows, batch_size=500):
+    """
+    Encode the rows as a JSON array of reading dicts, a batch at a time.
+    """
+    yield '['
+    separator = ''
+    for batch in batched(rows, batch_size):
+        yield separator + ','.join(_encode_row(row) for row in batch)
+        separator = ','
+    yield ']\n'
+
+
+def ndjson_chunks(rows, batch_size=500):
+    """
+    Encode the rows as NDJSON, one reading dict per line, a batch at a time.
+    """
+    for batch in batched(rows, batch_size):
+        yield ''.join(_encode_row(row) + '\n' for row in batch)
+
+
+def _iter_type(conn, device_uuid, device, sensor_type, start, end, after, batch_size):
+    query = 'select rowid, value, date_created from {} where device_id = ? and type = ?'
+    params = [device, SENSOR_TYPE_IDS.get(sensor_type)]
+    if start is not None:
+        query += ' and date_created >= ?'
+        params.append(start)
+    if end is not None:
+        query += ' and date_created < ?'
+        params.append(end)
+    if after is not None:
+        # Seek to the cursor's date, then skip what was already returned for it
+        query += ' and date_created >= ? and (date_created > ? or rowid > ?)'
+        params += [after[0], after[0], after[1]]
+    query += ' order by date_created, rowid'
+
+    # The partitions hold consecutive ranges of dates, so reading them oldest
+    # first keeps the rows in order. A date lives in a single partition, so
+    # (date_created, rowid) is still unique across them.
+    if after is not None and (start is None or after[0] > start):
+        start = after[0]
+    for table in partitions(conn, start, end):
+        for rowid, value, date_created in _iter_cursor(conn.execute(query.format(table), params), batch_size):
+            yield rowid, device_uuid, sensor_type, value, date_created
+
+
+def batched(rows, batch_size):
+    """
+    Group the rows into lists of up to batch_size rows.
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_cursor(cur, batch_size):
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def _encode_row(row):
+    return json.dumps(dict(zip(COLUMNS, row[1:])), sort_keys=True, separators=(',', ':'))
+
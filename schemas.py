@@ -1,28 +1,382 @@
-import time
-from marshmallow import Schema, fields, validate
-
-SENSOR_TYPES = ['temperature', 'humidity']
-
-
-class DeviceReadingSchema(Schema):
-    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
-    value = fields.Int(required=True, validate=validate.Range(min=0, max=100))
-    date_created = fields.Int(missing=int(time.time()))
-
-
-class DeviceReadingInputSchema(Schema):
-    type = fields.Str(missing=None, validate=validate.OneOf(SENSOR_TYPES))
-    start = fields.Int(missing=None)
-    end = fields.Int(missing=None)
-
-
-class DeviceReadingValueInputSchema(Schema):
-    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
-    start = fields.Int(missing=None)
-    end = fields.Int(missing=None)
-
-
-class DeviceReadingQuartilesInputSchema(Schema):
-    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
-    start = fields.Int(required=True)
-    end = fields.Int(required=True)
+import base64
+import math
+import time
+from collections.abc import Mapping
+from marshmallow import RAISE, Schema, ValidationError, fields, missing, post_load, validate, validates, \
+    validates_schema
+
+SENSOR_TYPES = ['temperature', 'humidity']
+
+METRICS = ['min', 'max', 'median', 'mean', 'mode', 'quartiles']
+
+SERIES_METHODS = ['buckets', 'lttb']
+
+# Widths in seconds of the reading_rollups buckets, coarsest first. Baked
+# into the triggers of db.py, and the widths a series interval is rounded up
+# to a multiple of so it is added up from them
+ROLLUP_RESOLUTIONS = (86400, 3600, 60)
+
+# Most points a series can be asked for, and how many it gets by default
+MAX_SERIES_POINTS = 2000
+DEFAULT_SERIES_POINTS = 300
+
+# Most devices a batch stats request can ask for
+MAX_BATCH_DEVICES = 10000
+
+# Readings are dated in epoch seconds within MAX_DATE of the epoch, about
+# 70000 years either way. The grouped min and max queries pack a value and
+# its date into one integer that relies on it (see db._PACKING), and it
+# turns dates sent in milliseconds or microseconds away
+MAX_DATE = 2 ** 41 - 1
+
+
+def now():
+    return int(time.time())
+
+
+class DeviceReadingSchema(Schema):
+    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
+    value = fields.Int(required=True, validate=validate.Range(min=0, max=100))
+    # Stamped when the reading is loaded, not when the module is imported
+    date_created = fields.Int(missing=now, validate=validate.Range(min=-MAX_DATE, max=MAX_DATE,
+                                                                   error='Must be in epoch seconds.'))
+
+
+def encode_cursor(date_created, rowid):
+    return base64.urlsafe_b64encode('{}:{}'.format(date_created, rowid).encode()).decode().rstrip('=')
+
+
+class Cursor(fields.Field):
+    """
+    Opaque keyset pagination cursor, deserialized to (date_created, rowid).
+    """
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            decoded = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+            date_created, rowid = decoded.split(':')
+            return int(date_created), int(rowid)
+        except (TypeError, ValueError):
+            raise ValidationError('Invalid cursor.')
+
+
+class DeviceReadingInputSchema(Schema):
+    type = fields.Str(missing=None, validate=validate.OneOf(SENSOR_TYPES))
+    start = fields.Int(missing=None)
+    end = fields.Int(missing=None)
+    limit = fields.Int(missing=None, validate=validate.Range(min=1, max=10000))
+    cursor = Cursor(missing=None)
+
+
+class DeviceReadingValueInputSchema(Schema):
+    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
+    start = fields.Int(missing=None)
+    end = fields.Int(missing=None)
+
+
+class DeviceReadingQuartilesInputSchema(Schema):
+    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
+    start = fields.Int(required=True)
+    end = fields.Int(required=True)
+
+
+class DeviceReadingBulkSchema(DeviceReadingSchema):
+    device_uuid = fields.Str(required=True, validate=validate.Length(min=1))
+
+
+class DeviceReadingPercentileInputSchema(DeviceReadingValueInputSchema):
+    p = fields.Float(required=True, validate=validate.Range(min=0, max=100))
+
+
+class DeviceReadingStatsInputSchema(DeviceReadingValueInputSchema):
+    metrics = fields.Str()
+
+    @validates('metrics')
+    def validate_metrics(self, value):
+        unknown = [metric for metric in value.split(',') if metric not in METRICS]
+        if unknown:
+            raise ValidationError('Unknown metrics: {}. Must be some of: {}.'.format(', '.join(unknown), ', '.join(METRICS)))
+
+    @post_load
+    def split_metrics(self, data, **kwargs):
+        data['metrics'] = data['metrics'].split(',') if 'metrics' in data else METRICS
+        return data
+
+
+class DeviceReadingSeriesInputSchema(DeviceReadingQuartilesInputSchema):
+    interval = fields.Int(validate=validate.Range(min=1))
+    points = fields.Int(validate=validate.Range(min=1, max=MAX_SERIES_POINTS))
+    method = fields.Str(missing='buckets', validate=validate.OneOf(SERIES_METHODS))
+
+    @validates_schema
+    def validate_window(self, data, **kwargs):
+        if data['end'] <= data['start']:
+            raise ValidationError('Must be after start.', 'end')
+        if 'interval' in data and 'points' in data:
+            raise ValidationError('Give either an interval or points, not both.', 'interval')
+        if 'interval' in data and -(-(data['end'] - data['start']) // data['interval']) > MAX_SERIES_POINTS:
+            raise ValidationError('Too many points, the interval must be at least {} for this window.'.format(
+                -(-(data['end'] - data['start']) // MAX_SERIES_POINTS)), 'interval')
+
+    @post_load
+    def resolve_interval(self, data, **kwargs):
+        # Points are turned into the interval that gives at most that many,
+        # rounded up to whole days, hours or minutes when it is that long,
+        # so the buckets are added up from the rollups
+        if 'interval' not in data:
+            interval = -(-(data['end'] - data['start']) // data.pop('points', DEFAULT_SERIES_POINTS))
+            for resolution in ROLLUP_RESOLUTIONS:
+                if interval >= resolution:
+                    interval = -(-interval // resolution) * resolution
+                    break
+            data['interval'] = interval
+        data.pop('points', None)
+        return data
+
+
+class BatchStatsInputSchema(Schema):
+    devices = fields.List(fields.Str(validate=validate.Length(min=1)), required=True,
+                          validate=validate.Length(min=1, max=MAX_BATCH_DEVICES))
+    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
+    start = fields.Int(missing=None)
+    end = fields.Int(missing=None)
+    metrics = fields.List(fields.Str(validate=validate.OneOf(METRICS)), missing=METRICS,
+                          validate=validate.Length(min=1))
+
+
+class DeviceReadingStreamInputSchema(Schema):
+    type = fields.Str(missing=None, validate=validate.OneOf(SENSOR_TYPES))
+    # EventSource sends it as a Last-Event-ID header when it reconnects, this
+    # lets clients pass it on the first connection
+    last_event_id = fields.Str(missing=None)
+
+
+class FleetStreamInputSchema(DeviceReadingStreamInputSchema):
+    devices = fields.Str()
+
+    @post_load
+    def split_devices(self, data, **kwargs):
+        data['devices'] = data['devices'].split(',') if 'devices' in data else None
+        return data
+
+
+class DeviceReadingLatestInputSchema(Schema):
+    type = fields.Str(missing=None, validate=validate.OneOf(SENSOR_TYPES))
+
+
+class BatchLatestInputSchema(DeviceReadingLatestInputSchema):
+    devices = fields.List(fields.Str(validate=validate.Length(min=1)), required=True,
+                          validate=validate.Length(min=1, max=MAX_BATCH_DEVICES))
+
+
+class ReadingExportInputSchema(Schema):
+    type = fields.Str(missing=None, validate=validate.OneOf(SENSOR_TYPES))
+    start = fields.Int(missing=None)
+    end = fields.Int(missing=None)
+
+
+class FleetStatsInputSchema(Schema):
+    type = fields.Str(required=True, validate=validate.OneOf(SENSOR_TYPES))
+    start = fields.Int(missing=None)
+    end = fields.Int(missing=None)
+    devices = fields.Str()
+    percentiles = fields.Str()
+
+    @validates('percentiles')
+    def validate_percentiles(self, value):
+        try:
+            percentiles = [float(p) for p in value.split(',')]
+        except ValueError:
+            raise ValidationError('Percentiles must be comma separated numbers.')
+        if not all(0 <= p <= 100 for p in percentiles):
+            raise ValidationError('Percentiles must be between 0 and 100.')
+
+    @post_load
+    def split_lists(self, data, **kwargs):
+        data['devices'] = data['devices'].split(',') if 'devices' in data else None
+        data['percentiles'] = [float(p) for p in data['percentiles'].split(',')] if 'percentiles' in data else [50, 95, 99]
+        return data
+
+
+class _Irregular(Exception):
+    # Raised by the fast path of FastSchema for anything it does not handle
+    pass
+
+
+class FastSchema(object):
+    """
+    Precompiled loader for a flat schema of Str, Int and Float fields.
+
+    The fields and validators of the schema are turned into a few type
+    checks and comparisons per field once, up front, and well-formed input
+    is loaded with those alone. Anything irregular, whether invalid, of an
+    unexpected type, or for a field or validator it does not know, is handed
+    to the schema's own load instead, so errors and edge-case conversions
+    are exactly marshmallow's. Schemas with hooks always go through
+    marshmallow.
+
+    Callable defaults are called once per load_many, so every reading of a
+    batch is stamped with the same date_created.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._fast = schema.unknown == RAISE and not any(schema._hooks.values())
+        self._fields = [_compile_field(name, field) for name, field in schema.load_fields.items()]
+        self._keys = frozenset(field[0] for field in self._fields)
+        self._stamped = [(field[0], field[1], field[4]) for field in self._fields if callable(field[4])]
+
+    def load(self, data):
+        result = self.load_many([data])[0]
+        if isinstance(result, ValidationError):
+            raise result
+        return result
+
+    def load_many(self, items):
+        """
+        Load every item, returning for each either its data or the
+        ValidationError it was rejected with.
+        """
+        defaults = {attribute: default() for _, attribute, default in self._stamped}
+        results = []
+        for item in items:
+            try:
+                if not self._fast:
+                    raise _Irregular()
+                results.append(self._load(item, defaults))
+            except _Irregular:
+                try:
+                    data = self.schema.load(item)
+                except ValidationError as err:
+                    results.append(err)
+                    continue
+
+                # Stamped like the rest of the batch
+                for key, attribute, _ in self._stamped:
+                    if key not in item:
+                        data[attribute] = defaults[attribute]
+                results.append(data)
+
+        return results
+
+    def _load(self, item, defaults):
+        if not isinstance(item, Mapping) or not self._keys.issuperset(item.keys()):
+            raise _Irregular()
+
+        data = {}
+        for key, attribute, parse, check, default, required, allow_none in self._fields:
+            value = item.get(key, missing)
+            if value is missing:
+                if required:
+                    raise _Irregular()
+                if default is not missing:
+                    data[attribute] = defaults[attribute] if callable(default) else default
+            elif value is None:
+                if not allow_none:
+                    raise _Irregular()
+                data[attribute] = None
+            else:
+                value = parse(value)
+                if check is not None and not check(value):
+                    raise _Irregular()
+                data[attribute] = value
+        return data
+
+
+def _compile_field(name, field):
+    # (input key, output attribute, parse, check, default, required, allow_none)
+    kind = type(field)
+    if kind is fields.String:
+        parse = _parse_str
+    elif kind is fields.Integer and not field.strict:
+        parse = _parse_int
+    elif kind is fields.Float and not field.allow_nan:
+        parse = _parse_float
+    else:
+        parse = _parse_with(field, name)
+
+    checks = [_compile_validator(validator) for validator in field.validators]
+    if not checks:
+        check = None
+    elif len(checks) == 1:
+        check = checks[0]
+    else:
+        def check(value):
+            return all(c(value) for c in checks)
+
+    return (field.data_key or name, field.attribute or name, parse, check, field.missing, field.required,
+            field.allow_none)
+
+
+def _compile_validator(validator):
+    kind = type(validator)
+    if kind is validate.OneOf:
+        choices = frozenset(validator.choices)
+        return lambda value: value in choices
+    if kind is validate.Range:
+        low, high = validator.min, validator.max
+        return lambda value: ((low is None or (value >= low if validator.min_inclusive else value > low)) and
+                              (high is None or (value <= high if validator.max_inclusive else value < high)))
+    if kind is validate.Length and validator.equal is None:
+        low, high = validator.min, validator.max
+        return lambda value: (low is None or len(value) >= low) and (high is None or len(value) <= high)
+
+    def check(value):
+        try:
+            return validator(value) is not False
+        except ValidationError:
+            return False
+    return check
+
+
+def _parse_str(value):
+    if type(value) is not str:
+        raise _Irregular()
+    return value
+
+
+def _parse_int(value):
+    kind = type(value)
+    if kind is int:
+        return value
+    if kind is not str:
+        raise _Irregular()
+    try:
+        return int(value)
+    except ValueError:
+        raise _Irregular()
+
+
+def _parse_float(value):
+    kind = type(value)
+    if kind is not float and kind is not int and kind is not str:
+        raise _Irregular()
+    try:
+        value = float(value)
+    except ValueError:
+        raise _Irregular()
+    if not math.isfinite(value):
+        raise _Irregular()
+    return value
+
+
+def _parse_with(field, name):
+    # Any other field deserializes itself, with its validators run again by
+    # the compiled checks
+    def parse(value):
+        try:
+            return field.deserialize(value, name)
+        except ValidationError:
+            raise _Irregular()
+    return parse
+
+
+# Precompiled loaders for the schemas every request goes through
+READING = FastSchema(DeviceReadingSchema())
+READING_BULK = FastSchema(DeviceReadingBulkSchema())
+READING_QUERY = FastSchema(DeviceReadingInputSchema())
+VALUE_QUERY = FastSchema(DeviceReadingValueInputSchema())
+QUARTILES_QUERY = FastSchema(DeviceReadingQuartilesInputSchema())
+PERCENTILE_QUERY = FastSchema(DeviceReadingPercentileInputSchema())
+EXPORT_QUERY = FastSchema(ReadingExportInputSchema())
+LATEST_QUERY = FastSchema(DeviceReadingLatestInputSchema())
@@ -0,0 +1,120 @@
+from db import ROLLUP_RESOLUTIONS, partitions
+from retrieval import iter_readings
+from stats import _bucket_query, _key, cover_range
+
+
+def bucket_series(conn, device_uuid, sensor_type, start, end, interval):
+    """
+    Return the count, min, max and mean of a device's readings of one type
+    in each interval seconds of [start, end), as a list of
+    (bucket, count, min, max, mean) in bucket order. Buckets are aligned on
+    multiples of interval like the rollups, and the ones without readings
+    are left out.
+
+    The rollups whose width divides interval fit in the buckets whole, so
+    the window is covered with the coarsest of them and only the edges
+    narrower than those are read from the raw readings. Every row is read
+    once, straight into the bucket it falls in.
+    """
+    buckets, edges = cover_range(start, end, tuple(r for r in ROLLUP_RESOLUTIONS if interval % r == 0))
+    key = _key(conn, device_uuid, sensor_type)
+
+    # bucket -> [count, total, min, max]
+    series = {}
+
+    def add(date, count, total, low, high):
+        bucket = date - date % interval
+        aggregate = series.get(bucket)
+        if aggregate is None:
+            series[bucket] = [count, total, low, high]
+        else:
+            aggregate[0] += count
+            aggregate[1] += total
+            aggregate[2] = min(aggregate[2], low)
+            aggregate[3] = max(aggregate[3], high)
+
+    for resolution, first, last in buckets:
+        query, params = _bucket_query(
+            'select bucket, count, total, min_value, max_value from reading_rollups '
+            'where device_id = ? and type = ? and resolution = ?',
+            [*key, resolution], first, last)
+
+        for row in conn.execute(query, params):
+            add(*row)
+
+    for edge_start, edge_end in edges:
+        query = ('select date_created, value from {} where device_id = ? and type = ? '
+                 'and date_created >= ? and date_created < ?')
+
+        for table in partitions(conn, edge_start, edge_end):
+            for date_created, value in conn.execute(query.format(table), (*key, edge_start, edge_end)):
+                add(date_created, 1, value, value, value)
+
+    return [(bucket, count, low, high, total / count)
+            for bucket, (count, total, low, high) in sorted(series.items())]
+
+
+def lttb_series(conn, device_uuid, sensor_type, start, end, interval):
+    """
+    Downsample a device's readings of one type in [start, end) to about one
+    (date_created, value) point per interval seconds, keeping the shape of
+    the series with Largest-Triangle-Three-Buckets.
+    """
+    rows = ((row[4], row[3]) for row in iter_readings(conn, device_uuid, sensor_type, start, end))
+    return list(lttb(rows, interval))
+
+
+def lttb(points, interval):
+    """
+    Yield the points of a (date, value) series, in date order, picked with
+    Largest-Triangle-Three-Buckets over buckets of interval seconds.
+
+    The first and last points are always kept. In between, each bucket
+    keeps the point forming the largest triangle with the point kept before
+    it and the average of the next bucket that has points. Buckets are
+    time-based rather than holding an equal number of points, so the series
+    is read in a single pass, holding at most two buckets of points.
+    """
+    points = iter(points)
+    first = next(points, None)
+    if first is None:
+        return
+    yield first
+
+    kept = first
+    current = []
+    upcoming = []
+    upcoming_bucket = None
+    last = None
+    for point in points:
+        if last is not None:
+            bucket = last[0] - last[0] % interval
+            if bucket != upcoming_bucket:
+                # The upcoming bucket is complete, so the current one can be
+                # decided against its average
+                if current:
+                    kept = _largest_triangle(kept, current, _average(upcoming))
+                    yield kept
+                current, upcoming, upcoming_bucket = upcoming, [], bucket
+            upcoming.append(last)
+        last = point
+
+    if last is None:
+        return
+
+    # The last point stands in for the bucket after the final ones
+    if current:
+        kept = _largest_triangle(kept, current, _average(upcoming))
+        yield kept
+    if upcoming:
+        yield _largest_triangle(kept, upcoming, last)
+    yield last
+
+
+def _average(points):
+    return sum(date for date, _ in points) / len(points), sum(value for _, value in points) / len(points)
+
+
+def _largest_triangle(a, candidates, c):
+    # Twice the area of the triangle, the factor does not change the winner
+    return max(candidates, key=lambda b: abs((a[0] - c[0]) * (b[1] - a[1]) - (a[0] - b[0]) * (c[1] - a[1])))
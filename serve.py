@@ -0,0 +1,218 @@
+"""
+Multi-process entry point, run from the repository root:
+
+    python serve.py --workers 4 --port 8000
+
+Starts one writer process and --workers reader processes. The readers all
+accept connections on the same listening socket, each serving requests on
+threads, so reads and metric queries scale with the cores. They never write
+to SQLite themselves: the readings of every POST are validated in the
+reader and sent over a Unix socket to the writer, which group commits them
+on its ingest queues (see writer.py), so there is a single writer per
+database file and the readers never wait on its lock. The databases are in
+WAL mode, so readers see every commit without blocking it. Each commit is
+then sent back to every reader, which feeds its live streams and drops
+the metric cache entries it falls into.
+
+On SIGTERM or SIGINT, the readers stop accepting connections, end the live
+streams and finish the requests they are serving, so every write they took
+is answered. Only then is the writer stopped, once it has committed
+everything it was sent. A reader that dies is restarted. When the writer
+dies, everything is shut down.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import uuid
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+from app import _get_shard_paths, app, close_streams, follow_writer, warm_latest_indexes
+from db import migrate
+from ingest import close_ingest_queues
+from writer import WriterServer
+
+
+def serve(host='127.0.0.1', port=8000, workers=None, drain_timeout=30, config=None, log=sys.stderr):
+    """
+    Serve the app on host and port with a writer process and workers reader
+    processes, one per core by default, until SIGTERM or SIGINT. config
+    updates the app config of every process. Run it on the main thread.
+    """
+    workers = workers or os.cpu_count()
+    config = dict(config or {})
+
+    # Switched to WAL and migrated up front, rather than by every process
+    app.config.update(config)
+    for path in _get_shard_paths():
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        migrate(conn)
+        conn.close()
+
+    stopping = _stop_on_signals(signal.SIGTERM, signal.SIGINT)
+    listener = socket.create_server((host, port), backlog=1024)
+    directory = tempfile.mkdtemp(prefix='canary-')
+    address = os.path.join(directory, 'writer.sock')
+    authkey = os.urandom(32)
+
+    # Spawned rather than forked, like the fleet pool
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    writer = context.Process(target=_run_writer, args=(address, authkey, config, ready), name='canary-writer')
+    writer.start()
+
+    # Every reader numbers the live stream events the same way, so a client
+    # can resume on any of them
+    reader_config = dict(config, WRITER_ADDRESS=address, WRITER_AUTHKEY=authkey, STREAM_EPOCH=uuid.uuid4().hex[:8])
+
+    def start_reader(index):
+        reader = context.Process(target=_run_reader, args=(listener, reader_config, drain_timeout),
+                                 name='canary-reader-{}'.format(index))
+        reader.start()
+        return reader
+
+    readers = []
+    try:
+        while not ready.wait(0.1):
+            if stopping.is_set():
+                return
+            if not writer.is_alive():
+                raise RuntimeError('The writer process exited with {} on startup'.format(writer.exitcode))
+        readers = [start_reader(index) for index in range(workers)]
+        print('Serving on http://{}:{} with {} readers and a writer'.format(*listener.getsockname()[:2], workers),
+              file=log, flush=True)
+
+        while not stopping.wait(1):
+            if not writer.is_alive():
+                print('The writer exited with {}, shutting down'.format(writer.exitcode), file=log, flush=True)
+                break
+            for index, reader in enumerate(readers):
+                if not reader.is_alive():
+                    print('Reader {} exited with {}, restarting it'.format(index, reader.exitcode), file=log, flush=True)
+                    readers[index] = start_reader(index)
+    finally:
+        # The readers first, once they have drained every write they took
+        # has been answered, so nothing can reach the writer after it stops
+        for reader in readers:
+            reader.terminate()
+        for reader in readers:
+            reader.join(drain_timeout + 10)
+            if reader.is_alive():
+                reader.kill()
+        writer.terminate()
+        writer.join()
+
+        listener.close()
+        shutil.rmtree(directory, ignore_errors=True)
+        print('Stopped', file=log, flush=True)
+
+
+class InFlight(object):
+    """
+    WSGI middleware counting the requests being served, a streamed one until
+    its response is closed, so a server can wait for them to finish.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.count = 0
+        self._idle = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._idle:
+            self.count += 1
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._finished()
+            raise
+        return ClosingIterator(response, self._finished)
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds for every request to finish. Returns
+        False if some are still running.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self.count == 0, timeout)
+
+    def _finished(self):
+        with self._idle:
+            self.count -= 1
+            self._idle.notify_all()
+
+
+def _run_writer(address, authkey, config, ready):
+    app.config.update(config)
+    stopping = _stop_on_signals(signal.SIGTERM)
+
+    server = WriterServer(address, authkey, app.config['INGEST_ACK_TIMEOUT'],
+                          maxsize=app.config['INGEST_QUEUE_SIZE'],
+                          batch_size=app.config['INGEST_BATCH_SIZE'],
+                          flush_interval=app.config['INGEST_FLUSH_INTERVAL'],
+                          follow_buffer=app.config['WRITER_FOLLOW_BUFFER'])
+    threading.Thread(target=server.serve_forever, name='writer', daemon=True).start()
+    ready.set()
+
+    stopping.wait()
+    server.close()
+    # Commits what is still queued
+    close_ingest_queues()
+
+
+def _run_reader(listener, config, drain_timeout):
+    app.config.update(config)
+    stopping = _stop_on_signals(signal.SIGTERM)
+
+    # Following before serving, so the stream events are numbered from the
+    # first commit on
+    follow_writer()
+    warm_latest_indexes()
+
+    in_flight = InFlight(app)
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, in_flight, threaded=True, fd=listener.fileno())
+    threading.Thread(target=server.serve_forever, name='http', daemon=True).start()
+
+    stopping.wait()
+    server.shutdown()
+    close_streams()
+    if not in_flight.wait(drain_timeout):
+        print('{}: gave up on {} requests after {}s'.format(
+            multiprocessing.current_process().name, in_flight.count, drain_timeout), file=sys.stderr, flush=True)
+
+
+def _stop_on_signals(*signums):
+    # The children only stop when the supervisor tells them to, a Ctrl-C in
+    # the terminal reaches the whole process group at once
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for signum in signums:
+        signal.signal(signum, lambda *_: stopping.set())
+    return stopping
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the app with reader processes and a single writer process.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Reader processes (default: one per core, %(default)s)')
+    parser.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    parser.add_argument('--shards', type=int, default=1, help='Number of shards (default: %(default)s)')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='Seconds readers wait for their requests to finish on shutdown (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    serve(args.host, args.port, args.workers, args.drain_timeout, dict(DATABASE=args.db, SHARD_COUNT=args.shards))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from collections import defaultdict
+from db import create_devices, create_partitions, migrate, partition_start, resume_partitions, suspend_partitions, \
+    touch_devices
+from ingest import insert_readings
+
+
+def shard_paths(base_path, count):
+    """
+    Return the path of every shard when readings are spread over count
+    SQLite files. A single shard is just base_path, so an unsharded database
+    keeps its name.
+    """
+    if count == 1:
+        return [base_path]
+
+    # The count is part of the name, so resharding never writes into the
+    # files it is reading from
+    stem, extension = os.path.splitext(base_path)
+    return ['{}-{}-of-{}{}'.format(stem, index, count, extension) for index in range(count)]
+
+
+def shard_index(device_uuid, count):
+    # crc32 rather than hash(), which is salted differently in every process
+    return zlib.crc32(device_uuid.encode('utf-8')) % count
+
+
+def shard_path(base_path, count, device_uuid):
+    """
+    Return the path of the shard holding the readings of device_uuid.
+    """
+    return shard_paths(base_path, count)[shard_index(device_uuid, count)]
+
+
+def group_by_shard(base_path, count, rows, key=lambda row: row[0]):
+    """
+    Group rows by the path of the shard they belong to. key picks the
+    device_uuid out of a row, the first column by default.
+    """
+    paths = shard_paths(base_path, count)
+    groups = defaultdict(list)
+    for row in rows:
+        groups[paths[shard_index(key(row), count)]].append(row)
+    return groups
+
+
+# The columns after the device and type of each aggregate, which reshard
+# copies to the new shards keyed on the device ids there
+_AGGREGATES = {
+    'reading_histograms': ['bucket', 'value', 'count'],
+    'reading_rollups': ['resolution', 'bucket', 'count', 'total', 'min_value', 'min_date', 'max_value', 'max_date'],
+}
+
+
+def reshard(base_path, old_count, new_count, batch_size=100000, log=sys.stderr):
+    """
+    Copy every reading, histogram and rollup from old_count shards into
+    new_count shards.
+
+    This is an offline tool: stop the writers first. The old shards must all
+    exist and hold data, and the new ones must not exist yet, which is
+    checked before anything is written. The readings are loaded into the new
+    shards with their partitions suspended (see suspend_partitions), then
+    the aggregates are copied over as they are, so those kept by retention
+    for readings that have expired are not lost. The old shards are left in
+    place to be removed once the new ones have been checked.
+    """
+    old_paths = shard_paths(base_path, old_count)
+    new_paths = shard_paths(base_path, new_count)
+    if set(new_paths) & set(old_paths):
+        raise ValueError('Resharding needs a different shard count')
+    missing = [path for path in old_paths if not os.path.exists(path)]
+    if missing:
+        raise ValueError('No shard at {}, is {} the current shard count?'.format(', '.join(missing), old_count))
+    existing = [path for path in new_paths if os.path.exists(path)]
+    if existing:
+        raise ValueError('{} already exist, remove them first'.format(', '.join(existing)))
+
+    sources = {}
+    for path in old_paths:
+        sources[path] = sqlite3.connect(path)
+        migrate(sources[path])
+    if not any(conn.execute('select exists (select 1 from devices)').fetchone()[0] for conn in sources.values()):
+        raise ValueError('The shards at {} hold no readings'.format(', '.join(old_paths)))
+
+    targets = {}
+    suspended = {}
+    for path in new_paths:
+        targets[path] = sqlite3.connect(path)
+        migrate(targets[path])
+        suspended[path] = set()
+
+    copied = 0
+    started = time.monotonic()
+    try:
+        for source in sources.values():
+            cur = source.execute('select device_uuid, type, value, date_created from readings')
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for path, shard_rows in group_by_shard(base_path, new_count, rows).items():
+                    dates = {row[3] for row in shard_rows}
+                    create_partitions(targets[path], dates)
+                    firsts = {partition_start(date_created) for date_created in dates} - suspended[path]
+                    if firsts:
+                        suspend_partitions(targets[path], sorted(firsts))
+                        suspended[path].update(firsts)
+                    insert_readings(targets[path], shard_rows)
+
+                copied += len(rows)
+                print('{} readings copied ({:.0f}/s)'.format(copied, copied / (time.monotonic() - started)), file=log)
+
+        for table, columns in _AGGREGATES.items():
+            for source in sources.values():
+                _copy_aggregates(source, targets, base_path, new_count, table, columns, batch_size)
+            print('{} copied'.format(table), file=log)
+
+        for conn in targets.values():
+            resume_partitions(conn, rebuild=False)
+    finally:
+        for conn in list(targets.values()) + list(sources.values()):
+            conn.close()
+
+    return copied
+
+
+def _copy_aggregates(source, targets, base_path, count, table, columns, batch_size):
+    cur = source.execute('select d.uuid, a.type, {} from {} a join devices d on d.id = a.device_id'.format(
+        ', '.join('a.' + column for column in columns), table))
+    insert = 'insert into {} (device_id, type, {}) values ({})'.format(
+        table, ', '.join(columns), ','.join('?' * (len(columns) + 2)))
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+
+        for path, shard_rows in group_by_shard(base_path, count, rows).items():
+            conn = targets[path]
+            # Devices whose readings have all expired only have aggregates
+            ids = create_devices(conn, {row[0] for row in shard_rows})
+            with conn:
+                conn.executemany(insert, [(ids[row[0]],) + tuple(row[1:]) for row in shard_rows])
+                touch_devices(conn, {ids[row[0]] for row in shard_rows})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline tool to move the readings to a different number of shards.')
+    parser.add_argument('--db', default='database.db', help='Base path of the database (default: %(default)s)')
+    parser.add_argument('--from', dest='old_count', type=int, required=True, help='Current number of shards')
+    parser.add_argument('--to', dest='new_count', type=int, required=True, help='New number of shards')
+    parser.add_argument('--batch-size', type=int, default=100000, help='Readings per transaction (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    copied = reshard(args.db, args.old_count, args.new_count, args.batch_size)
+    print('Copied {} readings into {}. Set SHARD_COUNT={} and remove {} once checked.'.format(
+        copied, ', '.join(shard_paths(args.db, args.new_count)), args.new_count,
+        ', '.join(shard_paths(args.db, args.old_count))))
+
+
+if __name__ == '__main__':
+    main()
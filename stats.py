@@ -0,0 +1,427 @@
+import math
+from collections import Counter, defaultdict
+from db import HISTOGRAM_BUCKET, ROLLUP_RESOLUTIONS, SENSOR_TYPE_IDS, _PACKING, device_id, find_devices, partitions
+from schemas import METRICS
+
+# The metrics answered from the rollups, and from the histograms
+SUMMARY_METRICS = {'min', 'max', 'mean'}
+HISTOGRAM_METRICS = {'median', 'mode', 'quartiles'}
+
+
+class Histogram(object):
+    """
+    Exact distribution of the reading values for a device, type and window.
+
+    Values are bounded to 0-100 by DeviceReadingSchema, so a histogram never
+    has more than 101 entries and every statistic below costs the same
+    whatever the number of readings it summarises.
+    """
+
+    def __init__(self, counts):
+        self.counts = sorted((value, count) for value, count in counts.items() if count > 0)
+        self.total = sum(count for _, count in self.counts)
+
+    def __len__(self):
+        return self.total
+
+    def value_at(self, rank):
+        """
+        Return (value, offset) for the reading at the 0-based rank in value
+        order, where offset is its rank among the readings with that value.
+        """
+        if not 0 <= rank < self.total:
+            raise IndexError(rank)
+
+        for value, count in self.counts:
+            if rank < count:
+                return value, rank
+            rank -= count
+
+    def mean(self):
+        return sum(value * count for value, count in self.counts) / self.total
+
+    def mode(self):
+        # If 2 different values have the same frequency of occurence, take the smaller number
+        return max(self.counts, key=lambda item: (item[1], -item[0]))[0]
+
+    def median_of(self, first, last):
+        """
+        Return the median of the readings ranked first to last (exclusive)
+        in value order, matching statistics.median on that slice.
+        """
+        size = last - first
+        if size % 2:
+            return self.value_at(first + size // 2)[0]
+        return (self.value_at(first + size // 2 - 1)[0] + self.value_at(first + size // 2)[0]) / 2
+
+    def quartiles(self):
+        """
+        Return the 1st and 3rd quartile as the medians of the lower and upper
+        halves of the values.
+        """
+        if self.total == 1:
+            return self.counts[0][0], self.counts[0][0]
+
+        mid = self.total // 2
+        return self.median_of(0, mid), self.median_of(self.total - mid, self.total)
+
+    def percentile(self, p):
+        """
+        Return the p-th percentile with the nearest-rank method.
+        """
+        rank = max(math.ceil(p / 100 * self.total) - 1, 0)
+        return self.value_at(rank)[0]
+
+
+class Summary(object):
+    """
+    Count, total, min and max of the reading values for a device, type and
+    window. The min and max are kept as (value, date_created) so the reading
+    they came from can be returned, with ties going to the earlier reading.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, count, total, min_value, min_date, max_value, max_date):
+        self.count += count
+        self.total += total
+        if self.min is None or (min_value, min_date) < self.min:
+            self.min = (min_value, min_date)
+        if self.max is None or (-max_value, max_date) < (-self.max[0], self.max[1]):
+            self.max = (max_value, max_date)
+
+    def mean(self):
+        return self.total / self.count
+
+
+def cover_range(start, end, resolutions):
+    """
+    Cover [start, end) with the coarsest whole buckets that fit.
+
+    resolutions are bucket widths in seconds, coarsest first, each a
+    multiple of the next. Returns (buckets, edges): buckets is a list of
+    (resolution, first, last) meaning the buckets of that width starting in
+    [first, last), and edges is a list of (start, end) ranges narrower than
+    the finest bucket that have to be read from the raw readings. None stands
+    for an open start or end throughout.
+    """
+    if start is not None and end is not None and start >= end:
+        return [], []
+    if not resolutions:
+        return [], [(start, end)]
+
+    size = resolutions[0]
+    first = None if start is None else -(-start // size) * size
+    last = None if end is None else end // size * size
+
+    if first is not None and last is not None and first >= last:
+        # No whole bucket of this width fits, try the next one down
+        return cover_range(start, end, resolutions[1:])
+
+    buckets = [(size, first, last)]
+    edges = []
+    # Cover the ragged edges with the finer resolutions
+    if first is not None and start < first:
+        left_buckets, left_edges = cover_range(start, first, resolutions[1:])
+        buckets += left_buckets
+        edges += left_edges
+    if last is not None and last < end:
+        right_buckets, right_edges = cover_range(last, end, resolutions[1:])
+        buckets += right_buckets
+        edges += right_edges
+
+    return buckets, edges
+
+
+def value_summary(conn, device_uuid, sensor_type, start=None, end=None):
+    """
+    Build the Summary of a device's readings of one type over [start, end).
+
+    The window is covered with the coarsest day, hour and minute buckets of
+    reading_rollups that fit, and only what is left at the edges, less than
+    a minute either side, is read from the raw readings.
+    """
+    buckets, edges = cover_range(start, end, ROLLUP_RESOLUTIONS)
+    key = _key(conn, device_uuid, sensor_type)
+
+    summary = Summary()
+    for resolution, first, last in buckets:
+        query, params = _bucket_query(
+            'select count, total, min_value, min_date, max_value, max_date from reading_rollups '
+            'where device_id = ? and type = ? and resolution = ?',
+            [*key, resolution], first, last)
+
+        for row in conn.execute(query, params):
+            summary.add(*row)
+
+    for edge_start, edge_end in edges:
+        query = ('select value, date_created from {} where device_id = ? and type = ? '
+                 'and date_created >= ? and date_created < ?')
+
+        for table in partitions(conn, edge_start, edge_end):
+            for value, date_created in conn.execute(query.format(table), (*key, edge_start, edge_end)):
+                summary.add(1, value, value, date_created, value, date_created)
+
+    return summary
+
+
+def value_histogram(conn, device_uuid, sensor_type, start=None, end=None):
+    """
+    Build the Histogram of a device's readings of one type over [start, end).
+
+    The whole hourly buckets inside the window are merged from
+    reading_histograms, and only the partial buckets at the edges are read
+    from the raw readings.
+    """
+    buckets, edges = cover_range(start, end, (HISTOGRAM_BUCKET,))
+    key = _key(conn, device_uuid, sensor_type)
+
+    counts = Counter()
+    for _, first, last in buckets:
+        query, params = _bucket_query(
+            'select value, sum(count) from reading_histograms where device_id = ? and type = ?',
+            [*key], first, last)
+
+        for value, count in conn.execute(query + ' group by value', params):
+            counts[value] += count
+
+    for edge_start, edge_end in edges:
+        query = ('select value, count(*) from {} where device_id = ? and type = ? '
+                 'and date_created >= ? and date_created < ? group by value')
+
+        for table in partitions(conn, edge_start, edge_end):
+            for value, count in conn.execute(query.format(table), (*key, edge_start, edge_end)):
+                counts[value] += count
+
+    return Histogram(counts)
+
+
+def reading_at(conn, histogram, rank, device_uuid, sensor_type, start=None, end=None):
+    """
+    Return (value, date_created) of the reading at the 0-based rank when the
+    readings in the window are ordered by value then date_created, seeking
+    straight to it through the (device_id, type, value, date_created) index
+    of each partition in turn.
+
+    The histograms outlive the partitions expired by retention, so when the
+    reading itself is gone its date_created is returned as None.
+    """
+    value, offset = histogram.value_at(rank)
+
+    conditions = 'device_id = ? and type = ? and value = ?'
+    params = [*_key(conn, device_uuid, sensor_type), value]
+    if start is not None:
+        conditions += ' and date_created >= ?'
+        params.append(start)
+    if end is not None:
+        conditions += ' and date_created < ?'
+        params.append(end)
+
+    # Count what each partition holds of the value, so whole partitions can
+    # be skipped. Expired readings are older than any left, so they come first.
+    counts = [(table, conn.execute('select count(*) from {} where {}'.format(table, conditions), params).fetchone()[0])
+              for table in partitions(conn, start, end)]
+    offset -= dict(histogram.counts)[value] - sum(count for _, count in counts)
+    if offset < 0:
+        return value, None
+
+    for table, count in counts:
+        if offset < count:
+            query = 'select value, date_created from {} where {} order by date_created limit 1 offset ?'
+            return tuple(conn.execute(query.format(table, conditions), params + [offset]).fetchone())
+        offset -= count
+
+
+def compute_stats(conn, device_uuid, sensor_type, start=None, end=None, metrics=METRICS):
+    """
+    Compute the given metrics over a device's readings of one type in
+    [start, end), reading the rollups and the histograms at most once each
+    however many metrics are asked for.
+
+    Returns a dict keyed by metric, or None when there are no readings in
+    the window. The min, max and median are reading dicts, the mean and mode
+    plain values and the quartiles a dict of quartile_1 and quartile_3.
+    """
+    metrics = set(metrics)
+
+    summary = None
+    if metrics & SUMMARY_METRICS:
+        summary = value_summary(conn, device_uuid, sensor_type, start, end)
+        if not summary:
+            return None
+
+    histogram = None
+    if metrics & HISTOGRAM_METRICS:
+        histogram = value_histogram(conn, device_uuid, sensor_type, start, end)
+
+    return _metric_results(conn, device_uuid, sensor_type, start, end, metrics, summary, histogram)
+
+
+def batch_stats(conn, device_uuids, sensor_type, start=None, end=None, metrics=METRICS, chunk_size=500):
+    """
+    Compute the given metrics for many devices' readings of one type in
+    [start, end) at once.
+
+    Rather than a query per device, the rollups and histograms are read
+    with one query per bucket width and chunk of chunk_size devices, grouped
+    by device. Only the median still seeks to its reading device by device.
+    Returns {device_uuid: results}, results being what compute_stats
+    returns for that device.
+    """
+    metrics = set(metrics)
+    ids = find_devices(conn, device_uuids)
+    chunks = [sorted(ids.values())[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    type_id = SENSOR_TYPE_IDS.get(sensor_type)
+
+    summaries = batch_summaries(conn, chunks, type_id, start, end) if metrics & SUMMARY_METRICS else None
+    histograms = batch_histograms(conn, chunks, type_id, start, end) if metrics & HISTOGRAM_METRICS else None
+
+    results = {}
+    for device_uuid in device_uuids:
+        device = ids.get(device_uuid)
+        summary = None if summaries is None else summaries.get(device, Summary())
+        histogram = None if histograms is None else histograms.get(device, Histogram({}))
+        if summary is not None and not summary:
+            results[device_uuid] = None
+        else:
+            results[device_uuid] = _metric_results(conn, device_uuid, sensor_type, start, end, metrics, summary,
+                                                   histogram)
+
+    return results
+
+
+def batch_summaries(conn, chunks, type_id, start=None, end=None):
+    """
+    Build the Summary of the readings of one type over [start, end) for
+    every device in chunks of device ids, as {device_id: Summary}. Devices
+    without readings are left out.
+
+    The window is covered like value_summary, with each part read for a
+    whole chunk in a query grouped by device. The min and max readings are
+    picked in the same query by packing each into an integer (_PACKING).
+    """
+    buckets, edges = cover_range(start, end, ROLLUP_RESOLUTIONS)
+
+    summaries = defaultdict(Summary)
+    for chunk in chunks:
+        devices = ','.join('?' * len(chunk))
+        for resolution, first, last in buckets:
+            query, params = _bucket_query(
+                'select device_id, sum(count), sum(total), min(min_value * {0} + min_date), '
+                'max(max_value * {0} - max_date) from reading_rollups '
+                'where type = ? and resolution = ? and device_id in ({1})'.format(_PACKING, devices),
+                [type_id, resolution, *chunk], first, last)
+
+            for device, count, total, packed_min, packed_max in conn.execute(query + ' group by device_id', params):
+                summaries[device].add(count, total, *_unpack_min(packed_min), *_unpack_max(packed_max))
+
+        for edge_start, edge_end in edges:
+            query = ('select device_id, count(*), sum(value), min(value * {0} + date_created), '
+                     'max(value * {0} - date_created) from {{}} where type = ? and device_id in ({1}) '
+                     'and date_created >= ? and date_created < ? group by device_id').format(_PACKING, devices)
+
+            for table in partitions(conn, edge_start, edge_end):
+                for device, count, total, packed_min, packed_max in conn.execute(
+                        query.format(table), (type_id, *chunk, edge_start, edge_end)):
+                    summaries[device].add(count, total, *_unpack_min(packed_min), *_unpack_max(packed_max))
+
+    return summaries
+
+
+def batch_histograms(conn, chunks, type_id, start=None, end=None):
+    """
+    Build the Histogram of the readings of one type over [start, end) for
+    every device in chunks of device ids, as {device_id: Histogram}, the
+    same way value_histogram does with queries grouped by device.
+    """
+    buckets, edges = cover_range(start, end, (HISTOGRAM_BUCKET,))
+
+    counts = defaultdict(Counter)
+    for chunk in chunks:
+        devices = ','.join('?' * len(chunk))
+        for _, first, last in buckets:
+            query, params = _bucket_query(
+                'select device_id, value, sum(count) from reading_histograms '
+                'where type = ? and device_id in ({})'.format(devices),
+                [type_id, *chunk], first, last)
+
+            for device, value, count in conn.execute(query + ' group by device_id, value', params):
+                counts[device][value] += count
+
+        for edge_start, edge_end in edges:
+            query = ('select device_id, value, count(*) from {{}} where type = ? and device_id in ({}) '
+                     'and date_created >= ? and date_created < ? group by device_id, value').format(devices)
+
+            for table in partitions(conn, edge_start, edge_end):
+                for device, value, count in conn.execute(query.format(table), (type_id, *chunk, edge_start, edge_end)):
+                    counts[device][value] += count
+
+    return {device: Histogram(device_counts) for device, device_counts in counts.items()}
+
+
+def _metric_results(conn, device_uuid, sensor_type, start, end, metrics, summary, histogram):
+    # The metrics out of the Summary and Histogram of a device's window,
+    # None when it has no readings
+    def reading(value, date_created):
+        return dict(device_uuid=device_uuid, type=sensor_type, value=value, date_created=date_created)
+
+    results = {}
+    if summary is not None:
+        if not summary:
+            return None
+
+        if 'min' in metrics:
+            results['min'] = reading(*summary.min)
+        if 'max' in metrics:
+            results['max'] = reading(*summary.max)
+        if 'mean' in metrics:
+            results['mean'] = round(summary.mean())
+
+    if histogram is not None:
+        if not histogram:
+            return None
+
+        if 'median' in metrics:
+            results['median'] = reading(*reading_at(conn, histogram, len(histogram) // 2,
+                                                    device_uuid, sensor_type, start, end))
+        if 'mode' in metrics:
+            results['mode'] = histogram.mode()
+        if 'quartiles' in metrics:
+            q1, q3 = histogram.quartiles()
+            results['quartiles'] = dict(quartile_1=round(q1), quartile_3=round(q3))
+
+    return results
+
+
+def _unpack_min(packed):
+    value = (packed + _PACKING // 2) // _PACKING
+    return value, packed - value * _PACKING
+
+
+def _unpack_max(packed):
+    # Packed as value * _PACKING - date_created, so the earliest date wins
+    value = (packed + _PACKING // 2) // _PACKING
+    return value, value * _PACKING - packed
+
+
+def _bucket_query(query, params, first, last):
+    if first is not None:
+        query += ' and bucket >= ?'
+        params.append(first)
+    if last is not None:
+        query += ' and bucket < ?'
+        params.append(last)
+
+    return query, params
+
+
+def _key(conn, device_uuid, sensor_type):
+    # The (device_id, type) the aggregates and partitions are keyed on
+    return device_id(conn, device_uuid), SENSOR_TYPE_IDS.get(sensor_type)
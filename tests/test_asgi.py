@@ -0,0 +1,265 @@
+import asyncio
+import json
+import sqlite3
+import unittest
+from app import app, close_streams
+from asgi import ExecutorApp, application
+from db import migrate
+
+
+class ASGITestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup an empty SQLite DB
+        conn = sqlite3.connect('test_database.db')
+        for (name, kind) in conn.execute("select name, type from sqlite_master where type in ('table', 'view')").fetchall():
+            conn.execute('DROP {} IF EXISTS "{}"'.format(kind, name))
+        conn.execute('PRAGMA user_version = 0')
+        migrate(conn)
+        conn.close()
+
+        self.device_uuid = 'test_device'
+
+        app.config['TESTING'] = True
+
+        self.client = app.test_client
+
+    def _request(self, asgi_app, method, path, query=b'', chunks=(b'',), headers=()):
+        # Send the body in the given chunks and collect what is sent back
+        messages = []
+        pending = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                   for i, chunk in enumerate(chunks)]
+
+        async def receive():
+            if pending:
+                return pending.pop(0)
+            # The client stays connected
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': list(headers),
+                 'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80), 'client': ('127.0.0.1', 5000)}
+        asyncio.run(asgi_app(scope, receive, send))
+
+        start = messages[0]
+        self.assertFalse(messages[-1].get('more_body'))
+        return start['status'], dict(start['headers']), b''.join(m.get('body', b'') for m in messages[1:])
+
+    def test_asgi_matches_wsgi(self):
+        # Given a batch of readings POSTed through the ASGI app in several chunks
+        body = json.dumps([{'type': 'temperature', 'value': value, 'date_created': 100 + value}
+                           for value in range(10)]).encode()
+        status, _, data = self._request(application, 'POST', '/devices/{}/readings/'.format(self.device_uuid),
+                                        chunks=[body[:7], body[7:50], body[50:]])
+
+        # Then they should be written
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(data)['inserted'], 10)
+
+        # And every GET should answer exactly what the WSGI app does
+        for path, query in [('/devices/{}/readings/'.format(self.device_uuid), b'type=temperature&limit=3'),
+                            ('/devices/{}/readings/max/'.format(self.device_uuid), b'type=temperature'),
+                            ('/devices/{}/readings/stats/'.format(self.device_uuid), b'type=temperature&start=103'),
+                            ('/devices/{}/readings/max/'.format(self.device_uuid), b'type=pressure')]:
+            status, headers, data = self._request(application, 'GET', path, query)
+            expected = self.client().get(path + '?' + query.decode())
+            self.assertEqual(status, expected.status_code)
+            self.assertEqual(data, expected.data)
+            self.assertEqual(headers.get(b'x-next-cursor'), expected.headers.get('X-Next-Cursor', '').encode() or None)
+
+    def test_asgi_busy(self):
+        # Given an ASGI app that takes no more requests
+        busy = ExecutorApp(app, max_workers=1, max_pending=0, retry_after=3)
+
+        # When we make a request
+        status, headers, _ = self._request(busy, 'GET', '/devices/{}/readings/'.format(self.device_uuid))
+
+        # Then we should be told to come back later
+        self.assertEqual(status, 503)
+        self.assertEqual(headers[b'retry-after'], b'3')
+
+    def _run_slow_client(self, asgi_app, check, disconnect=False):
+        # Request / from a client that does not read the body until check
+        # passes, and is then gone if disconnect is set. Returns whether
+        # check passed, and what was sent
+        messages = []
+        passed = []
+        taken = asyncio.Event()
+        pending = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if pending:
+                return pending.pop(0)
+            if disconnect:
+                await taken.wait()
+                return {'type': 'http.disconnect'}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and not disconnect:
+                await taken.wait()
+            messages.append(message)
+
+        async def run():
+            scope = {'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': []}
+            request = asyncio.ensure_future(asgi_app(scope, receive, send))
+            for _ in range(200):
+                if check():
+                    passed.append(True)
+                    break
+                await asyncio.sleep(0.01)
+            taken.set()
+            await asyncio.wait_for(request, 5)
+
+        asyncio.run(run())
+        return bool(passed), messages
+
+    def test_asgi_buffers_bodies(self):
+        # Given a response of known length
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '4000')])
+            return [b'x' * 1000] * 4
+
+        asgi_app = ExecutorApp(wsgi_app, max_workers=1, max_pending=1, send_buffer=1)
+
+        # When it is sent to a client that has not read any of it yet
+        # Then the thread should be done with it already
+        released, messages = self._run_slow_client(asgi_app, lambda: asgi_app.pending == 0)
+        self.assertTrue(released)
+
+        # And the client should get the whole body at once
+        self.assertEqual([m.get('body') for m in messages[1:]], [b'x' * 4000])
+
+    def test_asgi_abandons_stuck_streams(self):
+        # Given an endless streamed response
+        closed = []
+
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/event-stream')])
+            try:
+                while True:
+                    yield b'event'
+            finally:
+                closed.append(True)
+
+        # When the client stops reading it, or disconnects
+        # Then the stream should be abandoned and closed, freeing its thread
+        stuck = ExecutorApp(wsgi_app, max_workers=2, max_pending=1, send_timeout=0.1, send_buffer=2)
+        abandoned, _ = self._run_slow_client(stuck, lambda: closed)
+        self.assertTrue(abandoned)
+        self.assertEqual(stuck.pending, 0)
+
+        gone = ExecutorApp(wsgi_app, max_workers=2, max_pending=1, send_timeout=60, send_buffer=2)
+        self._run_slow_client(gone, lambda: True, disconnect=True)
+        self.assertEqual(closed, [True, True])
+        self.assertEqual(gone.pending, 0)
+
+    async def _open_stream(self, asgi_app, path, messages, disconnected):
+        # Request path from a client that reads everything until it
+        # disconnects
+        pending = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if pending:
+                return pending.pop(0)
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+        await asgi_app(scope, receive, send)
+
+    async def _wait_for_body(self, messages):
+        for _ in range(500):
+            if any(m['type'] == 'http.response.body' for m in messages):
+                return
+            await asyncio.sleep(0.01)
+        self.fail('no body sent')
+
+    def test_asgi_limits_streams(self):
+        # Given an ASGI app with 2 threads, so it serves a single live stream
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/event-stream; charset=utf-8')])
+            return iter(lambda: b': keepalive\n\n', None)
+
+        asgi_app = ExecutorApp(wsgi_app, max_workers=2, max_pending=10, retry_after=3)
+        self.assertEqual(asgi_app.max_streams, 1)
+
+        async def run():
+            # When a second stream is opened while the first one is
+            first, second, disconnected = [], [], asyncio.Event()
+            request = asyncio.ensure_future(self._open_stream(asgi_app, '/', first, disconnected))
+            await self._wait_for_body(first)
+            await self._open_stream(asgi_app, '/', second, asyncio.Event())
+
+            # Then it should be turned away
+            self.assertEqual(second[0]['status'], 503)
+            self.assertEqual(dict(second[0]['headers'])[b'retry-after'], b'3')
+
+            # And be served once the first one is closed
+            disconnected.set()
+            await asyncio.wait_for(request, 5)
+            third, disconnected = [], asyncio.Event()
+            request = asyncio.ensure_future(self._open_stream(asgi_app, '/', third, disconnected))
+            await self._wait_for_body(third)
+            self.assertEqual(third[0]['status'], 200)
+            disconnected.set()
+            await asyncio.wait_for(request, 5)
+
+        asyncio.run(run())
+
+        # And streams should always leave some threads to other requests
+        with self.assertRaises(ValueError):
+            ExecutorApp(wsgi_app, max_workers=2, max_pending=10, max_streams=2)
+
+    def test_asgi_shutdown_ends_streams(self):
+        # Given an open live stream
+        asgi_app = ExecutorApp(app, max_workers=2, max_pending=10, on_shutdown=close_streams)
+        lifespan = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return lifespan.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        async def run():
+            messages = []
+            request = asyncio.ensure_future(self._open_stream(asgi_app, '/readings/stream/', messages,
+                                                              asyncio.Event()))
+            await self._wait_for_body(messages)
+
+            # When the server shuts down
+            await asyncio.wait_for(asgi_app({'type': 'lifespan'}, receive, send), 5)
+
+            # Then the stream should have ended, and the shutdown completed
+            await asyncio.wait_for(request, 5)
+            self.assertFalse(messages[-1].get('more_body'))
+            self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+        asyncio.run(run())
+
+    def test_asgi_startup_failure(self):
+        # Given a startup hook that fails
+        def on_startup():
+            raise sqlite3.OperationalError('unable to open database file')
+
+        asgi_app = ExecutorApp(app, max_workers=2, max_pending=10, on_startup=on_startup)
+        sent = []
+
+        async def receive():
+            return {'type': 'lifespan.startup'}
+
+        async def send(message):
+            sent.append(message)
+
+        # When the server starts
+        asyncio.run(asyncio.wait_for(asgi_app({'type': 'lifespan'}, receive, send), 5))
+
+        # Then it should be told the startup failed, and why
+        self.assertEqual(sent, [{'type': 'lifespan.startup.failed', 'message': 'unable to open database file'}])
@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import sqlite3
+import unittest
+from app import app
+from benchmarks.generate import device_uuids, generate_fleet, iter_fleet
+from benchmarks.mix import RecordingMiddleware, load_mix, make_mix
+from benchmarks.replay import replay
+from benchmarks.serving import benchmark_serving
+
+
+class BenchmarkTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a small synthetic fleet in the test DB
+        conn = sqlite3.connect('test_database.db')
+        for (name, kind) in conn.execute("select name, type from sqlite_master where type in ('table', 'view')").fetchall():
+            conn.execute('DROP {} IF EXISTS "{}"'.format(kind, name))
+        conn.execute('PRAGMA user_version = 0')
+        conn.close()
+
+        self.end = 1700000000
+        self.fleet = generate_fleet('test_database.db', 10, 200, span=86400, end=self.end, seed=3, log=io.StringIO())
+        self.devices = device_uuids(10, seed=3)
+
+        app.config['TESTING'] = True
+
+    def test_generate_fleet(self):
+        # Given a generated fleet
+        # Then every reading should be written
+        self.assertEqual(self.fleet['readings'], 2000)
+        conn = sqlite3.connect('test_database.db')
+        count, first, last = conn.execute('select count(*), min(date_created), max(date_created) from readings').fetchone()
+        self.assertEqual(count, 2000)
+
+        # And the readings should stay inside the span, in date order and bounded
+        self.assertTrue(self.end - 86400 <= first <= last < self.end)
+        rows = list(iter_fleet(self.devices, 200, {'temperature': 0.5, 'humidity': 0.5}, 86400, self.end, seed=3))
+        self.assertEqual([row[3] for row in rows], sorted(row[3] for row in rows))
+        self.assertTrue(all(0 <= row[2] <= 100 for row in rows))
+
+        # And the same seed should give the same readings
+        self.assertEqual(rows, list(iter_fleet(self.devices, 200, {'temperature': 0.5, 'humidity': 0.5}, 86400,
+                                               self.end, seed=3)))
+
+    def test_replay_report(self):
+        # Given a request mix against the fleet
+        mix = make_mix(self.devices, 300, 86400, self.end, seed=5)
+        self.assertEqual(mix, make_mix(self.devices, 300, 86400, self.end, seed=5))
+
+        # When we replay it in process
+        report = replay(mix, concurrency=2)
+
+        # Then every request should be answered and reported under its route
+        self.assertEqual(report['total']['requests'], 300)
+        self.assertEqual(sum(endpoint['requests'] for endpoint in report['endpoints'].values()), 300)
+        self.assertNotIn('500', report['total']['statuses'])
+        self.assertIn('GET /devices/<string:device_uuid>/readings/stats/', report['endpoints'])
+
+        # And the latencies and the SQLite work should be reported per endpoint
+        for name, endpoint in report['endpoints'].items():
+            self.assertTrue(endpoint['p50_ms'] <= endpoint['p95_ms'] <= endpoint['p99_ms'] <= endpoint['max_ms'])
+            self.assertGreater(endpoint['statements_per_request'], 0)
+
+            # With no full scans on the per-device endpoints
+            if '<string:device_uuid>' in name:
+                self.assertEqual(endpoint['full_scan_steps_per_request'], 0, name)
+
+        # And the report should be machine-readable
+        self.assertEqual(json.loads(json.dumps(report)), report)
+
+    def test_serving_report(self):
+        # Given a request mix against the fleet
+        mix = make_mix(self.devices, 100, 86400, self.end, seed=5)
+
+        # When we replay it against serve.py with a single reader
+        report = benchmark_serving('test_database.db', 1, [1], mix, concurrency=2, writers=1, log=io.StringIO())
+
+        # Then the GETs should all be answered by the readers
+        run, = report['runs']
+        self.assertEqual(run['workers'], 1)
+        self.assertEqual(run['reads']['requests'], sum(1 for request in mix if request['method'] == 'GET'))
+        self.assertNotIn('500', run['reads']['statuses'])
+
+        # And every POST sent alongside should have been committed by the writer
+        self.assertEqual(list(run['writes']['statuses']), ['201'])
+        self.assertEqual(json.loads(json.dumps(report)), report)
+
+    def test_record_mix(self):
+        # Given an app recording its requests
+        path = 'test_mix.jsonl'
+        self.addCleanup(os.remove, path)
+        wsgi_app = app.wsgi_app
+        app.wsgi_app = RecordingMiddleware(wsgi_app, path)
+        self.addCleanup(setattr, app, 'wsgi_app', wsgi_app)
+
+        # When we make some requests
+        body = json.dumps({'type': 'temperature', 'value': 20, 'date_created': 5})
+        self.assertEqual(app.test_client().post('/devices/test_device/readings/', data=body).status_code, 201)
+        self.assertEqual(app.test_client().get('/devices/test_device/readings/max/?type=temperature').status_code, 200)
+
+        # Then they should be recorded in a mix that can be replayed
+        mix = load_mix(path)
+        self.assertEqual([(r['method'], r['path'], r['query'], r['body']) for r in mix], [
+            ('POST', '/devices/test_device/readings/', '', body),
+            ('GET', '/devices/test_device/readings/max/', 'type=temperature', None),
+        ])
+        self.assertEqual(replay(mix, measure_work=False)['total']['statuses'], {'200': 1, '201': 1})
@@ -0,0 +1,194 @@
+import gzip
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+from bulk import export_readings, import_readings, parse_chunk, read_chunks
+from db import migrate, resume_partitions, suspend_partitions
+from ingest import insert_readings
+from schemas import MAX_DATE
+from shards import group_by_shard
+
+# Decoded, the devices are numbered in whatever order they were first seen
+AGGREGATES = ['select d.uuid, h.type, h.bucket, h.value, h.count from reading_histograms h '
+              'join devices d on d.id = h.device_id order by 1, 2, 3, 4',
+              'select d.uuid, r.type, r.resolution, r.bucket, r.count, r.total, r.min_value, r.min_date, '
+              'r.max_value, r.max_date from reading_rollups r join devices d on d.id = r.device_id order by 1, 2, 3, 4']
+
+
+class BulkTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a directory for the databases and files, and readings for a
+        # few devices spread over several partitions, ties included
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        generator = random.Random(11)
+        self.readings = [('device_{}'.format(generator.randint(0, 4)), generator.choice(['temperature', 'humidity']),
+                          generator.randint(0, 100), generator.randint(-86400, 30 * 86400)) for _ in range(3000)]
+        self.readings += [('device_0', 'temperature', value, 7200) for value in (3, 3, 97, 97)]
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _database(self, name, rows=()):
+        conn = sqlite3.connect(self._path(name))
+        migrate(conn)
+        if rows:
+            insert_readings(conn, rows)
+        return conn
+
+    def _write(self, name, lines):
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(self._path(name), 'wt') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        return self._path(name)
+
+    def _assert_same_database(self, conn, expected):
+        for query in ['select device_uuid, type, value, date_created from readings order by 1, 2, 3, 4'] + AGGREGATES:
+            self.assertEqual(conn.execute(query).fetchall(), expected.execute(query).fetchall())
+
+    def test_import_matches_insert(self):
+        # Given a database loaded through the API's insert path, with the
+        # readings split over a gzipped NDJSON file and a CSV with some bad
+        # lines
+        expected = self._database('expected.db', self.readings)
+        half = len(self.readings) // 2
+        ndjson = self._write('readings.ndjson.gz', [json.dumps(dict(device_uuid=d, type=t, value=v, date_created=c))
+                                                    for d, t, v, c in self.readings[:half]])
+        csv = self._write('readings.csv', ['device_uuid,type,value,date_created'] +
+                          ['{},{},{},{}'.format(*row) for row in self.readings[half:]] +
+                          ['device_0,pressure,1,5', 'device_0,temperature,101,5', 'device_0,temperature', ''])
+
+        # When we bulk import them in small batches, with and without workers
+        for workers in (0, 2):
+            path = self._path('imported_{}.db'.format(workers))
+            log = io.StringIO()
+            imported, rejected = import_readings(path, 1, [ndjson, csv], workers=workers, batch_size=500,
+                                                 chunk_lines=300, log=log)
+
+            # Then the readings and every aggregate should be the same as
+            # written reading by reading
+            self.assertEqual((imported, rejected), (len(self.readings), 3))
+            conn = sqlite3.connect(path)
+            self._assert_same_database(conn, expected)
+
+            # And the indexes and triggers should be back
+            names = {name for (name,) in conn.execute("select name from sqlite_master where type in ('index', 'trigger')")}
+            for (first,) in conn.execute('select first from reading_partitions'):
+                self.assertIn('readings_{}_device_type_date'.format(first), names)
+                self.assertIn('readings_{}_rollup_insert'.format(first), names)
+            self.assertEqual(conn.execute('select count(*) from bulk_loads').fetchone()[0], 0)
+
+            # And the rejected lines should be reported with their line numbers
+            self.assertIn('readings.csv:{}: '.format(len(self.readings) - half + 2), log.getvalue())
+            self.assertIn('readings.csv:{}: '.format(len(self.readings) - half + 4), log.getvalue())
+            self.assertIn('readings imported (', log.getvalue())
+            conn.close()
+
+    def test_import_into_existing_readings(self):
+        # Given a database already holding some readings
+        expected = self._database('expected.db', self.readings)
+        conn = self._database('existing.db', self.readings[:1000])
+        conn.close()
+
+        # When the rest are imported onto them
+        path = self._write('rest.ndjson', [json.dumps(dict(device_uuid=d, type=t, value=v, date_created=c))
+                                           for d, t, v, c in self.readings[1000:]])
+        import_readings(self._path('existing.db'), 1, [path], workers=0, log=io.StringIO())
+
+        # Then the aggregates should fold both together
+        self._assert_same_database(sqlite3.connect(self._path('existing.db')), expected)
+
+    def test_resume_interrupted_load(self):
+        # Given a load that was killed with its partitions suspended
+        expected = self._database('expected.db', self.readings)
+        conn = self._database('interrupted.db', self.readings[:1000])
+        suspend_partitions(conn, [first for (first,) in conn.execute('select first from reading_partitions')])
+        insert_readings(conn, self.readings[1000:])
+        self.assertEqual(conn.execute("select count(*) from sqlite_master where type = 'trigger'").fetchone()[0], 0)
+
+        # When the partitions are resumed
+        resume_partitions(conn)
+
+        # Then it should be as if nothing happened
+        self._assert_same_database(conn, expected)
+        self.assertEqual(resume_partitions(conn), [])
+
+    def test_import_date_bounds(self):
+        # Given readings dated at the bounds of what the API accepts, and one
+        # dated in microseconds past them
+        rows = [('device_0', 'temperature', 40, -MAX_DATE), ('device_0', 'temperature', 60, MAX_DATE),
+                ('device_0', 'temperature', 45, -MAX_DATE + 30), ('device_0', 'temperature', 55, MAX_DATE - 30)]
+        expected = self._database('expected.db', rows)
+        path = self._write('bounds.csv', ['device_uuid,type,value,date_created'] +
+                           ['{},{},{},{}'.format(*row) for row in rows] + ['device_0,temperature,50,1700000000000000'])
+
+        # When they are imported, with the rollups rebuilt from the packed
+        # min and max of each bucket
+        log = io.StringIO()
+        imported, rejected = import_readings(self._path('bounds.db'), 1, [path], workers=0, log=log)
+
+        # Then the one out of range should be rejected, and the aggregates
+        # of the others should be the same as written reading by reading
+        self.assertEqual((imported, rejected), (4, 1))
+        self.assertIn('bounds.csv:6: ', log.getvalue())
+        self._assert_same_database(sqlite3.connect(self._path('bounds.db')), expected)
+
+    def test_parse_chunk(self):
+        # Given CSV lines with an empty date and a wrong value
+        rows, errors = parse_chunk(['device_uuid', 'type', 'value', 'date_created'], 2,
+                                   ['a,temperature,5,\n', 'a,temperature,x,7\n', '\n', 'a,humidity,6,8\n'])
+
+        # Then the empty date should be stamped, and the error kept with its line
+        self.assertEqual(len(rows), 2)
+        self.assertIsInstance(rows[0][3], int)
+        self.assertEqual(rows[1], ('a', 'humidity', 6, 8))
+        self.assertEqual(errors, [(3, {'value': ['Not a valid integer.']})])
+
+    def test_read_chunks_leaves_stdin_open(self):
+        # Given NDJSON on stdin
+        stdin = io.StringIO('{"value": 1}\n{"value": 2}\n')
+
+        # When its chunks are read
+        with mock.patch('sys.stdin', stdin):
+            chunks = list(read_chunks('-', 'ndjson', chunk_lines=1))
+
+        # Then every line should be read, and stdin left open
+        self.assertEqual([chunk[1:] for chunk in chunks], [(1, ['{"value": 1}\n']), (2, ['{"value": 2}\n'])])
+        self.assertFalse(stdin.closed)
+
+    def test_export(self):
+        # Given readings across 2 shards
+        for path, rows in group_by_shard(self._path('fleet.db'), 2, self.readings).items():
+            self._database(os.path.basename(path), rows).close()
+
+        # When we export one device for a time range
+        out = io.StringIO()
+        count = export_readings(self._path('fleet.db'), 2, out, 'csv', 'device_0', 'temperature', 0, 86400)
+
+        # Then only its readings in range should come out, in date order
+        expected = sorted((r for r in self.readings if r[0] == 'device_0' and r[1] == 'temperature' and 0 <= r[3] < 86400),
+                          key=lambda r: r[3])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'device_uuid,type,value,date_created')
+        self.assertEqual(count, len(expected))
+        self.assertEqual([int(line.split(',')[3]) for line in lines[1:]], [r[3] for r in expected])
+
+        # And the whole fleet exported as NDJSON should import back the same
+        out = io.StringIO()
+        count = export_readings(self._path('fleet.db'), 2, out, 'ndjson')
+        self.assertEqual(count, len(self.readings))
+        path = self._write('fleet.ndjson', out.getvalue().splitlines())
+        import_readings(self._path('copy.db'), 1, [path], workers=0, log=io.StringIO())
+        self._assert_same_database(sqlite3.connect(self._path('copy.db')), self._database('expected.db', self.readings))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import time
+import unittest
+from unittest import mock
+from cache import MISSING, MetricCache
+
+
+class MetricCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MetricCache(max_entries=2, open_ttl=5)
+        self.closed_key = ('test_device', 'temperature', 10, 20, 'median')
+
+    def test_hit_and_miss(self):
+        # Given an empty cache
+        # When we look up a key
+        # Then it should be a miss
+        self.assertIs(self.cache.get(self.closed_key), MISSING)
+
+        # And once the key is cached it should be a hit
+        self.cache.put(self.closed_key, 42, self.cache.token())
+        self.assertEqual(self.cache.get(self.closed_key), 42)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_invalidate_only_matching_windows(self):
+        # Given results cached for two windows of the same series
+        other_key = ('test_device', 'temperature', 20, 30, 'median')
+        self.cache.put(self.closed_key, 42, self.cache.token())
+        self.cache.put(other_key, 43, self.cache.token())
+
+        # When a reading is inserted into the first window
+        self.cache.invalidate([('test_device', 'temperature', 50, 15)])
+
+        # Then only the first window should be dropped
+        self.assertIs(self.cache.get(self.closed_key), MISSING)
+        self.assertEqual(self.cache.get(other_key), 43)
+
+        # And readings for other series should not touch the cache
+        self.cache.invalidate([('test_device', 'humidity', 50, 25), ('other_device', 'temperature', 50, 25)])
+        self.assertEqual(self.cache.get(other_key), 43)
+
+    def test_stale_result_not_cached(self):
+        # Given a result computed before a reading was inserted
+        token = self.cache.token()
+        self.cache.invalidate([('test_device', 'temperature', 50, 15)])
+
+        # When it is put in the cache
+        self.cache.put(self.closed_key, 42, token)
+
+        # Then it should be dropped
+        self.assertIs(self.cache.get(self.closed_key), MISSING)
+
+    def test_other_version_misses(self):
+        # Given a result cached at one version of its device
+        self.cache.put(self.closed_key, 42, self.cache.token(), 3)
+
+        # When the device has been written to by another process since,
+        # and what it wrote is not known
+        # Then it should be a miss
+        self.assertIs(self.cache.get(self.closed_key, 4), MISSING)
+        self.assertIs(self.cache.get(self.closed_key, 4, lambda since: None), MISSING)
+
+        # And it should no longer be there for its own version either
+        self.assertIs(self.cache.get(self.closed_key, 3), MISSING)
+
+    def test_other_version_outside_window_hits(self):
+        # Given a result cached for [10, 20) at one version of its device
+        self.cache.put(self.closed_key, 42, self.cache.token(), 3)
+
+        # When other processes wrote readings after the window since
+        written_since = mock.Mock(return_value=(20, 500))
+
+        # Then it should still be a hit, and be moved to the new version
+        self.assertEqual(self.cache.get(self.closed_key, 5, written_since), 42)
+        written_since.assert_called_once_with(3)
+        self.assertEqual(self.cache.get(self.closed_key, 5), 42)
+
+        # And writes of other types only should not reach it either
+        self.assertEqual(self.cache.get(self.closed_key, 6, lambda since: (None, None)), 42)
+
+        # But a write reaching into the window should be a miss
+        self.assertIs(self.cache.get(self.closed_key, 7, lambda since: (0, 10)), MISSING)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_open_window_expires(self):
+        # Given a result cached for a window with no end
+        open_key = ('test_device', 'temperature', 10, None, 'median')
+        self.cache.put(open_key, 42, self.cache.token())
+
+        # When the TTL has passed
+        with mock.patch('cache.time.monotonic', return_value=time.monotonic() + 10):
+            # Then it should be a miss
+            self.assertIs(self.cache.get(open_key), MISSING)
+
+    def test_evicts_least_recently_used(self):
+        # Given a full cache
+        keys = [('test_device', 'temperature', i, i + 1, 'mean') for i in range(3)]
+        self.cache.put(keys[0], 0, self.cache.token())
+        self.cache.put(keys[1], 1, self.cache.token())
+
+        # When the oldest entry is used and a new one added
+        self.cache.get(keys[0])
+        self.cache.put(keys[2], 2, self.cache.token())
+
+        # Then the least recently used entry should be evicted
+        self.assertIs(self.cache.get(keys[1]), MISSING)
+        self.assertEqual(self.cache.get(keys[0]), 0)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
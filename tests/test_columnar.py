@@ -0,0 +1,68 @@
+import io
+import unittest
+import columnar
+
+
+class ColumnarTestCases(unittest.TestCase):
+
+    def test_round_trip(self):
+        # Given batches of readings for a few devices
+        batches = [
+            [(1, 'device_a', 'temperature', 22, 1), (2, 'device_b', 'humidity', 100, 2)],
+            [],
+            [(3, 'device_a', 'humidity', 0, 2 ** 40), (4, 'device_c', 'temperature', 50, 3)],
+        ]
+
+        # When we encode and decode them
+        data = b''.join(columnar.encode_batches(batches))
+        readings = list(columnar.decode_readings(io.BytesIO(data)))
+
+        # Then we should get every reading back
+        self.assertEqual(readings, [
+            {'device_uuid': device_uuid, 'type': sensor_type, 'value': value, 'date_created': date_created}
+            for batch in batches for _, device_uuid, sensor_type, value, date_created in batch
+        ])
+
+    def test_dictionary_encoding(self):
+        # Given many readings from the same device
+        rows = [(i, 'a_long_device_uuid_string', 'temperature', 50, i) for i in range(1000)]
+
+        # When we encode them
+        data = b''.join(columnar.encode_batches([rows]))
+
+        # Then the strings should be stored once and each reading take 14 bytes
+        self.assertEqual(data.count(b'a_long_device_uuid_string'), 1)
+        self.assertLess(len(data), 1000 * 14 + 100)
+
+    def test_long_strings(self):
+        # Given a reading from a device with a uuid too long for a uint16
+        rows = [(1, 'd' * 70000, 'temperature', 50, 1)]
+
+        # When we encode and decode it
+        data = b''.join(columnar.encode_batches([rows]))
+        readings = list(columnar.decode_readings(io.BytesIO(data)))
+
+        # Then we should get the whole uuid back
+        self.assertEqual(readings[0]['device_uuid'], 'd' * 70000)
+
+    def test_decode_version_1(self):
+        # Given a stream written with uint16 string lengths, by version 1
+        data = (b'CNRY\x01' + b'\x01\x00\x00\x00' + b'\x01\x00\x00\x00\x01\x00a' + b'\x01\x00\x00\x00\x08\x00humidity'
+                + b'\x00\x00\x00\x00' + b'\x00' + (7).to_bytes(8, 'little') + b'\x2a' + b'\x00\x00\x00\x00')
+
+        # When we decode it
+        # Then it should still be read
+        self.assertEqual(list(columnar.decode_readings(io.BytesIO(data))),
+                         [{'device_uuid': 'a', 'type': 'humidity', 'value': 42, 'date_created': 7}])
+
+    def test_decode_rejects_other_data(self):
+        # Given data that is not a columnar stream
+        # When we decode it
+        # Then it should be rejected
+        with self.assertRaises(ValueError):
+            list(columnar.decode_columns(io.BytesIO(b'[{"value": 1}]')))
+
+        # And so should a truncated stream
+        data = b''.join(columnar.encode_batches([[(1, 'device_a', 'temperature', 22, 1)]]))
+        with self.assertRaises(ValueError):
+            list(columnar.decode_columns(io.BytesIO(data[:-10])))
@@ -0,0 +1,239 @@
+import os
+import sqlite3
+import unittest
+import uuid
+from db import MIGRATIONS, PARTITION_SIZE, SCHEMA_VERSION, WRITE_LOG_VERSIONS, Connection, ConnectionPool, \
+    device_id, drop_partitions, full_scans, get_schema_version, migrate, partition_table, partitions, written_since
+from ingest import insert_readings
+
+
+class MigrationTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.path = 'test_migrations.db'
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.conn = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.conn.close()
+        os.remove(self.path)
+
+    def test_migrate_new_database(self):
+        # Given an empty database
+        # When we migrate it
+        previous = migrate(self.conn)
+
+        # Then it should have started at version 0
+        self.assertEqual(previous, 0)
+
+        # And it should now be at the latest version
+        self.assertEqual(get_schema_version(self.conn), SCHEMA_VERSION)
+
+    def test_migrate_legacy_database(self):
+        # Given a database created before migrations existed
+        self.conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        self.conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                          ('test_device', 'temperature', 22, 1))
+        self.conn.commit()
+
+        # When we migrate it
+        migrate(self.conn)
+
+        # Then the existing readings should be kept
+        rows = self.conn.execute('select device_uuid, type, value, date_created from readings').fetchall()
+        self.assertEqual(rows, [('test_device', 'temperature', 22, 1)])
+
+        # And lookups by device, type and date should be range seeks
+        query = 'select * from readings where device_uuid = ? and type = ? and date_created >= ?'
+        self.assertEqual(full_scans(self.conn, query, ('test_device', 'temperature', 1)), [])
+
+    def test_migrate_partitions_readings(self):
+        # Given a legacy database with readings spread over 3 weeks
+        self.conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        rows = [('test_device', 'temperature', i, i * 86400) for i in range(21)]
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+        self.conn.commit()
+
+        # When we migrate it
+        migrate(self.conn)
+
+        # Then each reading should be moved into the partition of its date
+        self.assertEqual(partitions(self.conn), [partition_table(0), partition_table(PARTITION_SIZE),
+                                                 partition_table(2 * PARTITION_SIZE)])
+        for table in partitions(self.conn):
+            self.assertEqual(self.conn.execute('select count(*) from {}'.format(table)).fetchone()[0], 7)
+
+        # And only the partitions overlapping a window should be picked
+        self.assertEqual(partitions(self.conn, PARTITION_SIZE - 1, PARTITION_SIZE + 1),
+                         [partition_table(0), partition_table(PARTITION_SIZE)])
+        self.assertEqual(partitions(self.conn, 2 * PARTITION_SIZE), [partition_table(2 * PARTITION_SIZE)])
+
+        # And the aggregates should neither be lost nor counted twice
+        count, = self.conn.execute('select sum(count) from reading_histograms').fetchone()
+        self.assertEqual(count, 21)
+        insert_readings(self.conn, [('test_device', 'temperature', 50, 5)])
+        count, = self.conn.execute('select sum(count) from reading_rollups where resolution = 86400').fetchone()
+        self.assertEqual(count, 22)
+
+    def test_migrate_encodes_readings(self):
+        # Given a database at version 5, with its readings partitioned as text
+        self.conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        devices = [str(uuid.UUID(int=i)) for i in range(50)]
+        rows = [(devices[i % 50], ['temperature', 'humidity'][i % 3 % 2], i % 101, i * 97) for i in range(20000)]
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+        self.conn.commit()
+        self.conn.execute('BEGIN')
+        for statement in [statement for migration in MIGRATIONS[:5] for statement in migration]:
+            statement(self.conn) if callable(statement) else self.conn.execute(statement)
+        self.conn.execute('PRAGMA user_version = 5')
+        self.conn.execute('COMMIT')
+
+        def snapshot():
+            return (self.conn.execute('select * from readings').fetchall(),
+                    [self.conn.execute('select rowid from {} order by rowid'.format(table)).fetchall()
+                     for table in partitions(self.conn)],
+                    self.conn.execute('select sum(count), count(*) from reading_histograms').fetchone(),
+                    self.conn.execute('select sum(total), max(max_date), count(*) from reading_rollups').fetchone())
+
+        def size():
+            self.conn.execute('VACUUM')
+            return self.conn.execute('PRAGMA page_count').fetchone()[0]
+
+        before, text_size = snapshot(), size()
+
+        # When we migrate it
+        migrate(self.conn)
+
+        # Then the readings, their rowids and their aggregates should all be kept
+        self.assertEqual(snapshot(), before)
+        self.assertEqual(sorted(before[0]), sorted(rows))
+
+        # And the devices and types should be stored as ids
+        self.assertEqual(self.conn.execute('select count(*) from devices').fetchone()[0], 50)
+        self.assertEqual(self.conn.execute('select distinct typeof(device_id), typeof(type) from {}'.format(
+            partition_table(0))).fetchall(), [('integer', 'integer')])
+
+        # And the database should take less than half the space
+        self.assertLess(size(), text_size / 2)
+
+    def test_device_ids_are_cached(self):
+        # Given a device with readings
+        migrate(self.conn)
+        insert_readings(self.conn, [('test_device', 'temperature', 22, 1)])
+
+        # When we look its id up from a caching connection
+        conn = sqlite3.connect(self.path, factory=Connection)
+        self.assertEqual(device_id(conn, 'test_device'), 1)
+
+        # Then it should be cached for every connection to the database
+        self.assertEqual(sqlite3.connect(self.path, factory=Connection).device_ids, {'test_device': 1})
+        self.assertIsNone(device_id(conn, 'unknown_device'))
+
+        # And forgotten when the database is recreated
+        for (name, kind) in conn.execute("select name, type from sqlite_master where type in ('table', 'view')").fetchall():
+            conn.execute('DROP {} IF EXISTS "{}"'.format(kind, name))
+        conn.execute('PRAGMA user_version = 0')
+        migrate(conn)
+        self.assertEqual(conn.device_ids, {})
+        conn.close()
+
+    def test_written_since(self):
+        # Given a device written to a few times
+        migrate(self.conn)
+        insert_readings(self.conn, [('test_device', 'temperature', 22, 100)])
+        insert_readings(self.conn, [('test_device', 'temperature', 23, 50), ('test_device', 'temperature', 24, 300),
+                                    ('test_device', 'humidity', 40, 10)])
+        insert_readings(self.conn, [('test_device', 'humidity', 41, 20)])
+
+        # Then the dates written to each type after a version should be known
+        self.assertEqual(written_since(self.conn, 'test_device', 'temperature', 1), (50, 300))
+        self.assertEqual(written_since(self.conn, 'test_device', 'temperature', 2), (None, None))
+        self.assertEqual(written_since(self.conn, 'test_device', 'humidity', 0), (10, 20))
+        self.assertIsNone(written_since(self.conn, 'unknown_device', 'humidity', 0))
+
+        # And dropping a partition should count as writing its whole span
+        with self.conn:
+            drop_partitions(self.conn, [0])
+        self.assertEqual(written_since(self.conn, 'test_device', 'humidity', 3), (0, PARTITION_SIZE - 1))
+
+        # And only the last WRITE_LOG_VERSIONS versions should be kept
+        for i in range(WRITE_LOG_VERSIONS):
+            insert_readings(self.conn, [('test_device', 'temperature', 22, 1000 + i)])
+        self.assertIsNone(written_since(self.conn, 'test_device', 'temperature', 3))
+        self.assertEqual(written_since(self.conn, 'test_device', 'temperature', 4), (1000, 1000 + WRITE_LOG_VERSIONS - 1))
+        self.assertEqual(self.conn.execute('select count(distinct version) from device_writes').fetchone()[0],
+                         WRITE_LOG_VERSIONS)
+
+    def test_migrate_is_idempotent(self):
+        # Given a database that is already up to date
+        migrate(self.conn)
+
+        # When we migrate it again
+        previous = migrate(self.conn)
+
+        # Then nothing should be applied
+        self.assertEqual(previous, SCHEMA_VERSION)
+        self.assertEqual(get_schema_version(self.conn), SCHEMA_VERSION)
+
+    def test_full_scans_detects_scan(self):
+        # Given a migrated database with a partition of readings
+        migrate(self.conn)
+        insert_readings(self.conn, [('test_device', 'temperature', 22, 1)])
+
+        # When we plan a query that cannot use the index
+        scans = full_scans(self.conn, 'select * from {} where value = ?'.format(partition_table(0)), (1,))
+
+        # Then the scan should be reported
+        self.assertEqual(len(scans), 1)
+        self.assertTrue(scans[0].startswith('SCAN readings_0'))
+
+
+class ConnectionPoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.path = 'test_pool.db'
+        self.pool = ConnectionPool(max_idle=1)
+
+    def tearDown(self):
+        self.pool.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_acquire_reuses_released_connection(self):
+        # Given a connection that was released back to the pool
+        conn = self.pool.acquire(self.path)
+        self.pool.release(conn, self.path)
+
+        # When we acquire another one
+        # Then we should get the same connection back
+        self.assertIs(self.pool.acquire(self.path), conn)
+        self.assertEqual(self.pool.stats()['hits'], 1)
+        self.assertEqual(self.pool.stats()['misses'], 1)
+
+    def test_pragmas_applied(self):
+        # Given a pooled connection
+        conn = self.pool.acquire(self.path)
+
+        # Then it should be using the default pragmas
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA temp_store').fetchone()[0], 2)
+
+    def test_release_rolls_back_and_caps_idle(self):
+        # Given two connections, one left with an open transaction
+        first = self.pool.acquire(self.path)
+        second = self.pool.acquire(self.path)
+        first.execute('CREATE TABLE t (a INTEGER)')
+        first.execute('INSERT INTO t VALUES (1)')
+
+        # When both are released to a pool keeping one idle connection
+        self.pool.release(first, self.path)
+        self.pool.release(second, self.path)
+
+        # Then the transaction should have been rolled back
+        self.assertEqual(first.execute('SELECT count(*) FROM t').fetchone()[0], 0)
+
+        # And only one connection should still be open
+        self.assertEqual(self.pool.stats()['open'], 1)
@@ -0,0 +1,74 @@
+import math
+import os
+import random
+import sqlite3
+import unittest
+from db import migrate
+from ingest import insert_readings
+from fleet import fleet_stats, list_devices, shutdown_pool
+
+
+class FleetStatsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a DB with readings for a small fleet
+        self.path = 'test_fleet.db'
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.conn = sqlite3.connect(self.path)
+        migrate(self.conn)
+
+        generator = random.Random(11)
+        self.readings = [('device_{}'.format(generator.randint(0, 19)), 'temperature',
+                          generator.randint(0, 100), generator.randint(0, 3 * 86400)) for _ in range(3000)]
+        insert_readings(self.conn, self.readings)
+
+    def tearDown(self):
+        shutdown_pool()
+        self.conn.close()
+        os.remove(self.path)
+
+    def test_fleet_stats_matches_raw_values(self):
+        # Given every device in the fleet and a window
+        devices = list_devices(self.conn, 'temperature')
+        start, end = 1000, 2 * 86400 + 17
+
+        # When we compute the fleet stats in the request
+        results = fleet_stats([(self.conn, self.path, devices)], 'temperature', start, end, [50, 95])
+
+        # Then they should match the raw readings
+        values = sorted(value for _, _, value, date in self.readings if start <= date < end)
+        self.assertEqual(results['count'], len(values))
+        self.assertEqual(results['mean'], round(sum(values) / len(values)))
+        self.assertEqual(results['min']['value'], values[0])
+        self.assertEqual(results['max']['value'], values[-1])
+        self.assertEqual(results['percentiles'], {
+            '50': values[math.ceil(len(values) * 0.5) - 1],
+            '95': values[math.ceil(len(values) * 0.95) - 1],
+        })
+
+    def test_list_devices_in_window(self):
+        # Given a device that only reported on the fifth day
+        insert_readings(self.conn, [('late', 'temperature', 1, 4 * 86400 + 10)])
+
+        # When we list the devices of windows before, over and after that day
+        # Then only the windows overlapping it should have it
+        self.assertIn('late', list_devices(self.conn, 'temperature'))
+        self.assertNotIn('late', list_devices(self.conn, 'temperature', 0, 4 * 86400))
+        self.assertIn('late', list_devices(self.conn, 'temperature', 4 * 86400 + 20, 4 * 86400 + 30))
+        self.assertIn('late', list_devices(self.conn, 'temperature', 4 * 86400))
+        self.assertNotIn('late', list_devices(self.conn, 'temperature', 5 * 86400))
+        self.assertEqual(len(list_devices(self.conn, 'temperature', 5 * 86400)), 0)
+        self.assertEqual(len(list_devices(self.conn, 'temperature', None, 4 * 86400)), 20)
+
+    def test_fleet_stats_process_pool(self):
+        # Given every device in the fleet
+        devices = list_devices(self.conn, 'temperature')
+
+        # When we compute the fleet stats across worker processes
+        parallel = fleet_stats([(self.conn, self.path, devices)], 'temperature', 500, None, workers=3, min_parallel=1)
+
+        # Then the merged partials should match the stats computed in the request
+        self.assertEqual(parallel, fleet_stats([(self.conn, self.path, devices)], 'temperature', 500, None))
+        self.assertEqual(parallel['devices'], 20)
@@ -0,0 +1,135 @@
+import threading
+import unittest
+from hub import ReadingHub, TooManySubscribers, sse_chunks
+
+
+class ReadingHubTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = ReadingHub(buffer_size=3, history=5)
+
+    def test_fan_out_matches_filters(self):
+        # Given subscribers to a device, to a type across the fleet and to a list of devices
+        device = self.hub.subscribe('a')
+        fleet = self.hub.subscribe(sensor_type='humidity')
+        listed = self.hub.subscribe(devices=['b'])
+
+        # When readings are published
+        self.hub.publish([('a', 'temperature', 1, 10), ('b', 'humidity', 2, 11), ('c', 'humidity', 3, 12)])
+
+        # Then each should only get the ones it asked for, with increasing ids
+        self.assertEqual([row for _, row in device.get(0)], [('a', 'temperature', 1, 10)])
+        events = fleet.get(0)
+        self.assertEqual([row[0] for _, row in events], ['b', 'c'])
+        self.assertEqual([row[0] for _, row in listed.get(0)], ['b'])
+        self.assertLess(int(events[0][0].split('-')[1]), int(events[1][0].split('-')[1]))
+
+        # And nothing new should time out empty
+        self.assertEqual(device.get(0), [])
+
+    def test_slow_consumer_is_evicted_and_resumes(self):
+        # Given a subscriber that does not keep up
+        slow = self.hub.subscribe('a')
+        fast = self.hub.subscribe('a')
+        self.hub.publish([('a', 'temperature', value, value) for value in range(2)])
+        last_event_id = fast.get(0)[-1][0]
+        self.hub.publish([('a', 'temperature', value, value) for value in range(2, 5)])
+
+        # Then it should be evicted once its buffer is full, without holding up the others
+        self.assertTrue(slow.evicted)
+        self.assertEqual(len(fast.get(0)), 3)
+        self.assertEqual(len(slow.get(0)), 3)
+        self.assertIsNone(slow.get(0))
+        self.assertEqual(self.hub.stats(), dict(subscribers=1, published=5, evictions=1))
+
+        # And it should be able to resume from the history after the last event it saw
+        resumed = self.hub.subscribe('a', last_event_id=last_event_id)
+        self.assertFalse(resumed.reset)
+        self.assertEqual([row[2] for _, row in resumed.get(0)], [2, 3, 4])
+
+    def test_resume_beyond_history_resets(self):
+        # Given more events than the history remembers
+        first = self.hub.subscribe('a')
+        self.hub.publish([('a', 'temperature', 1, 1)])
+        event_id = first.get(0)[0][0]
+        self.hub.publish([('b', 'temperature', value, value) for value in range(6)])
+
+        # Then resuming from a forgotten or foreign id should ask the client to start over
+        self.assertTrue(self.hub.subscribe('a', last_event_id=event_id).reset)
+        self.assertTrue(self.hub.subscribe('a', last_event_id='nonsense').reset)
+        self.assertFalse(self.hub.subscribe('a').reset)
+
+    def test_sse_chunks(self):
+        # Given a subscriber streaming events
+        subscription = self.hub.subscribe('a')
+        chunks = sse_chunks(subscription, heartbeat=0)
+        self.assertEqual(next(chunks), 'retry: 1000\n\n')
+
+        # When nothing is published, then a keepalive should be sent
+        self.assertEqual(next(chunks), ': keepalive\n\n')
+
+        # And a published reading should be sent as an event, waking the stream
+        threading.Timer(0.05, self.hub.publish, [[('a', 'temperature', 1, 10)]]).start()
+        chunks = sse_chunks(self.hub.subscribe('a'), heartbeat=5)
+        next(chunks)
+        self.assertRegex(next(chunks), r'^id: \w+-1\nevent: reading\ndata: '
+                                       r'\{"date_created":10,"device_uuid":"a","type":"temperature","value":1\}\n\n$')
+
+        # And closing the stream should unsubscribe
+        chunks.close()
+        subscription.close()
+        self.assertEqual(self.hub.stats()['subscribers'], 0)
+
+    def test_numbered_elsewhere(self):
+        # Given two hubs sharing an epoch, published the same rows with the
+        # same sequence numbers, one of them joining late
+        first = ReadingHub(buffer_size=3, history=5, epoch='cafe')
+        second = ReadingHub(buffer_size=3, history=5, epoch='cafe')
+        first.publish([('a', 'temperature', 1, 10)], sequence=1)
+        for hub in (first, second):
+            hub.publish([('a', 'temperature', 2, 11), ('a', 'temperature', 3, 12)], sequence=2)
+
+        # Then a subscriber should resume on either with the ids of the other
+        for hub in (first, second):
+            subscription = hub.subscribe('a', last_event_id='cafe-2')
+            self.assertFalse(subscription.reset)
+            self.assertEqual([event_id for event_id, _ in subscription.get(0)], ['cafe-3'])
+
+        # And after rows that never arrived, resuming across them should reset
+        second.publish([('a', 'temperature', 4, 13)], sequence=6)
+        self.assertTrue(second.subscribe('a', last_event_id='cafe-3').reset)
+
+        # And closing the hub should end every subscription
+        subscription = first.subscribe('a')
+        first.close()
+        self.assertIsNone(subscription.get(0))
+        self.assertEqual(first.stats()['subscribers'], 0)
+
+    def test_max_subscribers(self):
+        # Given a hub taking at most 3 subscribers
+        hub = ReadingHub(max_subscribers=3)
+
+        # When more than that subscribe at once
+        subscriptions, refused = [], []
+
+        def subscribe():
+            try:
+                subscriptions.append(hub.subscribe('a'))
+            except TooManySubscribers:
+                refused.append(True)
+
+        threads = [threading.Thread(target=subscribe) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Then only 3 of them should get in
+        self.assertEqual((len(subscriptions), len(refused)), (3, 5))
+        self.assertEqual(hub.stats()['subscribers'], 3)
+
+        # And one leaving should make room for another
+        subscriptions[0].close()
+        hub.subscribe(sensor_type='humidity')
+        with self.assertRaises(TooManySubscribers):
+            hub.subscribe(sensor_type='humidity')
@@ -0,0 +1,143 @@
+import json
+import sqlite3
+import threading
+import unittest
+from unittest import mock
+from app import app
+from db import migrate
+from ingest import IngestQueue, IngestQueueFull, close_ingest_queues, put_batches
+
+
+class IngestQueueTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup an empty SQLite DB
+        conn = sqlite3.connect('test_database.db')
+        for (name, kind) in conn.execute("select name, type from sqlite_master where type in ('table', 'view')").fetchall():
+            conn.execute('DROP {} IF EXISTS "{}"'.format(kind, name))
+        conn.execute('PRAGMA user_version = 0')
+        migrate(conn)
+        conn.close()
+
+        self.device_uuid = 'test_device'
+
+        app.config['TESTING'] = True
+        app.config['INGEST_QUEUE'] = True
+
+        self.client = app.test_client
+
+    def tearDown(self):
+        close_ingest_queues()
+        app.config['INGEST_QUEUE'] = False
+        app.config['INGEST_DURABLE_ACK'] = False
+
+    def _count_readings(self):
+        conn = sqlite3.connect('test_database.db')
+        return conn.execute('select count(*) from readings').fetchone()[0]
+
+    def test_queue_group_commits(self):
+        # Given an ingest queue with a long flush interval
+        ingest_queue = IngestQueue('test_database.db', batch_size=5, flush_interval=10)
+
+        # When we queue more rows than fit in one group commit
+        tickets = [ingest_queue.put([(self.device_uuid, 'temperature', i, i)]) for i in range(12)]
+
+        # Then the full groups should be committed without waiting for the interval
+        for ticket in tickets[:10]:
+            ticket.wait(timeout=5)
+        self.assertGreaterEqual(self._count_readings(), 10)
+
+        # And closing the queue should drain the rest
+        ingest_queue.close()
+        self.assertEqual(self._count_readings(), 12)
+
+    def test_queue_full(self):
+        # Given an ingest queue that holds a single batch and a stalled writer
+        with mock.patch.object(IngestQueue, '_run'):
+            ingest_queue = IngestQueue('test_database.db', maxsize=1)
+
+        # When more batches arrive than fit
+        ingest_queue.put([(self.device_uuid, 'temperature', 1, 1)])
+
+        # Then the queue should refuse them
+        with self.assertRaises(IngestQueueFull):
+            ingest_queue.put([(self.device_uuid, 'temperature', 1, 1)])
+
+    def test_put_batches_all_or_nothing(self):
+        # Given two ingest queues with stalled writers, one of them full
+        with mock.patch.object(IngestQueue, '_run'):
+            ingest_queues = [IngestQueue('test_database.db', maxsize=1) for _ in range(2)]
+        ingest_queues[1].put([(self.device_uuid, 'temperature', 1, 1)])
+
+        # When a batch for both of them is put
+        with self.assertRaises(IngestQueueFull):
+            put_batches({ingest_queue: [(self.device_uuid, 'temperature', 2, 2)] for ingest_queue in ingest_queues})
+
+        # Then none of its rows should have been queued
+        self.assertFalse(ingest_queues[0].full())
+
+    def test_writer_failure_fails_tickets(self):
+        # Given an ingest queue whose writer fails to open the database once
+        # a batch has been put on it
+        queued = threading.Event()
+
+        def migrate_fails(conn):
+            queued.wait(5)
+            raise sqlite3.OperationalError('disk I/O error')
+
+        with mock.patch('ingest.migrate', side_effect=migrate_fails):
+            ingest_queue = IngestQueue('test_database.db')
+            ticket = ingest_queue.put([(self.device_uuid, 'temperature', 1, 1)])
+            queued.set()
+
+            # When the request waits on its readings
+            # Then it should get the error rather than hang
+            with self.assertRaises(sqlite3.OperationalError):
+                ticket.wait(timeout=5)
+            ingest_queue._thread.join(5)
+
+        # And the queue should refuse any more
+        with self.assertRaises(IngestQueueFull):
+            ingest_queue.put([(self.device_uuid, 'temperature', 1, 1)])
+
+    def test_device_readings_post_queued(self):
+        # Given the app in queued ingest mode
+        # When we POST a reading
+        request = self.client().post(
+            '/devices/{}/readings/'.format(self.device_uuid),
+            data=json.dumps({'type': 'temperature', 'value': 100}))
+
+        # Then we should receive a 202
+        self.assertEqual(request.status_code, 202)
+
+        # And the reading should be in the db once the queue is drained
+        close_ingest_queues()
+        self.assertEqual(self._count_readings(), 1)
+
+    def test_device_readings_post_durable_ack(self):
+        # Given the app in queued ingest mode with durable acks
+        app.config['INGEST_DURABLE_ACK'] = True
+
+        # When we POST a batch of readings
+        request = self.client().post(
+            '/devices/{}/readings/'.format(self.device_uuid),
+            data=json.dumps([{'type': 'temperature', 'value': 100}, {'type': 'humidity', 'value': 50}]))
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(json.loads(request.data)['inserted'], 2)
+
+        # And the readings should already be committed
+        self.assertEqual(self._count_readings(), 2)
+
+    def test_device_readings_post_backpressure(self):
+        # Given the app in queued ingest mode with a full queue
+        with mock.patch.object(IngestQueue, 'put', side_effect=IngestQueueFull):
+            # When we POST a reading
+            request = self.client().post(
+                '/devices/{}/readings/'.format(self.device_uuid),
+                data=json.dumps({'type': 'temperature', 'value': 100}))
+
+        # Then we should be told to back off
+        self.assertEqual(request.status_code, 503)
+        self.assertEqual(request.headers['Retry-After'], '1')
@@ -0,0 +1,121 @@
+import sqlite3
+import time
+import unittest
+import instrumentation
+from app import app
+from db import migrate, partition_table
+from ingest import insert_readings
+from instrumentation import InstrumentedConnection, TimingHistogram, timed
+
+
+class InstrumentationTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup an empty SQLite DB
+        conn = sqlite3.connect('test_database.db')
+        for (name, kind) in conn.execute("select name, type from sqlite_master where type in ('table', 'view')").fetchall():
+            conn.execute('DROP {} IF EXISTS "{}"'.format(kind, name))
+        conn.execute('PRAGMA user_version = 0')
+        migrate(conn)
+        insert_readings(conn, [('test_device', 'temperature', value, 100 + value) for value in range(10)])
+        conn.close()
+
+        self.device_uuid = 'test_device'
+
+        app.config['TESTING'] = True
+
+        self.client = app.test_client
+
+    def tearDown(self):
+        instrumentation.configure(app.config['SLOW_QUERY_THRESHOLD'], app.config['SLOW_QUERY_EXPLAIN_INTERVAL'])
+
+    def test_phases_are_exclusive(self):
+        # Given a phase nested in another
+        timer = instrumentation.start_request({})
+        with timed('materialization'):
+            time.sleep(0.01)
+            with timed('sql'):
+                time.sleep(0.02)
+        instrumentation.finish_request(timer)
+
+        # Then the inner phase should not count towards the outer one
+        self.assertGreaterEqual(timer.totals['sql'], 0.02)
+        self.assertGreaterEqual(timer.totals['materialization'], 0.01)
+        self.assertLess(timer.totals['materialization'], 0.02)
+        self.assertIsNone(instrumentation.current_timer())
+
+    def test_cursor_counts_as_sql(self):
+        # Given an instrumented connection
+        conn = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+
+        # When we step through a query while a request is timed
+        timer = instrumentation.start_request({})
+        rows = list(conn.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000) '
+                                 'SELECT i FROM n'))
+        instrumentation.finish_request(timer)
+
+        # Then we should get the rows, with the time counted as sql
+        self.assertEqual(len(rows), 1000)
+        self.assertEqual(list(timer.totals), ['sql'])
+
+    def test_slow_query_plan(self):
+        # Given every statement counting as slow
+        instrumentation.configure(0, explain_interval=60)
+        conn = sqlite3.connect('test_database.db', factory=InstrumentedConnection)
+
+        # When the same query runs twice
+        for _ in range(2):
+            conn.execute('SELECT value FROM {} WHERE device_id = ? AND type = ?'.format(partition_table(0)),
+                         (1, 1)).fetchall()
+        conn.close()
+
+        # Then it should be counted twice, with the partition folded out of its query and plan
+        lines = instrumentation.get_slow_queries().render()
+        sample = [line for line in lines if line.startswith('canary_slow_queries_total{query="SELECT value')]
+        self.assertEqual(len(sample), 1)
+        self.assertIn('query="SELECT value FROM readings_* WHERE device_id = ? AND type = ?"', sample[0])
+        self.assertIn('SEARCH readings_* USING COVERING INDEX', sample[0])
+        self.assertTrue(sample[0].endswith(' 2'))
+
+    def test_histogram_buckets_are_cumulative(self):
+        # Given a histogram with a few observations
+        histogram = TimingHistogram('test_seconds', 'Test', ('route',), buckets=(0.1, 1))
+        for seconds in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(('/test/',), seconds)
+
+        # Then it should render in the Prometheus text format
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{route="/test/",le="0.1"} 1',
+            'test_seconds_bucket{route="/test/",le="1"} 3',
+            'test_seconds_bucket{route="/test/",le="+Inf"} 4',
+            'test_seconds_sum{route="/test/"} 6.05',
+            'test_seconds_count{route="/test/"} 4',
+        ])
+
+    def test_metrics_endpoint(self):
+        # Given a metric request and a streamed one
+        self.client().get('/devices/{}/readings/max/?type=temperature'.format(self.device_uuid))
+        response = self.client().get('/devices/{}/readings/?type=temperature'.format(self.device_uuid))
+        response.get_data()
+        response.close()
+
+        # When we GET the metrics
+        request = self.client().get('/metrics')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, 'text/plain')
+        text = request.data.decode()
+
+        # Then the requests should be timed by route, metric and type
+        route = '/devices/<string:device_uuid>/readings/max/'
+        self.assertIn('canary_request_duration_seconds_count{{route="{}",method="GET",metric="max",'
+                      'type="temperature",status="200"}}'.format(route), text)
+        for phase in ['validation', 'sql', 'materialization', 'serialization']:
+            self.assertIn('canary_request_phase_seconds_count{{route="{}",metric="max",type="temperature",'
+                          'phase="{}"}}'.format(route, phase), text)
+
+        # And the phases of the streamed response too
+        self.assertIn('canary_request_phase_seconds_count{route="/devices/<string:device_uuid>/readings/",'
+                      'metric="",type="temperature",phase="serialization"}', text)
+        self.assertIn('canary_db_pool_connections{state="open"}', text)
@@ -0,0 +1,150 @@
+import random
+import sqlite3
+import unittest
+from unittest import mock
+import latest
+from db import Connection, migrate
+from ingest import insert_readings
+from latest import LatestIndex, batch_latest_readings, latest_readings
+from retention import expire_partitions
+
+
+class LatestIndexTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup an in-memory DB with readings spread over several weekly partitions
+        self.conn = sqlite3.connect(':memory:', factory=Connection)
+        migrate(self.conn)
+
+        generator = random.Random(5)
+        self.devices = ['device_{}'.format(i) for i in range(50)]
+        # Unique dates, so there are no ties for the latest reading
+        dates = generator.sample(range(0, 60 * 86400), 5000)
+        insert_readings(self.conn, [(generator.choice(self.devices), generator.choice(['temperature', 'humidity']),
+                                     generator.randint(0, 100), date) for date in dates])
+        # One device only reported early on
+        insert_readings(self.conn, [('early_device', 'temperature', 7, 5)])
+        self.devices.append('early_device')
+
+    def _expected(self):
+        return {device: latest_readings(self.conn, device) for device in self.devices}
+
+    def test_warm_load_matches_queries(self):
+        # Given an index warmed from the database
+        index = LatestIndex()
+        index.load(self.conn)
+
+        # Then it should hold the latest reading of every device and type
+        self.assertEqual({device: latest_readings(self.conn, device, index=index) for device in self.devices},
+                         self._expected())
+        self.assertEqual(len(index), sum(len(latest) for latest in self._expected().values()))
+
+        # And the batch form should agree
+        self.assertEqual(batch_latest_readings(self.conn, self.devices + ['unknown'], index=index),
+                         dict(self._expected(), unknown={}))
+
+    def test_lookup_follows_write_versions(self):
+        # Given a warm index
+        index = LatestIndex()
+        index.load(self.conn)
+
+        # When newer, older and tied readings are written, including for a new
+        # device, without the index being told
+        rows = [('device_1', 'temperature', 42, 10 ** 8), ('device_2', 'humidity', 3, 1),
+                ('new_device', 'humidity', 99, 10 ** 8), ('new_device', 'humidity', 98, 10 ** 8)]
+        insert_readings(self.conn, rows)
+        self.devices.append('new_device')
+
+        # Then lookups should see them, the last written winning ties
+        self.assertEqual(latest_readings(self.conn, 'device_1', 'temperature', index), {'temperature': (42, 10 ** 8)})
+        self.assertEqual(latest_readings(self.conn, 'new_device', index=index), {'humidity': (98, 10 ** 8)})
+        self.assertEqual({device: latest_readings(self.conn, device, index=index) for device in self.devices},
+                         self._expected())
+
+    def test_queries_match_readings(self):
+        # Given the readings as the view returns them, dated uniquely
+        expected = {device: {} for device in self.devices}
+        for device, sensor_type, value, date_created in self.conn.execute(
+                'select device_uuid, type, value, date_created from readings order by date_created'):
+            expected[device][sensor_type] = (value, date_created)
+
+        # Then the latest readings should be found from the rollups and the
+        # partitions they point to
+        self.assertEqual(self._expected(), expected)
+
+    def test_update_from_commits(self):
+        # Given a warm index
+        index = LatestIndex()
+        index.load(self.conn)
+
+        # When it takes in commits, with newer, older and tied readings and
+        # a type the device had no readings of
+        device = self.conn.device_ids['device_1']
+        rows = [('device_1', 'temperature', 42, 10 ** 8), ('device_1', 'temperature', 43, 10 ** 8),
+                ('device_2', 'humidity', 3, 1), ('early_device', 'humidity', 50, 6)]
+        index.update(rows, insert_readings(self.conn, rows))
+
+        # Then lookups should answer them without reading any device again,
+        # the last written winning ties
+        with mock.patch('latest._query_latest', wraps=latest._query_latest) as query_latest:
+            readings = batch_latest_readings(self.conn, self.devices, index=index)
+        self.assertEqual(query_latest.call_count, 0)
+        self.assertEqual(readings['device_1']['temperature'], (43, 10 ** 8))
+        self.assertEqual(readings['early_device'], {'temperature': (7, 5), 'humidity': (50, 6)})
+        self.assertEqual(readings, self._expected())
+
+        # And a commit following one it missed should leave the device to be
+        # read again
+        insert_readings(self.conn, [('device_1', 'humidity', 1, 10 ** 8)])
+        rows = [('device_1', 'temperature', 44, 10 ** 8 + 1)]
+        index.update(rows, insert_readings(self.conn, rows))
+        self.assertEqual(index.get(device, 2), readings['device_1']['humidity'])
+        with mock.patch('latest._query_latest', wraps=latest._query_latest) as query_latest:
+            self.assertEqual(latest_readings(self.conn, 'device_1', index=index),
+                             {'temperature': (44, 10 ** 8 + 1), 'humidity': (1, 10 ** 8)})
+        self.assertEqual(query_latest.call_count, 1)
+
+    def test_reread_skips_absent_types(self):
+        # Given a warm index, and a device with temperatures only written to
+        # behind its back
+        index = LatestIndex()
+        index.load(self.conn)
+        insert_readings(self.conn, [('early_device', 'temperature', 8, 6)])
+
+        # When it is looked up
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        readings = latest_readings(self.conn, 'early_device', index=index)
+        self.conn.set_trace_callback(None)
+
+        # Then a single partition should be read, whatever the number of
+        # partitions and even with no humidity readings
+        self.assertEqual(readings, {'temperature': (8, 6)})
+        self.assertEqual(len([statement for statement in statements if 'from "readings_' in statement]), 1)
+
+    def test_lookup_only_rereads_changed_devices(self):
+        # Given a warm index
+        index = LatestIndex()
+        index.load(self.conn)
+
+        # When one device is written to
+        insert_readings(self.conn, [('device_1', 'temperature', 42, 10 ** 8)])
+        with mock.patch('latest._query_latest', wraps=latest._query_latest) as query_latest:
+            readings = batch_latest_readings(self.conn, ['device_1', 'device_2'], index=index)
+
+        # Then only that device should have been read again from the partitions
+        self.assertEqual(readings['device_1']['temperature'], (42, 10 ** 8))
+        self.assertEqual({call.args[1] for call in query_latest.call_args_list}, {self.conn.device_ids['device_1']})
+
+    def test_warm_load_skips_expired_partitions(self):
+        # Given the early partitions expired, their rollups kept
+        expire_partitions(self.conn, 14 * 86400)
+
+        # When we warm an index
+        index = LatestIndex()
+        index.load(self.conn)
+
+        # Then devices whose readings all expired should have none
+        self.assertEqual(latest_readings(self.conn, 'early_device', index=index), {})
+        self.assertEqual({device: latest_readings(self.conn, device, index=index) for device in self.devices},
+                         self._expected())
@@ -0,0 +1,94 @@
+import random
+import sqlite3
+import statistics
+import unittest
+from db import _PARTITION_DEVICES, PARTITION_SIZE, device_version, full_scans, migrate, partitions
+from ingest import insert_readings
+from retention import _HISTOGRAM_DELETE, _ROLLUP_DELETE, expire_partitions
+from retrieval import iter_readings
+from stats import compute_stats
+
+
+class RetentionTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup an in-memory DB with readings spread over 4 partitions
+        self.conn = sqlite3.connect(':memory:')
+        migrate(self.conn)
+
+        self.device_uuid = 'test_device'
+
+        generator = random.Random(13)
+        self.readings = [(generator.randint(0, 100), generator.randint(0, 4 * PARTITION_SIZE - 1)) for _ in range(2000)]
+        insert_readings(self.conn, [(self.device_uuid, 'temperature', value, date) for value, date in self.readings])
+
+    def test_queries_span_partitions(self):
+        # Given a window crossing partition boundaries
+        start, end = PARTITION_SIZE - 4000, 3 * PARTITION_SIZE + 17
+
+        # When we read the readings and compute the stats over it
+        rows = list(iter_readings(self.conn, self.device_uuid, 'temperature', start, end))
+        results = compute_stats(self.conn, self.device_uuid, 'temperature', start, end)
+
+        # Then the readings should come back in date order from every partition
+        dates = sorted(date for _, date in self.readings if start <= date < end)
+        self.assertEqual([row[4] for row in rows], dates)
+
+        # And the stats should match the raw values
+        ordered = sorted((value, date) for value, date in self.readings if start <= date < end)
+        self.assertEqual(results['mean'], round(statistics.mean(value for value, _ in ordered)))
+        median = ordered[len(ordered) // 2]
+        self.assertEqual((results['median']['value'], results['median']['date_created']), median)
+
+    def test_expire_partitions_downsample(self):
+        # Given the stats over the whole history
+        before = compute_stats(self.conn, self.device_uuid, 'temperature')
+
+        # When we expire the 2 oldest partitions and keep their aggregates
+        expired = expire_partitions(self.conn, 2 * PARTITION_SIZE + 10)
+
+        # Then only whole partitions older than the cutoff should be dropped
+        self.assertEqual(expired, [0, PARTITION_SIZE])
+        self.assertEqual(len(partitions(self.conn)), 2)
+        count, = self.conn.execute('select count(*) from readings').fetchone()
+        self.assertEqual(count, len([date for _, date in self.readings if date >= 2 * PARTITION_SIZE]))
+
+        # And the stats should still be answered from the aggregates
+        after = compute_stats(self.conn, self.device_uuid, 'temperature', metrics=['min', 'max', 'mean', 'mode'])
+        self.assertEqual(after['mean'], before['mean'])
+        self.assertEqual(after['mode'], before['mode'])
+        self.assertEqual(after['max'], before['max'])
+
+        # And new readings for an expired period should still be accepted
+        insert_readings(self.conn, [(self.device_uuid, 'temperature', 1, 5)])
+        self.assertEqual(len(partitions(self.conn)), 3)
+
+    def test_expire_partitions_without_downsample(self):
+        # When we expire the 2 oldest partitions along with their aggregates
+        expire_partitions(self.conn, 2 * PARTITION_SIZE, downsample=False)
+
+        # Then the stats should only cover the partitions left
+        results = compute_stats(self.conn, self.device_uuid, 'temperature')
+        values = [value for value, date in self.readings if date >= 2 * PARTITION_SIZE]
+        self.assertEqual(results['mean'], round(statistics.mean(values)))
+        self.assertEqual(results['min']['value'], min(values))
+
+        # And the aggregates should have been deleted with range seeks
+        self.assertEqual(full_scans(self.conn, _HISTOGRAM_DELETE, (0,)), [])
+        self.assertEqual(full_scans(self.conn, _ROLLUP_DELETE, (60, 0)), [])
+
+    def test_expire_partitions_bumps_versions(self):
+        # Given a device with readings in the expiring partitions, and one without
+        insert_readings(self.conn, [('recent_device', 'temperature', 1, 4 * PARTITION_SIZE - 1)])
+        before = device_version(self.conn, self.device_uuid)
+        recent = device_version(self.conn, 'recent_device')
+
+        # When the oldest partition expires
+        expire_partitions(self.conn, 2 * PARTITION_SIZE)
+
+        # Then only the device that lost readings should get a new version
+        self.assertEqual(device_version(self.conn, self.device_uuid)[0], before[0] + 1)
+        self.assertEqual(device_version(self.conn, 'recent_device'), recent)
+
+        # And the devices should have been found with a range seek
+        self.assertEqual(full_scans(self.conn, _PARTITION_DEVICES, (0, PARTITION_SIZE)), [])
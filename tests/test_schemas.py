@@ -0,0 +1,99 @@
+import unittest
+from unittest import mock
+from marshmallow import ValidationError
+from werkzeug.datastructures import ImmutableMultiDict
+from benchmarks.validation import benchmark_validation
+from schemas import PERCENTILE_QUERY, READING, READING_BULK, READING_QUERY, DeviceReadingBulkSchema, \
+    DeviceReadingInputSchema, DeviceReadingPercentileInputSchema, DeviceReadingSchema, FastSchema, \
+    DeviceReadingStatsInputSchema, encode_cursor
+
+
+class SchemaTestCases(unittest.TestCase):
+
+    def _assert_same(self, fast, schema, items):
+        # Every item should load to the same data, or fail with the same errors
+        with mock.patch('schemas.time.time', return_value=1700000000.5):
+            for item, result in zip(items, fast.load_many(items)):
+                try:
+                    expected = schema.load(item)
+                except ValidationError as err:
+                    self.assertIsInstance(result, ValidationError, item)
+                    self.assertEqual(result.messages, err.messages, item)
+                else:
+                    self.assertEqual(result, expected, item)
+
+    def test_fast_readings_match_marshmallow(self):
+        # Given well-formed and irregular readings
+        items = [
+            {'type': 'temperature', 'value': 10, 'date_created': 100},
+            {'type': 'humidity', 'value': 0},
+            {'type': 'humidity', 'value': '100', 'date_created': ' 5 '},
+            {'type': 'humidity', 'value': 1, 'date_created': 2 ** 41 - 1},
+            {'type': 'humidity', 'value': 1, 'date_created': str(-2 ** 41)},
+            {'type': 'humidity', 'value': 1, 'date_created': 1700000000000000},
+            {'type': 'temperature', 'value': 5.5},
+            {'type': 'pressure', 'value': 10},
+            {'type': 'temperature', 'value': 101},
+            {'type': 'temperature', 'value': True},
+            {'type': 'temperature', 'value': float('inf')},
+            {'type': 'temperature', 'value': '7.0'},
+            {'type': b'temperature', 'value': 7},
+            {'type': None, 'value': None, 'date_created': None},
+            {'type': 'temperature', 'value': 10, 'extra': 1},
+            {},
+            None,
+            [1, 2],
+        ]
+
+        # Then the precompiled loader should agree with marshmallow on all of them
+        self._assert_same(READING, DeviceReadingSchema(), items)
+        self._assert_same(READING_BULK, DeviceReadingBulkSchema(),
+                          [dict(item, device_uuid='a') if isinstance(item, dict) else item for item in items] +
+                          [{'type': 'temperature', 'value': 1, 'device_uuid': ''}])
+
+    def test_fast_queries_match_marshmallow(self):
+        # Given query strings, well-formed and not
+        queries = [
+            [('type', 'temperature')],
+            [('type', 'temperature'), ('start', '10'), ('end', '20'), ('limit', '5')],
+            [('limit', '0')],
+            [('start', '')],
+            [('cursor', encode_cursor(100, 3))],
+            [('cursor', 'nonsense')],
+            [('type', 'humidity'), ('type', 'pressure')],
+            [('unknown', '1')],
+        ]
+
+        # Then the precompiled loaders should agree with marshmallow
+        self._assert_same(READING_QUERY, DeviceReadingInputSchema(), [ImmutableMultiDict(q) for q in queries])
+        self._assert_same(PERCENTILE_QUERY, DeviceReadingPercentileInputSchema(),
+                          [ImmutableMultiDict([('type', 'temperature'), ('p', p)])
+                           for p in ['50', '99.9', '1e1', '101', 'nan', '-inf', 'x']])
+
+        # And schemas with hooks should go through marshmallow
+        stats = FastSchema(DeviceReadingStatsInputSchema())
+        self._assert_same(stats, DeviceReadingStatsInputSchema(),
+                          [ImmutableMultiDict([('type', 'temperature'), ('metrics', m)]) for m in ['min,max', 'nope']])
+
+    def test_date_created_stamped_per_request(self):
+        # Given readings loaded at different times
+        with mock.patch('schemas.time.time', side_effect=[1000.0, 2000.0, 3000.0]):
+            first = READING.load({'type': 'temperature', 'value': 1})
+            batch = READING.load_many([{'type': 'temperature', 'value': 1}, {'type': 'temperature', 'value': 1.5}])
+
+        # Then each request should get its own time, shared by its whole batch
+        self.assertEqual(first['date_created'], 1000)
+        self.assertEqual([data['date_created'] for data in batch], [2000, 2000])
+
+        # And a failed load should raise like marshmallow
+        with self.assertRaises(ValidationError):
+            READING.load({'type': 'temperature'})
+
+    def test_benchmark_validation(self):
+        # Given a small batch
+        results = benchmark_validation(count=200, repeat=1)
+
+        # Then both loaders should be timed
+        self.assertEqual(results['readings'], 200)
+        self.assertGreater(results['fast_readings_per_second'], 0)
+        self.assertGreater(results['marshmallow_readings_per_second'], 0)
@@ -1,7 +1,17 @@
+import io
 import json
+import os
 import sqlite3
+import threading
+import time
 import unittest
-from app import app
+from unittest import mock
+import columnar
+from app import app, _get_db_connection, _get_metric_cache, _get_pool, _latest_indexes
+from db import full_scans, migrate
+from ingest import insert_readings
+from schemas import MAX_DATE, encode_cursor
+from shards import shard_path, shard_paths
 
 
 class SensorRoutesTestCases(unittest.TestCase):
@@ -9,48 +19,34 @@ class SensorRoutesTestCases(unittest.TestCase):
     def setUp(self):
         # Setup the SQLite DB
         conn = sqlite3.connect('test_database.db')
-        conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        for (name, kind) in conn.execute("select name, type from sqlite_master where type in ('table', 'view')").fetchall():
+            conn.execute('DROP {} IF EXISTS "{}"'.format(kind, name))
+        conn.execute('PRAGMA user_version = 0')
+        migrate(conn)
 
         self.device_uuid = 'test_device'
 
         # Setup some sensor data
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 22, 1))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 50, 5))
-
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'humidity', 44, 7))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'humidity', 24, 10))
-
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 100, 20))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 29, 20))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 4, 25))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 28, 30))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 100, 40))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 52, 50))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 4, 50))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (self.device_uuid, 'temperature', 100, 50))
-
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    ('other_uuid', 'temperature', 22, 60))
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    ('another_uuid', 'humidity', 27, 60))
-
-        conn.commit()
+        insert_readings(conn, [
+            (self.device_uuid, 'temperature', 22, 1),
+            (self.device_uuid, 'temperature', 50, 5),
+
+            (self.device_uuid, 'humidity', 44, 7),
+            (self.device_uuid, 'humidity', 24, 10),
+
+            (self.device_uuid, 'temperature', 100, 20),
+            (self.device_uuid, 'temperature', 29, 20),
+            (self.device_uuid, 'temperature', 4, 25),
+            (self.device_uuid, 'temperature', 28, 30),
+            (self.device_uuid, 'temperature', 100, 40),
+            (self.device_uuid, 'temperature', 52, 50),
+            (self.device_uuid, 'temperature', 4, 50),
+            (self.device_uuid, 'temperature', 100, 50),
+
+            ('other_uuid', 'temperature', 22, 60),
+            ('another_uuid', 'humidity', 27, 60),
+        ])
+        conn.close()
 
         app.config['TESTING'] = True
 
@@ -272,3 +268,596 @@ class SensorRoutesTestCases(unittest.TestCase):
 
         # And the response data should have a value for the q3 of 100
         self.assertTrue(res['quartile_3'] == 100)
+
+    def test_endpoint_query_plans_use_index(self):
+        """
+        Every endpoint query should be answered with range seeks on the
+        readings index and never fall back to a full SCAN.
+        """
+        # Given a connection that records every statement it executes
+        statements = []
+        connections = []
+
+        def traced_connection(device_uuid):
+            conn = _get_db_connection(device_uuid)
+            conn.set_trace_callback(statements.append)
+            connections.append(conn)
+            return conn
+
+        # When we hit every endpoint with and without the optional parameters
+        urls = ['/devices/{}/readings/'.format(self.device_uuid),
+                '/devices/{}/readings/?type=temperature&start=1&end=30'.format(self.device_uuid),
+                '/devices/{}/readings/?limit=2&cursor={}'.format(self.device_uuid, encode_cursor(20, 5))]
+        for metric in ['min', 'max', 'median', 'mean', 'mode', 'stats']:
+            urls.append('/devices/{}/readings/{}/?type=temperature'.format(self.device_uuid, metric))
+            urls.append('/devices/{}/readings/{}/?type=temperature&start=1&end=30'.format(self.device_uuid, metric))
+        urls.append('/devices/{}/readings/quartiles/?type=temperature&start=1&end=101'.format(self.device_uuid))
+        urls.append('/devices/{}/readings/percentile/?type=temperature&p=95&start=1&end=7201'.format(self.device_uuid))
+
+        with mock.patch('app._get_db_connection', traced_connection):
+            for url in urls:
+                self.assertEqual(self.client().get(url).status_code, 200)
+
+        # The connections are pooled, so stop tracing them
+        for conn in connections:
+            conn.set_trace_callback(None)
+
+        # Then none of the executed queries should need a full scan
+        conn = sqlite3.connect('test_database.db')
+        self.assertTrue(statements)
+        for statement in statements:
+            self.assertEqual(full_scans(conn, statement), [], statement)
+
+    def test_device_readings_post_batch(self):
+        # Given a device UUID
+        # When we POST a JSON array of readings with one invalid item
+        request = self.client().post(
+            '/devices/{}/readings/'.format(self.device_uuid),
+            data=json.dumps([
+                {'type': 'temperature', 'value': 10, 'date_created': 100},
+                {'type': 'pressure', 'value': 10, 'date_created': 101},
+                {'type': 'humidity', 'value': 30, 'date_created': 102},
+            ]))
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        res = json.loads(request.data)
+
+        # And the two valid readings should have been inserted
+        self.assertEqual(res['inserted'], 2)
+
+        # And the invalid one reported by its index
+        self.assertEqual(list(res['errors']), ['1'])
+        self.assertIn('type', res['errors']['1'])
+
+        request = self.client().get('/devices/{}/readings/?start=100'.format(self.device_uuid))
+        self.assertEqual(len(json.loads(request.data)), 2)
+
+    def test_device_readings_post_ndjson(self):
+        # Given a device UUID
+        # When we POST NDJSON readings
+        request = self.client().post(
+            '/devices/{}/readings/'.format(self.device_uuid),
+            content_type='application/x-ndjson',
+            data='{"type": "temperature", "value": 10, "date_created": 100}\n'
+                 '{"type": "temperature", "value": 11, "date_created": 101}\n'
+                 'not json\n')
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        res = json.loads(request.data)
+
+        # And the valid lines should have been inserted
+        self.assertEqual(res['inserted'], 2)
+
+        # And the malformed line reported as an error
+        self.assertEqual(list(res['errors']), ['2'])
+
+    def test_readings_bulk_post(self):
+        # Given readings for several devices
+        # When we POST them to the fleet bulk endpoint
+        request = self.client().post(
+            '/readings/bulk/',
+            data=json.dumps([
+                {'device_uuid': 'bulk_a', 'type': 'temperature', 'value': 10, 'date_created': 100},
+                {'device_uuid': 'bulk_b', 'type': 'humidity', 'value': 20, 'date_created': 100},
+                {'type': 'humidity', 'value': 20, 'date_created': 100},
+            ]))
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        res = json.loads(request.data)
+
+        # And the readings with a device_uuid should have been inserted
+        self.assertEqual(res['inserted'], 2)
+        self.assertIn('device_uuid', res['errors']['2'])
+
+        for device_uuid in ['bulk_a', 'bulk_b']:
+            request = self.client().get('/devices/{}/readings/'.format(device_uuid))
+            self.assertEqual(len(json.loads(request.data)), 1)
+
+    def test_readings_bulk_post_all_invalid(self):
+        # Given a batch where no reading is valid
+        # When we POST it to the fleet bulk endpoint
+        request = self.client().post(
+            '/readings/bulk/',
+            data=json.dumps([{'device_uuid': 'bulk_a', 'type': 'temperature', 'value': 101}]))
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(json.loads(request.data)['inserted'], 0)
+
+    def test_readings_post_malformed_json(self):
+        # Given a body that is not valid JSON
+        for path in ['/devices/{}/readings/'.format(self.device_uuid), '/readings/bulk/']:
+            # When we POST it as JSON
+            request = self.client().post(path, data='[{"type": "temperature",')
+
+            # Then we should receive a 400 saying so
+            self.assertEqual(request.status_code, 400)
+            self.assertEqual(json.loads(request.data), {'_schema': ['Invalid JSON.']})
+
+    def test_db_pool_reuses_connections(self):
+        # Given a few requests to warm up the connection pool
+        for _ in range(3):
+            self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+        before = json.loads(self.client().get('/db/pool/').data)
+
+        # When we make more requests
+        for _ in range(5):
+            self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+
+        # Then every one of them should have reused a pooled connection
+        after = json.loads(self.client().get('/db/pool/').data)
+        self.assertEqual(after['hits'] - before['hits'], 5)
+        self.assertEqual(after['misses'], before['misses'])
+
+    def test_device_readings_percentile(self):
+        # Given a device UUID and sensor type
+        # When we request the 90th percentile
+        request = self.client().get('/devices/{}/readings/percentile/?type=temperature&p=90'.format(self.device_uuid))
+
+        # Then we should receive a 200
+        self.assertEqual(request.status_code, 200)
+
+        res = json.loads(request.data)
+
+        # And the response data should have a value for the p90 of 100
+        self.assertTrue(res['value'] == 100)
+
+    def test_device_readings_metric_no_readings(self):
+        # Given a date range with no readings
+        # When we request the median over it
+        request = self.client().get('/devices/{}/readings/median/?type=temperature&start=1000'.format(self.device_uuid))
+
+        # Then we should receive a 404
+        self.assertEqual(request.status_code, 404)
+
+    def test_device_readings_stats(self):
+        # Given a device UUID and sensor type
+        # When we request every metric at once
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature'.format(self.device_uuid))
+
+        # Then we should receive a 200
+        self.assertEqual(request.status_code, 200)
+
+        res = json.loads(request.data)
+
+        # And the metrics should match the per-metric endpoints
+        for metric in ['min', 'max', 'median', 'mean', 'mode']:
+            single = json.loads(self.client().get(
+                '/devices/{}/readings/{}/?type=temperature'.format(self.device_uuid, metric)).data)
+            if metric in ('mean', 'mode'):
+                single = single['value']
+            self.assertEqual(res[metric], single)
+
+        self.assertEqual(res['quartiles'], {'quartile_1': 22, 'quartile_3': 100})
+
+    def test_device_readings_stats_metrics_subset(self):
+        # Given a device UUID and sensor type
+        # When we request a subset of the metrics
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature&metrics=min,mode'.format(self.device_uuid))
+
+        # Then we should only receive those metrics
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(set(json.loads(request.data)), {'min', 'mode'})
+
+        # And unknown metrics should be rejected
+        request = self.client().get('/devices/{}/readings/stats/?type=temperature&metrics=min,p99'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_series(self):
+        # Given a device UUID and sensor type
+        # When we request 10 second buckets of its temperatures
+        request = self.client().get('/devices/{}/readings/series/?type=temperature&start=0&end=60&interval=10'.format(
+            self.device_uuid))
+
+        # Then we should receive the aggregates of every bucket with readings
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data)['points'], [
+            {'start': 0, 'count': 2, 'min': 22, 'max': 50, 'mean': 36.0},
+            {'start': 20, 'count': 3, 'min': 4, 'max': 100, 'mean': 44.33},
+            {'start': 30, 'count': 1, 'min': 28, 'max': 28, 'mean': 28.0},
+            {'start': 40, 'count': 1, 'min': 100, 'max': 100, 'mean': 100.0},
+            {'start': 50, 'count': 3, 'min': 4, 'max': 100, 'mean': 52.0},
+        ])
+
+        # And LTTB should keep the first and last readings
+        points = json.loads(self.client().get(
+            '/devices/{}/readings/series/?type=temperature&start=0&end=60&points=3&method=lttb'.format(
+                self.device_uuid)).data)['points']
+        self.assertEqual(points[0], {'date_created': 1, 'value': 22})
+        self.assertEqual(points[-1], {'date_created': 50, 'value': 100})
+
+        # And asking for both an interval and points should be rejected
+        request = self.client().get('/devices/{}/readings/series/?type=temperature&start=0&end=60&interval=10&points=3'
+                                    .format(self.device_uuid))
+        self.assertEqual(request.status_code, 400)
+
+    def test_batch_stats(self):
+        # Given several device UUIDs, one without readings
+        devices = [self.device_uuid, 'other_uuid', 'unknown_uuid']
+
+        # When we request their mean and max in one batch
+        request = self.client().post('/readings/batch/stats/', data=json.dumps({
+            'devices': devices, 'type': 'temperature', 'metrics': ['mean', 'max']}))
+
+        # Then we should receive the metrics keyed by device
+        self.assertEqual(request.status_code, 200)
+        res = json.loads(request.data)
+        self.assertEqual(res['other_uuid'], {
+            'mean': 22, 'max': {'device_uuid': 'other_uuid', 'type': 'temperature', 'value': 22, 'date_created': 60}})
+        self.assertIsNone(res['unknown_uuid'])
+
+        # And they should match the per-device endpoint
+        single = json.loads(self.client().get(
+            '/devices/{}/readings/stats/?type=temperature&metrics=mean,max'.format(self.device_uuid)).data)
+        self.assertEqual(res[self.device_uuid], single)
+
+        # And unknown metrics should be rejected
+        request = self.client().post('/readings/batch/stats/', data=json.dumps({
+            'devices': devices, 'type': 'temperature', 'metrics': ['p99']}))
+        self.assertEqual(request.status_code, 400)
+
+    def test_batch_stats_date_bounds(self):
+        # Given readings dated at the bounds of what the API accepts
+        for value, date_created in [(40, -MAX_DATE), (60, MAX_DATE)]:
+            request = self.client().post('/devices/bounded_uuid/readings/', data=json.dumps(
+                {'type': 'temperature', 'value': value, 'date_created': date_created}))
+            self.assertEqual(request.status_code, 201)
+
+        # When we request their min and max in a batch
+        request = self.client().post('/readings/batch/stats/', data=json.dumps({
+            'devices': ['bounded_uuid'], 'type': 'temperature', 'metrics': ['min', 'max']}))
+
+        # Then the readings should come back as they were written, as from
+        # the per-device endpoint
+        res = json.loads(request.data)['bounded_uuid']
+        self.assertEqual((res['min']['value'], res['min']['date_created']), (40, -MAX_DATE))
+        self.assertEqual((res['max']['value'], res['max']['date_created']), (60, MAX_DATE))
+        self.assertEqual(res, json.loads(self.client().get(
+            '/devices/bounded_uuid/readings/stats/?type=temperature&metrics=min,max').data))
+
+        # And a date past them, e.g. in microseconds, should be rejected
+        request = self.client().post('/devices/bounded_uuid/readings/', data=json.dumps(
+            {'type': 'temperature', 'value': 50, 'date_created': 1700000000000000}))
+        self.assertEqual(request.status_code, 400)
+        self.assertIn('epoch seconds', request.data.decode())
+
+    def test_device_readings_stream(self):
+        # Given a client subscribed to a device's temperatures
+        stream = self.client().get('/devices/{}/readings/stream/?type=temperature'.format(self.device_uuid),
+                                   buffered=False)
+        self.assertEqual(stream.status_code, 200)
+        self.assertEqual(stream.mimetype, 'text/event-stream')
+
+        # When readings are posted for it
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid),
+                           data=json.dumps({'type': 'humidity', 'value': 10, 'date_created': 100}))
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid),
+                           data=json.dumps({'type': 'temperature', 'value': 20, 'date_created': 101}))
+
+        # Then the matching one should be pushed as an event
+        chunks = iter(stream.response)
+        self.assertEqual(next(chunks), b'retry: 1000\n\n')
+        event = next(chunks).decode()
+        self.assertIn('"value":20', event)
+        stream.close()
+
+        # And a fleet stream resuming from its id should not replay it
+        event_id = event.split('\n')[0][len('id: '):]
+        stream = self.client().get('/readings/stream/', headers={'Last-Event-ID': event_id}, buffered=False)
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid),
+                           data=json.dumps({'type': 'humidity', 'value': 30, 'date_created': 102}))
+        chunks = iter(stream.response)
+        next(chunks)
+        self.assertIn('"value":30', next(chunks).decode())
+        stream.close()
+
+    def test_device_readings_latest(self):
+        # Given a device UUID
+        # When we request its latest readings
+        request = self.client().get('/devices/{}/readings/latest/'.format(self.device_uuid))
+
+        # Then we should receive the latest of each type, the last written winning ties
+        self.assertEqual(request.status_code, 200)
+        expected = {
+            'temperature': {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 100, 'date_created': 50},
+            'humidity': {'device_uuid': self.device_uuid, 'type': 'humidity', 'value': 24, 'date_created': 10},
+        }
+        self.assertEqual(json.loads(request.data), expected)
+
+        # And the in-process index should answer the same, taking new readings in
+        app.config['LATEST_INDEX'] = True
+        _latest_indexes.clear()
+        try:
+            self.client().post('/devices/{}/readings/'.format(self.device_uuid),
+                               data=json.dumps({'type': 'humidity', 'value': 60, 'date_created': 70}))
+            expected['humidity'].update(value=60, date_created=70)
+            self.assertEqual(json.loads(self.client().get(
+                '/devices/{}/readings/latest/'.format(self.device_uuid)).data), expected)
+
+            # And readings written by another connection, as another worker would
+            conn = sqlite3.connect('test_database.db')
+            insert_readings(conn, [(self.device_uuid, 'humidity', 90, 80)])
+            conn.close()
+            expected['humidity'].update(value=90, date_created=80)
+            self.assertEqual(json.loads(self.client().get(
+                '/devices/{}/readings/latest/'.format(self.device_uuid)).data), expected)
+
+            # And the batch form should return them by device
+            request = self.client().post('/readings/batch/latest/', data=json.dumps({
+                'devices': [self.device_uuid, 'other_uuid', 'unknown_uuid'], 'type': 'temperature'}))
+            self.assertEqual(json.loads(request.data), {
+                self.device_uuid: {'temperature': expected['temperature']},
+                'other_uuid': {'temperature': {'device_uuid': 'other_uuid', 'type': 'temperature', 'value': 22,
+                                               'date_created': 60}},
+                'unknown_uuid': None,
+            })
+        finally:
+            app.config['LATEST_INDEX'] = None
+            _latest_indexes.clear()
+
+        # And a device without readings should get a 404
+        self.assertEqual(self.client().get('/devices/unknown_uuid/readings/latest/').status_code, 404)
+
+    def test_conditional_get(self):
+        # Given the ETag of a device's readings and of one of its metrics
+        url = '/devices/{}/readings/'.format(self.device_uuid)
+        first = self.client().get(url)
+        etag = first.headers['ETag']
+        first.close()
+        metric_etag = self.client().get(url + 'max/?type=temperature').headers['ETag']
+
+        # When we ask again with it
+        with mock.patch('app.iter_readings', side_effect=AssertionError('readings were read')), \
+                mock.patch('app.compute_stats', side_effect=AssertionError('readings were read')):
+            request = self.client().get(url, headers={'If-None-Match': etag})
+            metric_request = self.client().get(url + 'max/?type=temperature', headers={'If-None-Match': metric_etag})
+
+        # Then we should get a 304 without the readings being read
+        self.assertEqual(request.status_code, 304)
+        self.assertEqual(request.data, b'')
+        self.assertEqual(metric_request.status_code, 304)
+
+        # And another format of the same readings should not match
+        request = self.client().get(url, headers={'If-None-Match': etag, 'Accept': 'application/x-ndjson'})
+        self.assertEqual(request.status_code, 200)
+        request.close()
+
+        # And a write from another connection, as another worker would, should change it
+        conn = sqlite3.connect('test_database.db')
+        insert_readings(conn, [(self.device_uuid, 'humidity', 1, 1000)])
+        conn.close()
+        request = self.client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 200)
+        self.assertNotEqual(request.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(request.data)), 13)
+
+        # And other devices should keep theirs
+        other = self.client().get('/devices/other_uuid/readings/')
+        other.close()
+        self.assertEqual(self.client().get('/devices/other_uuid/readings/', headers={
+            'If-None-Match': other.headers['ETag']}).status_code, 304)
+
+    def test_device_readings_get_paginated(self):
+        # Given a device UUID
+        # When we page through its readings three at a time
+        pages = []
+        cursor = None
+        while True:
+            query_string = {'limit': 3}
+            if cursor:
+                query_string['cursor'] = cursor
+            request = self.client().get('/devices/{}/readings/'.format(self.device_uuid), query_string=query_string)
+            self.assertEqual(request.status_code, 200)
+
+            pages.append(json.loads(request.data))
+            cursor = request.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+
+        # Then we should receive every reading exactly once, in date order
+        self.assertEqual([len(page) for page in pages], [3, 3, 3, 3])
+        dates = [x['date_created'] for page in pages for x in page]
+        self.assertEqual(dates, sorted(dates))
+
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+        self.assertEqual(sorted(json.dumps(x, sort_keys=True) for page in pages for x in page),
+                         sorted(json.dumps(x, sort_keys=True) for x in json.loads(request.data)))
+
+    def test_device_readings_get_invalid_cursor(self):
+        # Given a device UUID
+        # When we make a request with a cursor we did not hand out
+        request = self.client().get('/devices/{}/readings/?cursor=nonsense'.format(self.device_uuid))
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+        self.assertIn('cursor', json.loads(request.data))
+
+    def test_device_readings_get_ndjson(self):
+        # Given a device UUID
+        # When we ask for its temperature readings as NDJSON
+        request = self.client().get('/devices/{}/readings/?type=temperature'.format(self.device_uuid),
+                                    headers={'Accept': 'application/x-ndjson'})
+
+        # Then we should receive a 200
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, 'application/x-ndjson')
+
+        # And one reading per line
+        res = [json.loads(line) for line in request.data.splitlines()]
+        self.assertEqual(len(res), 10)
+        self.assertTrue(all([x['type'] == 'temperature' for x in res]))
+
+    def test_device_readings_get_columnar(self):
+        # Given a device UUID
+        # When we ask for its readings in the columnar format
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+                                    headers={'Accept': columnar.MIMETYPE})
+
+        # Then we should receive a 200
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, columnar.MIMETYPE)
+
+        # And it should decode to the same readings as the JSON
+        res = list(columnar.decode_readings(io.BytesIO(request.data)))
+        expected = json.loads(self.client().get('/devices/{}/readings/'.format(self.device_uuid)).data)
+        self.assertEqual(res, expected)
+
+    def test_readings_export(self):
+        # Given readings for several devices
+        # When we export the temperature readings of the whole fleet
+        request = self.client().get('/readings/export/?type=temperature')
+
+        # Then we should receive a 200 in the columnar format
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, columnar.MIMETYPE)
+
+        res = list(columnar.decode_readings(io.BytesIO(request.data)))
+
+        # And the response data should have the eleven temperature readings
+        self.assertEqual(len(res), 11)
+        self.assertEqual({x['device_uuid'] for x in res}, {self.device_uuid, 'other_uuid'})
+
+    def test_device_readings_metric_cache(self):
+        # Given the metric cache turned on
+        app.config['METRIC_CACHE'] = True
+        self.addCleanup(app.config.update, METRIC_CACHE=None)
+        self.addCleanup(_get_metric_cache().clear)
+
+        url = '/devices/{}/readings/min/?type=temperature&start=1&end=30'.format(self.device_uuid)
+
+        # When we request the same metric twice
+        before = json.loads(self.client().get('/cache/').data)
+        first = json.loads(self.client().get(url).data)
+        second = json.loads(self.client().get(url).data)
+
+        # Then the second request should be served from the cache
+        self.assertEqual(first, second)
+        self.assertEqual(first['value'], 4)
+        after = json.loads(self.client().get('/cache/').data)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+        # And inserting a reading into the window should invalidate it
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid),
+                           data=json.dumps({'type': 'temperature', 'value': 1, 'date_created': 3}))
+        self.assertEqual(json.loads(self.client().get(url).data)['value'], 1)
+
+        # And so should a reading written by another connection, as another
+        # worker or the bulk loader would
+        conn = sqlite3.connect('test_database.db')
+        insert_readings(conn, [(self.device_uuid, 'temperature', 0, 2)])
+        conn.close()
+        self.assertEqual(json.loads(self.client().get(url).data)['value'], 0)
+
+        # And writes outside the window, from this process or another one,
+        # should leave it cached
+        before = json.loads(self.client().get('/cache/').data)
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid),
+                           data=json.dumps({'type': 'temperature', 'value': 1, 'date_created': 5000}))
+        conn = sqlite3.connect('test_database.db')
+        insert_readings(conn, [(self.device_uuid, 'temperature', 0, 6000), (self.device_uuid, 'humidity', 0, 2)])
+        conn.close()
+        self.assertEqual(json.loads(self.client().get(url).data)['value'], 0)
+        after = json.loads(self.client().get('/cache/').data)
+        self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses'],
+                          after['invalidations'] - before['invalidations']), (1, 0, 0))
+
+    def test_fleet_stats(self):
+        # Given readings for several devices
+        # When we request the fleet wide temperature stats
+        request = self.client().get('/readings/fleet/stats/?type=temperature&percentiles=50,90')
+
+        # Then we should receive a 200
+        self.assertEqual(request.status_code, 200)
+
+        res = json.loads(request.data)
+
+        # And the stats should cover both devices with temperature readings
+        self.assertEqual(res['devices'], 2)
+        self.assertEqual(res['count'], 11)
+        self.assertEqual(res['min']['value'], 4)
+        self.assertEqual(res['max'], {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 100, 'date_created': 20})
+        self.assertEqual(res['percentiles'], {'50': 29, '90': 100})
+
+        # And we should be able to limit it to a set of devices
+        request = self.client().get('/readings/fleet/stats/?type=temperature&devices=other_uuid')
+        self.assertEqual(json.loads(request.data)['count'], 1)
+
+    def test_sharded_routing(self):
+        # Given readings spread over 2 shards
+        app.config['SHARD_COUNT'] = 2
+        self.addCleanup(self._remove_shards)
+        readings = [{'device_uuid': 'shard_{}'.format(i), 'type': 'temperature', 'value': i, 'date_created': 100 + i}
+                    for i in range(10)]
+
+        # When we POST them to the fleet bulk endpoint
+        request = self.client().post('/readings/bulk/', data=json.dumps(readings))
+        self.assertEqual(request.status_code, 201)
+
+        # Then each device's readings should be stored in its own shard only
+        for reading in readings:
+            path = shard_path('test_database.db', 2, reading['device_uuid'])
+            conn = sqlite3.connect(path)
+            self.assertEqual(conn.execute('select count(*) from readings where device_uuid = ?',
+                                          (reading['device_uuid'],)).fetchone()[0], 1)
+            conn.close()
+
+        # And the device endpoints should read from that shard
+        request = self.client().get('/devices/shard_3/readings/max/?type=temperature')
+        self.assertEqual(json.loads(request.data)['value'], 3)
+
+        # And the fleet endpoints should cover every shard
+        request = self.client().get('/readings/fleet/stats/?type=temperature')
+        self.assertEqual(json.loads(request.data)['count'], 10)
+        request = self.client().get('/readings/fleet/stats/?type=temperature&devices=shard_1,shard_2')
+        self.assertEqual(json.loads(request.data)['count'], 2)
+
+    def test_pool_built_once(self):
+        # Given no connection pool yet, and one that is slow to build
+        def build(**options):
+            time.sleep(0.05)
+            return object()
+
+        with mock.patch('app._pool', None), mock.patch('app.ConnectionPool', side_effect=build) as pool_class:
+            # When several threads ask for it at once
+            pools = []
+            threads = [threading.Thread(target=lambda: pools.append(_get_pool())) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Then it should only be built once, and shared by all of them
+        self.assertEqual(pool_class.call_count, 1)
+        self.assertEqual(len(set(map(id, pools))), 1)
+
+    def _remove_shards(self):
+        app.config['SHARD_COUNT'] = 1
+        _get_pool().close()
+        for path in shard_paths('test_database.db', 2):
+            os.remove(path)
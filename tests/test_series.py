@@ -0,0 +1,124 @@
+import random
+import sqlite3
+import unittest
+from marshmallow import ValidationError
+from db import migrate
+from ingest import insert_readings
+from schemas import MAX_SERIES_POINTS, DeviceReadingSeriesInputSchema
+from series import bucket_series, lttb, lttb_series
+
+
+def reference_lttb(points, interval):
+    # LTTB over time buckets, with the whole series in memory
+    points = list(points)
+    if len(points) < 3:
+        return points
+
+    middle = points[1:-1]
+    buckets = []
+    for point in middle:
+        if buckets and buckets[-1][0][0] // interval == point[0] // interval:
+            buckets[-1].append(point)
+        else:
+            buckets.append([point])
+    buckets.append([points[-1]])
+
+    kept = [points[0]]
+    for bucket, after in zip(buckets, buckets[1:]):
+        c = (sum(d for d, _ in after) / len(after), sum(v for _, v in after) / len(after))
+        a = kept[-1]
+        kept.append(max(bucket, key=lambda b: abs((a[0] - c[0]) * (b[1] - a[1]) - (a[0] - b[0]) * (c[1] - a[1]))))
+    kept.append(points[-1])
+    return kept
+
+
+class SeriesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup an in-memory DB with two days of readings
+        self.conn = sqlite3.connect(':memory:')
+        migrate(self.conn)
+
+        self.device_uuid = 'test_device'
+
+        generator = random.Random(3)
+        self.readings = sorted((generator.randint(0, 2 * 86400), generator.randint(0, 100)) for _ in range(3000))
+        insert_readings(self.conn, [(self.device_uuid, 'temperature', value, date) for date, value in self.readings])
+        insert_readings(self.conn, [(self.device_uuid, 'humidity', 1, 100), ('other_uuid', 'temperature', 1, 100)])
+
+    def test_buckets_match_raw_readings(self):
+        # Given intervals that do and do not line up with the rollups, and ragged windows
+        for interval in [45, 60, 600, 3600, 7200, 86400]:
+            for start, end in [(0, 2 * 86400), (59, 86400 + 3600 * 5 + 61), (1000, 1100)]:
+                # When we build the series
+                series = bucket_series(self.conn, self.device_uuid, 'temperature', start, end, interval)
+
+                # Then every bucket should hold the aggregates of its raw readings
+                expected = {}
+                for date, value in self.readings:
+                    if start <= date < end:
+                        expected.setdefault(date - date % interval, []).append(value)
+                self.assertEqual([row[:4] for row in series],
+                                 [(bucket, len(values), min(values), max(values))
+                                  for bucket, values in sorted(expected.items())], (interval, start, end))
+                for (bucket, count, _, _, mean), values in zip(series, (expected[row[0]] for row in series)):
+                    self.assertAlmostEqual(mean, sum(values) / count)
+
+    def test_lttb_matches_reference(self):
+        # Given a dense series
+        for interval in [1, 500, 3600, 86400, 10 ** 6]:
+            # When we downsample it in a single pass
+            points = lttb_series(self.conn, self.device_uuid, 'temperature', 0, 2 * 86400 + 1, interval)
+
+            # Then it should pick the same points as the whole-series version
+            self.assertEqual(points, reference_lttb(self.readings, interval), interval)
+
+        # And short series should come back whole
+        self.assertEqual(list(lttb([], 10)), [])
+        self.assertEqual(list(lttb([(1, 5)], 10)), [(1, 5)])
+        self.assertEqual(list(lttb([(1, 5), (2, 6)], 10)), [(1, 5), (2, 6)])
+
+    def test_default_points_read_rollups(self):
+        # Given a week of readings, and the interval of the default points
+        insert_readings(self.conn, [(self.device_uuid, 'temperature', 50, date) for date in range(0, 7 * 86400, 97)])
+        data = DeviceReadingSeriesInputSchema().load({'type': 'temperature', 'start': 0, 'end': 7 * 86400})
+
+        # When we build the series
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        series = bucket_series(self.conn, self.device_uuid, 'temperature', 0, 7 * 86400, data['interval'])
+        self.conn.set_trace_callback(None)
+
+        # Then it should be added up from the rollups without reading any
+        # reading, and match the readings
+        self.assertEqual(data['interval'] % 60, 0)
+        self.assertTrue(any('from reading_rollups' in statement for statement in statements))
+        self.assertFalse(any('"readings_' in statement for statement in statements))
+        self.assertEqual(sum(row[1] for row in series), self.conn.execute(
+            "select count(*) from readings where device_uuid = ? and type = 'temperature'", (self.device_uuid,)
+        ).fetchone()[0])
+
+    def test_series_size_is_bounded(self):
+        # Given a window of the two days
+        data = DeviceReadingSeriesInputSchema().load({'type': 'temperature', 'start': 0, 'end': 2 * 86400,
+                                                      'points': 100})
+
+        # Then the points should be turned into an interval giving at most
+        # that many, in whole minutes
+        self.assertEqual(data['interval'], 1740)
+        self.assertLessEqual(len(bucket_series(self.conn, self.device_uuid, 'temperature', 0, 2 * 86400,
+                                               data['interval'])), 100)
+        self.assertLessEqual(len(lttb_series(self.conn, self.device_uuid, 'temperature', 0, 2 * 86400,
+                                             data['interval'])), 102)
+
+        # And longer ones should be rounded up to whole hours or days, and
+        # shorter ones left alone
+        for end, points, interval in [(30 * 86400, 100, 28800), (400 * 86400, 100, 4 * 86400), (1000, 100, 10)]:
+            data = DeviceReadingSeriesInputSchema().load({'type': 'temperature', 'start': 0, 'end': end,
+                                                          'points': points})
+            self.assertEqual(data['interval'], interval)
+
+        # And intervals giving too many points should be rejected
+        with self.assertRaises(ValidationError):
+            DeviceReadingSeriesInputSchema().load({'type': 'temperature', 'start': 0, 'end': MAX_SERIES_POINTS + 1,
+                                                   'interval': 1})
@@ -0,0 +1,227 @@
+import http.client
+import json
+import os
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from app import app
+from db import migrate
+from ingest import close_ingest_queues
+from writer import WriterClient, WriterError, WriterServer
+
+
+class WriterChannelTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a writer on a Unix socket, writing to two empty shards
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = [os.path.join(directory.name, 'shard-{}.db'.format(i)) for i in range(2)]
+        for path in self.paths:
+            conn = sqlite3.connect(path)
+            migrate(conn)
+            conn.close()
+
+        address = os.path.join(directory.name, 'writer.sock')
+        self.server = WriterServer(address, b'secret', flush_interval=0.01)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = WriterClient(address, b'secret')
+
+        self.addCleanup(close_ingest_queues)
+        self.addCleanup(self.server.close)
+        self.addCleanup(self.client.close)
+
+    def test_writes_are_committed_and_followed(self):
+        # Given a follower
+        commits = []
+        followed = threading.Event()
+
+        def on_commit(path, rows, versions, sequence):
+            commits.append((path, rows, sequence))
+            if sum(len(rows) for _, rows, _ in commits) == 4:
+                followed.set()
+
+        self.client.follow(on_commit)
+
+        # When readings for both shards are written, one batch at a time
+        self.assertEqual(self.client.write({self.paths[0]: [('a', 'temperature', 1, 10), ('a', 'temperature', 2, 20)],
+                                            self.paths[1]: [('b', 'humidity', 3, 30)]}), 'committed')
+        self.assertEqual(self.client.write({self.paths[1]: [('b', 'humidity', 4, 40)]}), 'committed')
+
+        # Then they should be in the shards once the write returns
+        for path, count in zip(self.paths, (2, 2)):
+            conn = sqlite3.connect(path)
+            self.assertEqual(conn.execute('select count(*) from readings').fetchone()[0], count)
+            conn.close()
+
+        # And the follower should get every commit, numbered one row after the other
+        self.assertTrue(followed.wait(5))
+        sequences = sorted((sequence, len(rows)) for _, rows, sequence in commits)
+        self.assertEqual(sequences[0][0], 1)
+        for (sequence, count), (following, _) in zip(sequences, sequences[1:]):
+            self.assertEqual(following, sequence + count)
+
+        # And a write that is not waited for should only be queued
+        self.assertEqual(self.client.write({self.paths[0]: [('a', 'temperature', 5, 50)]}, wait=False), 'queued')
+
+    def test_slow_follower_is_dropped(self):
+        # Given a follower that stops taking in commits, with room for two
+        self.server.follow_buffer = 2
+        commits = []
+        unblocked = threading.Event()
+
+        def on_commit(path, rows, versions, sequence):
+            unblocked.wait()
+            commits.append((sequence, len(rows)))
+
+        self.client.follow(on_commit)
+
+        # When more commits than fit in its queue and socket are written
+        for i in range(40):
+            rows = [('device_{}_{}'.format(i, j), 'temperature', j, j) for j in range(500)]
+            # Then none of them should wait for the follower
+            self.assertEqual(self.client.write({self.paths[0]: rows}), 'committed')
+
+        # And once it takes in commits again, it should follow the writer again
+        unblocked.set()
+        self.assertEqual(self.client.write({self.paths[1]: [('b', 'humidity', 1, 10)]}), 'committed')
+        deadline = time.monotonic() + 5
+        while (self.server.sequence, 1) not in commits:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_failed_commit(self):
+        # Given a shard the writer fails to commit to
+        with mock.patch('ingest.insert_readings', side_effect=sqlite3.OperationalError('disk I/O error')):
+            # When readings are written to it
+            # Then the reader should be told why
+            with self.assertRaisesRegex(WriterError, 'disk I/O error'):
+                self.client.write({self.paths[0]: [('a', 'temperature', 1, 10)]})
+
+        # And the app should answer the POST with a 500 saying so
+        app.config['TESTING'] = True
+        with mock.patch('app._get_writer', return_value=self.client), \
+                mock.patch('ingest.insert_readings', side_effect=sqlite3.OperationalError('disk I/O error')):
+            request = app.test_client().post('/devices/a/readings/', data=json.dumps(dict(type='temperature', value=1)))
+        self.assertEqual(request.status_code, 500)
+        self.assertIn(b'disk I/O error', request.data)
+
+
+class ServeTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup serve.py with 2 readers on a free port, with an empty DB
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db = os.path.join(directory.name, 'serve.db')
+        self.log = open(os.path.join(directory.name, 'serve.log'), 'w+')
+        self.addCleanup(self.log.close)
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = subprocess.Popen([sys.executable, os.path.join(root, 'serve.py'), '--workers', '2', '--port', '0',
+                                         '--db', self.db], cwd=root, stdout=self.log, stderr=subprocess.STDOUT)
+        self.addCleanup(self._stop)
+
+        deadline = time.monotonic() + 30
+        while True:
+            self.log.seek(0)
+            match = re.search(r'Serving on http://[^:]+:(\d+)', self.log.read())
+            if match:
+                break
+            self.assertIsNone(self.process.poll())
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.1)
+        self.port = int(match.group(1))
+
+    def _stop(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def _request(self, method, path, body=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response.status, data
+
+    def _wait_for(self, predicate):
+        deadline = time.monotonic() + 10
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_writes_reach_every_reader(self):
+        # Given a live stream open on one of the readers
+        stream = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        stream.request('GET', '/devices/device_1/readings/stream/')
+        events = stream.getresponse()
+        self.assertEqual(events.status, 200)
+        self.assertEqual(events.readline(), b'retry: 1000\n')
+
+        # When a reading is POSTed, whichever reader takes it
+        status, _ = self._request('POST', '/devices/device_1/readings/',
+                                  dict(type='temperature', value=42, date_created=1000))
+        self.assertEqual(status, 201)
+
+        # Then the stream should get it, numbered by the writer
+        lines = [events.readline() for _ in range(4)]
+        self.assertRegex(lines[1], rb'^id: [0-9a-f]+-1\n$')
+        self.assertIn(b'"value":42', lines[3])
+        stream.close()
+
+        # And every reader's latest index should have it
+        for _ in range(6):
+            status, data = self._request('GET', '/devices/device_1/readings/latest/')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(data)['temperature']['value'], 42)
+
+    def test_shutdown_drains_writes(self):
+        # Given readings POSTed from a few clients at once
+        acknowledged = []
+        stopping = threading.Event()
+
+        def post(client):
+            date_created = 0
+            while not stopping.is_set():
+                date_created += 1
+                try:
+                    status, _ = self._request('POST', '/readings/bulk/', [
+                        dict(device_uuid='device_{}'.format(client), type='humidity', value=1, date_created=date_created)])
+                except OSError:
+                    return
+                if status == 201:
+                    acknowledged.append(('device_{}'.format(client), date_created))
+
+        clients = [threading.Thread(target=post, args=(client,)) for client in range(4)]
+        for client in clients:
+            client.start()
+        self._wait_for(lambda: len(acknowledged) >= 20)
+
+        # When the server is told to stop while they keep going
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(30), 0)
+        stopping.set()
+        for client in clients:
+            client.join()
+
+        # Then every reading it acknowledged should have been committed
+        conn = sqlite3.connect(self.db)
+        committed = set(conn.execute('select device_uuid, date_created from readings').fetchall())
+        self.assertTrue(committed.issuperset(acknowledged))
+        conn.close()
+        self.log.seek(0)
+        self.assertIn('Stopped', self.log.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import io
+import os
+import sqlite3
+import unittest
+from db import PARTITION_SIZE, migrate
+from ingest import insert_readings
+from retention import expire_partitions
+from shards import group_by_shard, reshard, shard_path, shard_paths
+from stats import compute_stats
+
+
+class ShardsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a single shard DB with readings for a few devices
+        self.base_path = 'test_shards.db'
+        self.addCleanup(self._remove_shards)
+
+        conn = sqlite3.connect(self.base_path)
+        migrate(conn)
+        self.readings = [('device_{}'.format(i % 7), 'temperature', i % 101, i * 60) for i in range(500)]
+        insert_readings(conn, self.readings)
+        conn.close()
+
+    def _remove_shards(self):
+        for count in (1, 3):
+            for path in shard_paths(self.base_path, count):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_shard_paths(self):
+        # Given a base path
+        # Then a single shard should keep it, and more should be numbered
+        self.assertEqual(shard_paths('database.db', 1), ['database.db'])
+        self.assertEqual(shard_paths('database.db', 2), ['database-0-of-2.db', 'database-1-of-2.db'])
+
+        # And a device should always be routed to the same shard
+        self.assertEqual(shard_path('database.db', 4, 'device_1'), shard_path('database.db', 4, 'device_1'))
+        groups = group_by_shard('database.db', 4, self.readings)
+        self.assertEqual(sum(len(rows) for rows in groups.values()), len(self.readings))
+        for path, rows in groups.items():
+            self.assertTrue(all(shard_path('database.db', 4, row[0]) == path for row in rows))
+
+    def test_reshard(self):
+        # Given later readings, and the oldest ones expired with their
+        # aggregates kept
+        def stats(path):
+            conn = sqlite3.connect(path)
+            results = compute_stats(conn, 'device_1', 'temperature', metrics=['min', 'max', 'mean', 'mode'])
+            conn.close()
+            return results
+
+        later = [('device_{}'.format(i % 5), 'temperature', i % 101, 2 * PARTITION_SIZE + i) for i in range(100)]
+        conn = sqlite3.connect(self.base_path)
+        insert_readings(conn, later)
+        expire_partitions(conn, 2 * PARTITION_SIZE)
+        conn.close()
+        before = stats(self.base_path)
+
+        # When we move the readings from 1 shard to 3
+        copied = reshard(self.base_path, 1, 3, batch_size=64, log=io.StringIO())
+
+        # Then every reading left should be copied into its device's shard
+        self.assertEqual(copied, len(later))
+        counted = 0
+        for path in shard_paths(self.base_path, 3):
+            conn = sqlite3.connect(path)
+            rows = conn.execute('select device_uuid, type, value, date_created from readings').fetchall()
+            self.assertTrue(all(shard_path(self.base_path, 3, row[0]) == path for row in rows))
+
+            # And the rollups should be copied along with them, expired readings included
+            count, = conn.execute('select coalesce(sum(count), 0) from reading_rollups where resolution = 86400').fetchone()
+            counted += count
+            conn.close()
+        self.assertEqual(counted, len(self.readings) + len(later))
+
+        # And the stats should come out the same as before
+        self.assertEqual(stats(shard_path(self.base_path, 3, 'device_1')), before)
+
+        # And resharding onto the same count should be refused
+        with self.assertRaises(ValueError):
+            reshard(self.base_path, 3, 3, log=io.StringIO())
+
+    def test_reshard_checks_sources(self):
+        # Given a shard count that does not match the files
+        # When we reshard from it
+        # Then it should be refused without creating any shard
+        with self.assertRaisesRegex(ValueError, 'current shard count'):
+            reshard(self.base_path, 2, 3, log=io.StringIO())
+        self.assertFalse(any(os.path.exists(path) for path in shard_paths(self.base_path, 3)))
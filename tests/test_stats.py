@@ -0,0 +1,147 @@
+import random
+import sqlite3
+import statistics
+import unittest
+from db import migrate
+from ingest import insert_readings
+from stats import Histogram, batch_stats, compute_stats, cover_range, reading_at, value_histogram, value_summary
+
+
+class StatisticsEngineTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup an in-memory DB with readings spread over several hourly buckets
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.row_factory = sqlite3.Row
+        migrate(self.conn)
+
+        self.device_uuid = 'test_device'
+
+        generator = random.Random(7)
+        self.readings = [(generator.randint(0, 100), generator.randint(0, 2 * 86400)) for _ in range(2000)]
+        insert_readings(self.conn, [(self.device_uuid, 'temperature', value, date) for value, date in self.readings])
+
+        self.windows = [(None, None), (0, 3600), (100, 1300), (1000, 4 * 3600 + 17), (None, 7300), (5000, None),
+                        (59, 86400 + 3600 * 5 + 61), (86400, 2 * 86400)]
+
+    def _values(self, start, end):
+        return sorted(value for value, date in self.readings
+                      if (start is None or date >= start) and (end is None or date < end))
+
+    def test_histogram_matches_raw_values(self):
+        # Given windows with and without ragged bucket edges
+        for start, end in self.windows:
+            # When we build the histogram for the window
+            histogram = value_histogram(self.conn, self.device_uuid, 'temperature', start, end)
+            values = self._values(start, end)
+
+            # Then it should hold exactly the values in the window
+            self.assertEqual(len(histogram), len(values))
+            self.assertEqual(round(histogram.mean()), round(statistics.mean(values)))
+            self.assertEqual(histogram.mode(), min(statistics.multimode(values)))
+
+            # And the quartiles should match the medians of each half
+            mid = len(values) // 2
+            self.assertEqual(histogram.quartiles(),
+                             (statistics.median(values[:mid]), statistics.median(values[-mid:])))
+
+    def test_reading_at_matches_sorted_readings(self):
+        # Given a window with ragged edges
+        start, end = 1000, 4 * 3600 + 17
+        histogram = value_histogram(self.conn, self.device_uuid, 'temperature', start, end)
+
+        # When we look up the median reading
+        reading = reading_at(self.conn, histogram, len(histogram) // 2, self.device_uuid, 'temperature', start, end)
+
+        # Then it should be the one at the middle of the value, date ordering
+        ordered = sorted((value, date) for value, date in self.readings if start <= date < end)
+        self.assertEqual(reading, ordered[len(ordered) // 2])
+
+    def test_percentile_nearest_rank(self):
+        # Given the values 1 to 10
+        histogram = Histogram({value: 1 for value in range(1, 11)})
+
+        # Then the percentiles should use the nearest rank
+        self.assertEqual(histogram.percentile(0), 1)
+        self.assertEqual(histogram.percentile(25), 3)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(95), 10)
+        self.assertEqual(histogram.percentile(100), 10)
+
+    def test_summary_matches_raw_values(self):
+        # Given windows covered by day, hour and minute buckets and raw edges
+        for start, end in self.windows:
+            # When we build the summary for the window
+            summary = value_summary(self.conn, self.device_uuid, 'temperature', start, end)
+            readings = [(value, date) for value, date in self.readings
+                        if (start is None or date >= start) and (end is None or date < end)]
+
+            # Then it should match the raw readings
+            self.assertEqual(len(summary), len(readings))
+            self.assertEqual(summary.total, sum(value for value, _ in readings))
+
+            # And the min and max should be the earliest reading with that value
+            self.assertEqual(summary.min, min(readings))
+            self.assertEqual(summary.max, min(readings, key=lambda reading: (-reading[0], reading[1])))
+
+    def test_cover_range(self):
+        # Given a range with ragged edges either side of a whole day
+        # When we cover it with day, hour and minute buckets
+        buckets, edges = cover_range(86400 - 3600 - 90, 2 * 86400 + 60 + 5, (86400, 3600, 60))
+
+        # Then it should use the coarsest buckets that fit
+        self.assertEqual(buckets, [
+            (86400, 86400, 2 * 86400),
+            (3600, 86400 - 3600, 86400),
+            (60, 86400 - 3600 - 60, 86400 - 3600),
+            (60, 2 * 86400, 2 * 86400 + 60),
+        ])
+
+        # And leave only the sub-minute edges for the raw readings
+        self.assertEqual(edges, [(86400 - 3600 - 90, 86400 - 3600 - 60), (2 * 86400 + 60, 2 * 86400 + 65)])
+
+    def test_cover_range_open(self):
+        # Given an open start
+        # When we cover the range up to the middle of a day
+        buckets, edges = cover_range(None, 86400 + 3600, (86400, 3600, 60))
+
+        # Then it should use all the days before it and the hour after
+        self.assertEqual(buckets, [(86400, None, 86400), (3600, 86400, 86400 + 3600)])
+        self.assertEqual(edges, [])
+
+    def test_compute_stats_subset(self):
+        # Given a window with readings
+        # When we compute a subset of the metrics
+        results = compute_stats(self.conn, self.device_uuid, 'temperature', 1000, 90000, ['mean', 'quartiles'])
+
+        # Then only those metrics should be returned
+        self.assertEqual(set(results), {'mean', 'quartiles'})
+        self.assertEqual(set(results['quartiles']), {'quartile_1', 'quartile_3'})
+
+    def test_compute_stats_no_readings(self):
+        # Given a window with no readings
+        # When we compute the metrics
+        # Then there should be no results
+        self.assertIsNone(compute_stats(self.conn, self.device_uuid, 'humidity', 1000, 90000))
+
+    def test_batch_stats_match_compute_stats(self):
+        # Given several devices, one with readings outside the windows, including negative dates
+        generator = random.Random(11)
+        devices = ['device_{}'.format(i) for i in range(5)]
+        insert_readings(self.conn, [(device, 'temperature', generator.randint(0, 100), generator.randint(-86400, 86400))
+                                    for device in devices[:4] for _ in range(300)])
+        insert_readings(self.conn, [(devices[4], 'temperature', 50, 10 ** 6)])
+        devices += [self.device_uuid, 'unknown_device']
+
+        for start, end in self.windows:
+            # When we compute every metric for all of them at once, in small chunks
+            results = batch_stats(self.conn, devices, 'temperature', start, end, chunk_size=2)
+
+            # Then each device should get what compute_stats gives it alone
+            self.assertEqual(results, {device: compute_stats(self.conn, device, 'temperature', start, end)
+                                       for device in devices}, (start, end))
+
+        # And subsets of the metrics should match as well
+        self.assertEqual(batch_stats(self.conn, devices, 'temperature', 59, 90000, ['max', 'mode']),
+                         {device: compute_stats(self.conn, device, 'temperature', 59, 90000, ['max', 'mode'])
+                          for device in devices})
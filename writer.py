@@ -0,0 +1,276 @@
+import functools
+import logging
+import os
+import pickle
+import queue
+import socket
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from ingest import IngestQueueFull, get_ingest_queue, put_batches
+
+logger = logging.getLogger(__name__)
+
+
+class WriterError(Exception):
+    pass
+
+
+class WriterServer(object):
+    """
+    The writer process's end of the local channel the reader processes of
+    serve.py send their writes over, a Unix socket.
+
+    Every write goes on the IngestQueue of its shard, so this process is
+    the only one ever holding a write transaction, and concurrent POSTs
+    from all the readers are group committed together. Once a group commit
+    has succeeded its rows are sent to every reader following the writer,
+    numbered in the order they were committed, so each reader can feed its
+    live streams and drop the metric cache entries they fall into.
+
+    Each reader gets the commits through a queue of its own, holding at
+    most follow_buffer of them. A reader that falls further behind is
+    dropped instead of holding up the commits, and follows again.
+
+    A write waited for fails after ack_timeout seconds without its commit.
+    queue_options are passed on to get_ingest_queue.
+    """
+
+    def __init__(self, address, authkey, ack_timeout=None, follow_buffer=1000, **queue_options):
+        self.ack_timeout = ack_timeout
+        self.follow_buffer = follow_buffer
+        self.queue_options = queue_options
+        self.sequence = 0
+        self._listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self._followers = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def serve_forever(self):
+        """
+        Accept readers, one thread per connection, until close is called.
+        Run it on a daemon thread, a blocked accept is not woken by close.
+        """
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                if self._closed:
+                    return
+                raise
+            except (AuthenticationError, EOFError):
+                # Went away or failed to authenticate
+                continue
+            threading.Thread(target=self._handle, args=(conn,), name='writer-connection', daemon=True).start()
+
+    def close(self):
+        """
+        Stop accepting readers. Writes already sent are committed by
+        close_ingest_queues, which the caller runs once nothing else can
+        arrive.
+        """
+        self._closed = True
+        self._listener.close()
+        with self._lock:
+            for follower in self._followers:
+                follower.close()
+            self._followers = []
+
+    def _handle(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'follow':
+                    # Acknowledged once it is on the list, so no commit after
+                    # follow returns can be missed
+                    with self._lock:
+                        conn.send_bytes(b'')
+                        self._followers.append(_Follower(conn, self.follow_buffer))
+                    return
+
+                _, shards, wait = message
+                conn.send(self._write(shards, wait))
+        except (EOFError, OSError):
+            conn.close()
+
+    def _write(self, shards, wait):
+        # Queued on every shard at once, or on none of them
+        try:
+            tickets = put_batches({self._get_queue(path): rows for path, rows in shards.items()})
+        except IngestQueueFull:
+            return ('full',)
+
+        if not wait:
+            return ('queued',)
+        try:
+            for ticket in tickets:
+                ticket.wait(self.ack_timeout)
+        except TimeoutError:
+            return ('timeout',)
+        except Exception as err:
+            return ('error', str(err))
+        return ('committed',)
+
+    def _get_queue(self, path):
+        return get_ingest_queue(path, on_commit=functools.partial(self._committed, path), **self.queue_options)
+
+    def _committed(self, path, rows, versions):
+        # Called by the ingest threads of every shard. Pickled once, and
+        # queued under the lock so the followers get the commits in sequence
+        # order
+        with self._lock:
+            data = pickle.dumps((path, self.sequence + 1, rows, versions), pickle.HIGHEST_PROTOCOL)
+            self.sequence += len(rows)
+            for follower in list(self._followers):
+                if not follower.put(data):
+                    logger.warning('Dropped a reader %d commits behind', self.follow_buffer)
+                    self._followers.remove(follower)
+                    follower.close()
+
+
+class _Follower(object):
+    # A reader following the writer, sent its commits from a thread of its
+    # own so a reader that stops reading only ever blocks that thread
+
+    def __init__(self, conn, maxsize):
+        self.conn = conn
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        threading.Thread(target=self._send, name='writer-follower', daemon=True).start()
+
+    def put(self, data):
+        # False when the reader is maxsize commits behind
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        # Shut down rather than closed, which wakes a send blocked on the
+        # reader without freeing the descriptor under it. The sending thread
+        # closes it once it sees the send fail, or the end of the queue
+        with self._lock:
+            if not self.conn.closed:
+                with socket.socket(fileno=os.dup(self.conn.fileno())) as sock:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _send(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            try:
+                self.conn.send_bytes(data)
+            except OSError:
+                break
+        with self._lock:
+            self.conn.close()
+
+
+class WriterClient(object):
+    """
+    A reader process's end of the channel to the WriterServer.
+
+    Each thread writing checks a connection out of a small pool, sends its
+    rows and waits for the writer's answer, so there is never more than one
+    request in flight on a connection.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def write(self, shards, wait=True):
+        """
+        Send {shard path: rows} to the writer to be queued on every shard at
+        once. With wait, returns 'committed' once all of them have been
+        committed, otherwise 'queued' as soon as they are queued. Raises
+        IngestQueueFull when a queue is full, TimeoutError when the commit
+        took longer than the writer's ack_timeout, and WriterError when it
+        failed.
+        """
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+        try:
+            conn.send(('write', shards, wait))
+            reply = conn.recv()
+        except BaseException:
+            conn.close()
+            raise
+
+        with self._lock:
+            self._idle.append(conn)
+
+        if reply[0] == 'full':
+            raise IngestQueueFull('The ingest queue is full')
+        if reply[0] == 'timeout':
+            raise TimeoutError('Timed out waiting for the readings to be committed')
+        if reply[0] == 'error':
+            raise WriterError(reply[1])
+        return reply[0]
+
+    def follow(self, on_commit):
+        """
+        Call on_commit(path, rows, versions, sequence) from a thread for
+        every group commit of the writer, in the order they were committed.
+        versions are those the commit left the devices at (see
+        insert_readings), and sequence is the number of the first of the
+        rows, counting every row committed since the writer started.
+
+        When the writer drops this reader for falling behind, it follows
+        again and the commits in between are skipped. The write versions
+        tell the caches what they missed. Returns the thread, which stops
+        when the writer goes away.
+        """
+        conn = self._follow()
+
+        def run():
+            nonlocal conn
+            while True:
+                try:
+                    path, sequence, rows, versions = pickle.loads(conn.recv_bytes())
+                except (EOFError, OSError):
+                    conn.close()
+                    try:
+                        conn = self._follow()
+                    except (EOFError, OSError):
+                        return
+                    logger.warning('Fell behind the writer, following it again')
+                    continue
+                try:
+                    on_commit(path, rows, versions, sequence)
+                except Exception:
+                    logger.exception('Failed to take in %d committed readings', len(rows))
+
+        thread = threading.Thread(target=run, name='writer-follower', daemon=True)
+        thread.start()
+        return thread
+
+    def _follow(self):
+        conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        try:
+            conn.send(('follow',))
+            conn.recv_bytes()
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []